@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Fleet mode end to end on one machine: a local fleet.py controller and N web.py agents, each with its own data dir.
+
+  python3 bench/fleet.py [--nodes 3] [--users 300] [--timeout 60] [--out fleet.json]
+
+Agents run through web.py's own serve() on the fake system binaries from hotpaths.py. The script drives the
+controller's admin API through create / edit / move / delete / agent wipe-and-resync steps and after each one
+waits until every agent's users.json holds exactly the fleet users assigned to it with the controller's
+passwords. Reported per step: convergence time and the change entries agents pulled (deltas, not dumps);
+at the end: each node's applied version, lag and whether the ports agents picked made it back.
+Exits 1 if any step does not converge. Needs flask.
+"""
+import argparse, json, os, subprocess, sys, tempfile, time, urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from hotpaths import fake_outputs, setup_env
+from load import free_port
+
+SECRET = "fleet-bench-secret"
+
+def call(port, method, path, body=None, token=SECRET):
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", method=method,
+                                 data=None if body is None else json.dumps(body).encode(),
+                                 headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30) as r: return json.loads(r.read())
+
+def wait_up(port, path, proc, log):
+    for _ in range(200):
+        if proc.poll() is not None: sys.exit(f"exited, see {log}")
+        try: urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=2).read(); return
+        except OSError: time.sleep(0.05)
+    sys.exit(f"did not come up, see {log}")
+
+class Agent:
+    def __init__(self, name, token, tmp, controller):
+        self.name, self.token, self.controller = name, token, controller
+        self.dir = os.path.join(tmp, name); os.makedirs(self.dir)
+        with open(os.path.join(self.dir, "users.json"), "w") as f: f.write("[]")
+        self.port = free_port(); self.proc = None
+
+    def start(self):
+        log = os.path.join(self.dir, "agent.log")
+        env = dict(os.environ, WEB_PORT=str(self.port), WEB_WORKERS="1", FLEET_URL=f"http://127.0.0.1:{self.controller}",
+                   FLEET_TOKEN=self.token, FLEET_STATE_FILE=os.path.join(self.dir, "fleet.json"), FLEET_REPORT="1")
+        self.proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "bench", "load.py"), "--_serve", "web", self.dir],
+                                     env=env, stdout=open(log, "a"), stderr=subprocess.STDOUT, cwd=self.dir)
+        wait_up(self.port, "/favicon.ico", self.proc, log)
+
+    def stop(self):
+        self.proc.terminate(); self.proc.wait(10)
+
+    def users(self):
+        try:
+            with open(os.path.join(self.dir, "users.json")) as f: return {u["user"]: u for u in json.load(f) if u.get("fleet")}
+        except (OSError, ValueError): return None   # mid-replace
+
+    def stats(self):
+        return call(self.port, "GET", "/debug").get("fleet", {})
+
+def converge(agents, want, timeout):
+    """Seconds until every agent holds exactly want[node] ({user: password}); None on timeout."""
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        if all((lambda have: have is not None and {u: r.get("password") for u, r in have.items()} == want[a.name])(a.users())
+               for a in agents):
+            return round(time.monotonic() - t0, 2)
+        time.sleep(0.05)
+    return None
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--nodes", type=int, default=3)
+    ap.add_argument("--users", type=int, default=300)
+    ap.add_argument("--timeout", type=float, default=60)
+    ap.add_argument("--out", help="write the results as JSON")
+    a = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="zivpn-fleet-")
+    setup_env(tmp)
+    os.environ["PYTHONPATH"] = os.pathsep.join([ROOT, os.path.join(ROOT, "bench"), os.environ.get("PYTHONPATH", "")])
+    for name, text in fake_outputs([]).items():
+        with open(os.path.join(os.environ["FAKE_OUT"], name), "w") as f: f.write(text)
+
+    cport = free_port(); clog = os.path.join(tmp, "controller.log")
+    controller = subprocess.Popen([sys.executable, os.path.join(ROOT, "fleet.py")], stdout=open(clog, "w"), stderr=subprocess.STDOUT,
+                                  env=dict(os.environ, FLEET_DB=os.path.join(tmp, "fleet.db"), FLEET_SECRET=SECRET,
+                                           FLEET_PORT=str(cport), FLEET_BIND="127.0.0.1"))
+    wait_up(cport, "/api/health", controller, clog)
+    agents = []
+    try:
+        for i in range(a.nodes):
+            name = f"node{i}"
+            agents.append(Agent(name, call(cport, "POST", "/api/nodes", {"name": name})["token"], tmp, cport))
+        for ag in agents: ag.start()
+        want = {ag.name: {} for ag in agents}
+        home = {}
+        def upsert(rows):
+            res = call(cport, "POST", "/api/users", rows)
+            bad = [r for r in res["results"] if not r["ok"]]
+            if bad: sys.exit(f"controller rejected rows: {bad[:3]}")
+            for r in rows:
+                old = home.get(r["user"]); node = r.get("node", old)
+                pw = want[old].pop(r["user"]) if old else None
+                home[r["user"]] = node
+                want[node][r["user"]] = r.get("password", pw)
+
+        steps = []
+        def step(name, fn):
+            before = [ag.stats().get("changes", 0) for ag in agents]
+            fn()
+            t = converge(agents, want, a.timeout)
+            head = call(cport, "GET", "/api/health")["head"]
+            for _ in range(int(a.timeout * 20)):   # counters move just after the store write converge() saw
+                stats = [ag.stats() for ag in agents]
+                if all(st.get("applied", 0) >= head for st in stats): break
+                time.sleep(0.05)
+            after = [st.get("changes", 0) for st in stats]
+            pulled = sum(n - b if n >= b else n for b, n in zip(before, after))   # a restarted agent counts from 0
+            steps.append({"step": name, "seconds": t, "changes_pulled": pulled})
+            print(f"{name:28} {'did not converge' if t is None else f'{t:>6} s'}   {pulled:>6} changes pulled", flush=True)
+
+        names = [f"fu{i:05d}" for i in range(a.users)]
+        step(f"create {a.users}", lambda: upsert([{"user": u, "password": f"pw-{u}", "expires": "2030-01-01",
+                                                    "node": f"node{i % a.nodes}"} for i, u in enumerate(names)]))
+        edit = names[::10]
+        step(f"edit {len(edit)} passwords", lambda: upsert([{"user": u, "password": f"pw2-{u}"} for u in edit]))
+        move = names[1::20]
+        step(f"move {len(move)} to another node",
+             lambda: upsert([{"user": u, "node": f"node{(int(home[u][4:]) + 1) % a.nodes}"} for u in move]))
+        gone = names[2::20]
+        def delete():
+            for u in gone:
+                call(cport, "DELETE", f"/api/users/{u}"); want[home.pop(u)].pop(u)
+        step(f"delete {len(gone)}", delete)
+        def wipe():
+            ag = agents[0]; ag.stop()
+            os.remove(os.path.join(ag.dir, "fleet.json"))
+            with open(os.path.join(ag.dir, "users.json"), "w") as f: f.write("[]")
+            ag.start()
+        step("wipe node0 (full resync)", wipe)
+
+        time.sleep(2.5)   # FLEET_REPORT=1: let every agent report
+        nodes = call(cport, "GET", "/api/nodes")
+        users = call(cport, "GET", "/api/users")["users"]
+        report = {"head": nodes["head"], "nodes": [{k: n[k] for k in ("name", "users", "applied", "pending", "age")} for n in nodes["nodes"]],
+                  "ports_reported": sum(1 for u in users if u.get("port")), "users": len(users),
+                  "agents": {ag.name: ag.stats() for ag in agents}}
+        for n in report["nodes"]:
+            print(f"{n['name']:8} {n['users']:>6} users  applied v{n['applied']} of v{nodes['head']}  {n['pending']} log entries pending")
+        print(f"ports picked by agents and reported back: {report['ports_reported']}/{len(users)}")
+        ok = all(s["seconds"] is not None for s in steps)
+        if a.out:
+            with open(a.out, "w") as f: json.dump({"nodes": a.nodes, "users": a.users, "steps": steps, **report}, f, indent=2)
+            print(f"wrote {a.out}")
+    finally:
+        for ag in agents:
+            if ag.proc and ag.proc.poll() is None: ag.stop()
+        controller.terminate(); controller.wait(10)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
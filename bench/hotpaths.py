@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Latency, subprocess count and peak Python memory of the panels' hot paths at 100 / 1k / 10k users.
+
+  python3 bench/hotpaths.py [--users 100,1000,10000] [--repeat 5] [--out hotpaths.json] [--compare old.json]
+
+Everything runs in a temp dir: synthetic users.json, the panels' state files, and fake `iptables-save`,
+`iptables-restore`, `ipset`, `conntrack`, `ss`, `systemctl`, `tc`, `ip` executables first on PATH that log
+each call and replay output sized like a node with that many users. Nothing touches /etc/zivpn or the firewall.
+Needs flask (the panels import it).
+
+ensure_expiry_and_prune no longer exists; the expiry scheduler's heap rebuild and prune_expired() are
+measured in its place.
+"""
+import argparse, contextlib, io, json, os, platform, statistics, subprocess, sys, tempfile, time, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from row_alloc import synth_users
+
+FAKE = r"""#!/bin/sh
+echo "$(basename "$0") $*" >> "$FAKE_LOG"
+name=$(basename "$0"); f="$FAKE_OUT/$name"
+case "$name" in
+  iptables-save) t=filter; while [ $# -gt 0 ]; do [ "$1" = "-t" ] && t=$2; shift; done; f="$FAKE_OUT/iptables-save.$t" ;;
+  iptables-restore) cat >/dev/null ;;
+  ipset|tc|nft) case " $* " in *" restore "*|*" -batch "*|*" -f "*) cat >/dev/null ;; esac ;;
+esac
+[ -f "$f" ] && cat "$f"
+exit 0
+"""
+FAKE_BINS = ("iptables-save", "iptables-restore", "iptables", "ipset", "conntrack", "ss", "systemctl", "tc", "ip", "hostname", "nft")
+
+def bench_users(n):
+    users = synth_users(n)
+    for i, u in enumerate(users):
+        if i % 10 == 0: u["rate_down"] = "4000"
+        if i % 20 == 0: u["quota"] = str(10 << 30)
+    return users
+
+def fake_outputs(users):
+    """{file name: content} the fake binaries replay, sized like a real node with these users."""
+    ports = [u["port"] for u in users]
+    tags = ['"user:%s"' % u["user"] for u in users]
+    mangle = ["*mangle", ":PREROUTING ACCEPT [0:0]", ":POSTROUTING ACCEPT [0:0]", ":ZIVPN-LIMIT - [0:0]",
+              ":ZIVPN-ACCT - [0:0]", ":ZIVPN-ACCT-OUT - [0:0]", ":ZIVPN-COUNT - [0:0]",
+              "[0:0] -A PREROUTING -p udp -j ZIVPN-LIMIT", "[0:0] -A PREROUTING -p udp -j ZIVPN-ACCT",
+              "[0:0] -A POSTROUTING -p udp -j ZIVPN-ACCT-OUT", "[0:0] -A PREROUTING -p udp -j ZIVPN-COUNT",
+              "[0:0] -A ZIVPN-LIMIT -p udp -m set --match-set zivpn-locked dst -m set ! --match-set zivpn-allow src,dst -j DROP"]
+    for i, (p, t) in enumerate(zip(ports, tags)):
+        mangle.append(f"[{i*3}:{i*1500}] -A ZIVPN-ACCT -p udp -m udp --dport {p} -m comment --comment {t} -j RETURN")
+        mangle.append(f"[{i*2}:{i*900}] -A ZIVPN-ACCT-OUT -p udp -m conntrack --ctorigdstport {p} --ctdir REPLY -m comment --comment {t} -j RETURN")
+        mangle.append(f"[{i*3}:{i*1500}] -A ZIVPN-COUNT -p udp -m udp --dport {p} -m comment --comment {t} -j RETURN")
+    nat = ["*nat", ":PREROUTING ACCEPT [0:0]", ":ZIVPN-DNAT - [0:0]", "[0:0] -A PREROUTING -p udp -j ZIVPN-DNAT"]
+    nat += [f"[1:60] -A ZIVPN-DNAT -p udp -m udp --dport {p} -m comment --comment {t} -j DNAT --to-destination :5667"
+            for p, t in zip(ports, tags)]
+    locked = [u for u in users if u.get("bind_ip")]
+    ipset = ["create zivpn-locked bitmap:port range 1-65535", "create zivpn-allow hash:ip,port"]
+    ipset += [f"add zivpn-locked {u['port']}" for u in locked] + [f"add zivpn-allow {u['bind_ip']},udp:{u['port']}" for u in locked]
+    ct = [f"udp      17 {100 + i % 20} src=10.1.{i // 250 % 250}.{i % 250 + 1} dst=203.0.113.1 sport={20000 + i} dport={p} "
+          f"packets=40 bytes=9000 src=203.0.113.1 dst=10.1.{i // 250 % 250}.{i % 250 + 1} sport=5667 dport={20000 + i} "
+          f"packets=35 bytes=20000 [ASSURED] mark=0 use=1" for i, p in enumerate(ports) if i % 3 == 0]
+    return {"iptables-save.mangle": "\n".join(mangle + ["COMMIT"]) + "\n",
+            "iptables-save.nat": "\n".join(nat + ["COMMIT"]) + "\n",
+            "iptables-save.filter": "*filter\n:INPUT ACCEPT [0:0]\nCOMMIT\n",
+            "ipset": "\n".join(ipset) + "\n", "conntrack": "\n".join(ct) + "\n",
+            "ss": "UNCONN 0 0 0.0.0.0:5667 0.0.0.0:*\nUNCONN 0 0 0.0.0.0:53 0.0.0.0:*\n",
+            "systemctl": "active\n", "ip": "default via 203.0.113.254 dev eth0 src 203.0.113.1\n",
+            "hostname": "203.0.113.1\n", "tc": ""}
+
+def setup_env(tmp):
+    """Fake binaries + state paths; must run before the panels are imported (their config reads the env)."""
+    bindir = os.path.join(tmp, "bin"); os.makedirs(bindir); os.makedirs(os.path.join(tmp, "out"))
+    for b in FAKE_BINS:
+        with open(os.path.join(bindir, b), "w") as f: f.write(FAKE)
+        os.chmod(os.path.join(bindir, b), 0o755)
+    os.environ.update(PATH=bindir + os.pathsep + os.environ["PATH"], FAKE_LOG=os.path.join(tmp, "calls.log"),
+                      FAKE_OUT=os.path.join(tmp, "out"), USER_STORE="json", SYNC_DEBOUNCE="0", PRESENCE="poll",
+                      WEB_WORKERS="1", FW_BACKEND="iptables")
+
+def point_at(m, d):
+    """Aim one panel module's files at the per-size data dir d and drop its in-memory caches."""
+    for k, name in (("USERS_FILE", "users.json"), ("CONFIG_FILE", "config.json"), ("TRAFFIC_FILE", "traffic.json"),
+                    ("ACCT_FILE", "traffic.ring"), ("PORTS_FILE", "ports.bin"), ("SESSIONS_FILE", "sessions.json"),
+                    ("STATE_FILE", "state.pickle")):
+        if hasattr(m, k): setattr(m, k, os.path.join(d, f"{m.__name__}-{name}" if k != "USERS_FILE" else name))
+    m._users_cache.update(sig=None, rows=[])
+    m._acct.update(mm=None, slots={}, free=[])
+    m._expiry.update(heap=[], version=None)
+    if hasattr(m, "_rows_cache"): m._rows_cache["key"] = None
+    if hasattr(m, "_presence"): m._presence.update(flows={}, ports={}, owners={}, history=None, alive=False, synced=0.0)
+
+def calls():
+    try:
+        with open(os.environ["FAKE_LOG"]) as f: return sum(1 for _ in f)
+    except OSError: return 0
+
+def measure(fn, repeat, setup=None):
+    """{"ms_median", "ms_min", "subprocesses" (per call), "peak_kib" (Python heap, tracemalloc)}"""
+    times = []; spawned = 0
+    with contextlib.redirect_stdout(io.StringIO()):   # the panels' [firewall]/[expiry] log lines
+        for _ in range(repeat):
+            if setup: setup()
+            c = calls(); t = time.perf_counter()
+            fn()
+            times.append((time.perf_counter() - t) * 1000); spawned += calls() - c
+        if setup: setup()
+        tracemalloc.start(); fn(); _, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    return {"ms_median": round(statistics.median(times), 2), "ms_min": round(min(times), 2),
+            "subprocesses": round(spawned / repeat, 1), "peak_kib": peak // 1024}
+
+def run_size(web, w2, n, repeat, tmp):
+    d = os.path.join(tmp, f"n{n}"); os.makedirs(d)
+    users = bench_users(n)
+    raw = json.dumps(users)
+    def reset_users():
+        with open(os.path.join(d, "users.json"), "w") as f: f.write(raw)
+    reset_users()
+    for name, text in fake_outputs(users).items():
+        with open(os.path.join(os.environ["FAKE_OUT"], name), "w") as f: f.write(text)
+    res = {"web.py": {}, "web2day.py": {}}
+    for m, out in ((web, res["web.py"]), (w2, res["web2day.py"])):
+        point_at(m, d)
+        with contextlib.redirect_stdout(io.StringIO()):
+            snap = m.collect_state()           # warm: ring file, port bitmap, first reconcile
+        m.get_state = lambda wait=5.0, s=snap: s
+        client = m.app.test_client()
+        loaded = m.load_users()
+        out["collect_state"] = measure(m.collect_state, repeat)
+        if m is web:
+            out["apply_device_limits"] = measure(lambda: web.apply_device_limits(loaded), repeat)
+            out["acct_counters"] = measure(lambda: web.acct_counters(loaded), repeat)
+        else:
+            out["reconcile_rules"] = measure(lambda: w2.reconcile_rules(loaded), repeat)
+            out["mangle_counters"] = measure(w2.mangle_counters, repeat)
+        def cold_page():
+            if hasattr(m, "_rows_cache"): m._rows_cache["key"] = None
+            client.get("/").get_data()
+        out["build_view_cold"] = measure(cold_page, repeat)
+        out["build_view_warm"] = measure(lambda: client.get("/").get_data(), repeat)
+        out["pick_free_port"] = measure(m.pick_free_port, repeat)
+        out["expiry_heap_rebuild"] = measure(m._expiry_heap, repeat, setup=lambda: m._expiry.update(version=None))
+        out["prune_expired"] = measure(m.prune_expired, repeat, setup=reset_users)
+        reset_users()
+    return res
+
+def compare(old, new):
+    for panel, sizes in new["results"].items():
+        for n, ops in sizes.items():
+            for op, r in ops.items():
+                o = old.get("results", {}).get(panel, {}).get(n, {}).get(op)
+                if not o: continue
+                d = (r["ms_median"] - o["ms_median"]) / o["ms_median"] * 100 if o["ms_median"] else 0
+                print(f"{panel:11} {n:>6} {op:22} {o['ms_median']:>9.2f} -> {r['ms_median']:>9.2f} ms ({d:+.0f}%)"
+                      f"   procs {o['subprocesses']:g} -> {r['subprocesses']:g}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", default="100,1000,10000")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--out", default="hotpaths.json")
+    ap.add_argument("--compare", help="earlier --out file to diff against")
+    a = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="zivpn-bench-")
+    setup_env(tmp)
+    import web, web2day
+    web.start_collector = web2day.start_collector = lambda: None   # measured by hand, no background threads
+    web.request_refresh = web2day.request_refresh = lambda wait=0: None
+
+    rev = subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    doc = {"meta": {"at": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": rev, "python": platform.python_version(),
+                    "repeat": a.repeat}, "results": {"web.py": {}, "web2day.py": {}}}
+    for n in (int(x) for x in a.users.split(",")):
+        for panel, ops in run_size(web, web2day, n, a.repeat, tmp).items():
+            doc["results"][panel][str(n)] = ops
+            for op, r in ops.items():
+                print(f"{panel:11} {n:>6} {op:22} {r['ms_median']:>9.2f} ms  {r['subprocesses']:>5g} procs  {r['peak_kib']:>7} KiB",
+                      flush=True)
+    with open(a.out, "w") as f: json.dump(doc, f, indent=2)
+    print(f"wrote {a.out}")
+    if a.compare:
+        with open(a.compare) as f: compare(json.load(f), doc)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Concurrent end-to-end load against the real WSGI apps: web.py, web2day.py and the api.sh key service.
+
+  python3 bench/load.py [--target web,web2day,api] [--clients 20] [--seconds 10] [--users 1000]
+                        [--mix-web read=70,add=20,lock=10] [--mix-web2day read=80,add=20]
+                        [--mix-api health=20,consume=80] [--keys 200] [--workers 1] [--out load.json]
+
+Each app runs as its own HTTP server process (the panels through their serve(), so --workers > 1 exercises
+the gunicorn mode when it is installed), on a temp data dir and the fake system binaries from hotpaths.py,
+with the background collector live. N client threads keep one keep-alive connection each and pick operations
+by weight until the time is up. Reported per operation: count, errors, p50/p95/p99 ms; per target: requests/s
+and lost updates, i.e. writes the server acknowledged that are missing from the store afterwards (added users
+gone, locks without a bound IP) or, for the key service, keys it reported consumed more than once.
+Needs flask (the apps import it).
+"""
+import argparse, http.client, json, os, random, re, socket, subprocess, sys, tempfile, threading, time, urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from hotpaths import bench_users, fake_outputs, point_at, setup_env
+
+MIXES = {"web": "read=70,add=20,lock=10", "web2day": "read=80,add=20", "api": "health=20,consume=80"}
+ADMIN_SECRET = "load-secret"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def parse_mix(text):
+    mix = {k: float(v) for k, v in (kv.split("=") for kv in text.split(",") if kv)}
+    if not mix or sum(mix.values()) <= 0: sys.exit(f"bad mix: {text!r}")
+    return mix
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(len(xs) * p / 100))], 2) if xs else None
+
+# ---------- servers ----------
+def serve_panel(name, d):
+    """Child process entry (--_serve): one panel on data dir d, listening on WEB_PORT from the env."""
+    m = __import__(name)
+    point_at(m, d)
+    m.serve()
+
+def api_app(tmp):
+    """Write the key service's app.py out of the api.sh heredoc, as `api.sh --install` would."""
+    with open(os.path.join(ROOT, "api.sh")) as f: src = f.read()
+    m = re.search(r"cat >\"\$APPDIR/app.py\" <<'PY'\n(.*?)\nPY\n", src, re.S)
+    if not m: sys.exit("app.py heredoc not found in api.sh")
+    d = os.path.join(tmp, "api"); os.makedirs(d, exist_ok=True)
+    path = os.path.join(d, "app.py")
+    with open(path, "w") as f: f.write(m.group(1) + "\n")
+    return path
+
+def start(target, tmp, port, workers):
+    log = open(os.path.join(tmp, f"{target}.log"), "w")
+    env = dict(os.environ, WEB_PORT=str(port), WEB_WORKERS=str(workers), WEB_ADMIN_USER="", WEB_ADMIN_PASSWORD="")
+    if target == "api":
+        d = os.path.join(tmp, "api")
+        env.update(BIND="127.0.0.1", PORT=str(port), DB_PATH=os.path.join(d, "keys.db"), ADMIN_SECRET=ADMIN_SECRET)
+        argv = [sys.executable, api_app(tmp)]
+    else:
+        argv = [sys.executable, os.path.abspath(__file__), "--_serve", target, os.path.join(tmp, target)]
+    proc = subprocess.Popen(argv, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=tmp)
+    probe = "/api/health" if target == "api" else "/favicon.ico"
+    for _ in range(200):
+        if proc.poll() is not None: sys.exit(f"{target} server exited, see {log.name}")
+        try:
+            c = http.client.HTTPConnection("127.0.0.1", port, timeout=2); c.request("GET", probe); c.getresponse().read()
+            return proc
+        except OSError: time.sleep(0.05)
+    proc.kill(); sys.exit(f"{target} server did not come up, see {log.name}")
+
+# ---------- clients ----------
+class Client:
+    def __init__(self, port): self.port = port; self.conn = None
+
+    def request(self, method, path, form=None, body=None, headers=None):
+        """-> (status, body bytes); one reconnect if the keep-alive connection was dropped."""
+        headers = dict(headers or {})
+        if form is not None:
+            body = urllib.parse.urlencode(form); headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in (0, 1):
+            if self.conn is None: self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                r = self.conn.getresponse(); data = r.read()
+                if r.getheader("Connection", "").lower() == "close": self.close()
+                return r.status, data
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt: raise
+
+    def close(self):
+        if self.conn: self.conn.close(); self.conn = None
+
+class Run:
+    """Shared counters for one target; ops record (latency, ok) and what they expect to find afterwards."""
+    def __init__(self):
+        self.lock = threading.Lock(); self.lat = {}; self.err = {}; self.seq = 0
+        self.added = set(); self.locked = set(); self.consumed = {}
+
+    def next_id(self):
+        with self.lock: self.seq += 1; return self.seq
+
+    def record(self, op, ms, ok):
+        with self.lock:
+            self.lat.setdefault(op, []).append(ms)
+            if not ok: self.err[op] = self.err.get(op, 0) + 1
+
+def panel_ops(target, run, lockable):
+    tag = os.getpid()
+    def read(c):
+        s, _ = c.request("GET", "/"); return s == 200
+    def add(c):
+        user = f"load{tag}-{run.next_id()}"
+        form = {"user": user, "password": "pw"}
+        if target == "web": form["expires"] = "30"
+        s, _ = c.request("POST", "/add", form=form)
+        if s == 302:
+            with run.lock: run.added.add(user)
+        return s == 302
+    def lock(c):
+        user = random.choice(lockable)
+        s, _ = c.request("POST", "/lock", form={"op": "lock", "user": user})
+        if s == 302:
+            with run.lock: run.locked.add(user)
+        return s == 302
+    return {"read": read, "add": add, "lock": lock}
+
+def api_ops(run, keys):
+    def health(c):
+        s, _ = c.request("GET", "/api/health"); return s == 200
+    def consume(c):
+        key = random.choice(keys)
+        s, data = c.request("POST", "/api/consume", body=json.dumps({"key": key}), headers={"Content-Type": "application/json"})
+        if s == 200:
+            with run.lock: run.consumed[key] = run.consumed.get(key, 0) + 1
+        return s in (200, 409)   # 409 already_used is the correct answer for a spent key
+    return {"health": health, "consume": consume}
+
+def drive(port, ops, mix, clients, seconds, run):
+    names = [n for n in mix if n in ops]
+    if not names: sys.exit(f"mix has none of {sorted(ops)}")
+    weights = [mix[n] for n in names]
+    stop = time.monotonic() + seconds
+    def worker():
+        c = Client(port)
+        while time.monotonic() < stop:
+            op = random.choices(names, weights)[0]
+            t = time.perf_counter()
+            try: ok = ops[op](c)
+            except Exception: ok = False
+            run.record(op, (time.perf_counter() - t) * 1000, ok)
+        c.close()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return time.perf_counter() - t0
+
+# ---------- targets ----------
+def load_target(target, a, tmp):
+    port = free_port(); run = Run()
+    mix = parse_mix(getattr(a, "mix_" + target) or MIXES[target])
+    if target == "api":
+        proc = start(target, tmp, port, a.workers)
+        c = Client(port); keys = []
+        for _ in range(a.keys):
+            s, data = c.request("POST", "/api/generate", body=json.dumps({"expires_in_hours": 24}),
+                                headers={"Content-Type": "application/json", "X-Admin-Secret": ADMIN_SECRET})
+            if s == 200: keys.append(json.loads(data)["key"])
+        c.close()
+        if not keys: sys.exit("api: could not generate keys")
+        ops = api_ops(run, keys)
+    else:
+        d = os.path.join(tmp, target); os.makedirs(d)
+        users = bench_users(a.users)
+        for u in users: u["expires"] = "2030-01-01"   # nothing expires mid-run
+        with open(os.path.join(d, "users.json"), "w") as f: json.dump(users, f)
+        for name, text in fake_outputs(users).items():
+            with open(os.path.join(os.environ["FAKE_OUT"], name), "w") as f: f.write(text)
+        # /lock binds the source IP conntrack shows for the port; fake_outputs() has flows for every 3rd user
+        lockable = [u["user"] for i, u in enumerate(users) if i % 3 == 0]
+        proc = start(target, tmp, port, a.workers)
+        ops = panel_ops(target, run, lockable)
+    try:
+        elapsed = drive(port, ops, mix, a.clients, a.seconds, run)
+    finally:
+        proc.terminate()
+        try: proc.wait(10)
+        except subprocess.TimeoutExpired: proc.kill()
+    return report(target, run, elapsed, tmp)
+
+def report(target, run, elapsed, tmp):
+    total = sum(len(v) for v in run.lat.values())
+    res = {"requests": total, "seconds": round(elapsed, 2), "rps": round(total / elapsed, 1) if elapsed else 0,
+           "errors": sum(run.err.values()), "ops": {}}
+    for op, xs in sorted(run.lat.items()):
+        res["ops"][op] = {"count": len(xs), "errors": run.err.get(op, 0), "p50": pct(xs, 50), "p95": pct(xs, 95), "p99": pct(xs, 99)}
+    if target == "api":
+        import sqlite3
+        db = sqlite3.connect(os.path.join(tmp, "api", "keys.db"))
+        used = {k for (k,) in db.execute("SELECT id FROM keys WHERE used_at IS NOT NULL")}
+        db.close()
+        res["lost_updates"] = {"consumed_twice": sum(1 for n in run.consumed.values() if n > 1),
+                               "consumed_not_stored": len(set(run.consumed) - used)}
+    else:
+        with open(os.path.join(tmp, target, "users.json")) as f: final = {u["user"]: u for u in json.load(f)}
+        res["lost_updates"] = {"added_missing": len(run.added - set(final)),
+                               "lock_missing": sum(1 for u in run.locked if not final.get(u, {}).get("bind_ip"))}
+    return res
+
+def main():
+    if sys.argv[1:2] == ["--_serve"]:
+        return serve_panel(sys.argv[2], sys.argv[3])
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--target", default="web,web2day,api")
+    ap.add_argument("--clients", type=int, default=20)
+    ap.add_argument("--seconds", type=float, default=10)
+    ap.add_argument("--users", type=int, default=1000, help="users in the panels' store at start")
+    ap.add_argument("--keys", type=int, default=200, help="keys generated for the key service before the run")
+    ap.add_argument("--workers", type=int, default=1, help="WEB_WORKERS for the panels")
+    for t in MIXES: ap.add_argument(f"--mix-{t}", help=f"op=weight,... (default {MIXES[t]})")
+    ap.add_argument("--out", help="write the results as JSON")
+    a = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="zivpn-load-")
+    setup_env(tmp)
+    os.environ["PYTHONPATH"] = os.pathsep.join([ROOT, os.path.join(ROOT, "bench"), os.environ.get("PYTHONPATH", "")])
+    doc = {"meta": {"at": time.strftime("%Y-%m-%dT%H:%M:%S"), "clients": a.clients, "seconds": a.seconds,
+                    "users": a.users, "workers": a.workers}, "results": {}}
+    for target in a.target.split(","):
+        r = doc["results"][target] = load_target(target, a, tmp)
+        print(f"{target}: {r['requests']} requests in {r['seconds']} s = {r['rps']} req/s, {r['errors']} errors, "
+              f"lost updates {r['lost_updates']}", flush=True)
+        for op, o in r["ops"].items():
+            print(f"  {op:8} {o['count']:>7}  err {o['errors']:>5}  p50 {o['p50']:>8} ms  p95 {o['p95']:>8} ms  p99 {o['p99']:>8} ms")
+    if a.out:
+        with open(a.out, "w") as f: json.dump(doc, f, indent=2)
+        print(f"wrote {a.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Allocations per dashboard request at N users: old per-row type()/dict build vs UserRow (__slots__).
+
+  python3 bench/row_alloc.py [--users 10000] [--json]
+
+Runs against web.py / web2day.py from the repo root with a synthetic users.json in a temp dir.
+Needs flask (the panels import it); nothing touches /etc/zivpn or the firewall.
+"""
+import argparse, json, os, sys, tempfile, time, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def synth_users(n):
+    return [{"user": f"user{i:05d}", "password": f"pw{i}", "created_on": "2026-01-01",
+             "expires": "2020-01-01" if i % 7 == 0 else "2030-01-01", "port": str(6000 + i % 14000),
+             "bind_ip": "10.0.0.1" if i % 5 == 0 else ""} for i in range(n)]
+
+def measure(fn, repeat=3):
+    """(live blocks held by the result, peak KiB, ms) of the fastest of `repeat` runs."""
+    best = None
+    for _ in range(repeat):
+        tracemalloc.start(); t = time.perf_counter()
+        keep = fn()
+        ms = (time.perf_counter() - t) * 1000
+        snap = tracemalloc.take_snapshot(); _, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+        del keep
+        blocks = sum(s.count for s in snap.statistics("filename"))
+        r = (blocks, peak // 1024, round(ms, 1))
+        best = r if best is None or r[2] < best[2] else best
+    return best
+
+# --- the pre-UserRow code paths, kept here only as the "before" baseline ---
+def old_web_rows(web, users, st, traffic, today):
+    out = []
+    for u in users:
+        out.append(type("U", (), {"user": u.get("user",""), "password": u.get("password",""),
+                                  "expires": u.get("expires",""), "port": u.get("port",""),
+                                  "bind_ip": u.get("bind_ip",""),
+                                  "status": web.status_for_user(u, st["listen_port"], st["conntrack"]),
+                                  "traffic": web.bytes_to_human(traffic.get(u.get("user"), 0))}))
+    out.sort(key=lambda x: (x.user or "").lower())
+    return out
+
+def old_2day_rows(w2, users, ctr):
+    out = []
+    for u in users:
+        st = w2.status_for_user_by_counters(u.get("port"), ctr)
+        out.append({"user": u.get("user",""), "password": u.get("password",""), "expires": u.get("expires",""),
+                    "port": u.get("port",""), "bind_ip": u.get("bind_ip",""), "status": st,
+                    "traffic": w2.bytes_to_human(ctr.get(str(u.get("port","")), (0,0))[1])})
+    out.sort(key=lambda x: (x["status"]!="Online", (x["user"] or "").lower()))
+    return out
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=10000)
+    ap.add_argument("--json", action="store_true")
+    a = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="zivpn-bench-")
+    users = synth_users(a.users)
+    with open(os.path.join(tmp, "users.json"), "w") as f: json.dump(users, f)
+    import web, web2day
+    for m in (web, web2day):
+        m.USERS_FILE = os.path.join(tmp, "users.json")
+    web.TRAFFIC_FILE = os.path.join(tmp, "traffic.json")
+    ct = {str(6000 + i): {"src": ["10.0.0.1"], "packets": 1, "bytes": 1, "age": 1} for i in range(0, a.users, 3)}
+    st = {"version": 1, "at": time.time(), "conntrack": ct, "listen_port": "5667", "online_sig": 1, "changed_at": 0}
+    ctr = {p: (1, 123456) for p in ct}
+    web.get_state = lambda wait=5.0: st
+    today = time.strftime("%Y-%m-%d")
+    loaded = web.load_users()
+
+    res = {"users": a.users}
+    res["web_old_type_per_row"] = measure(lambda: old_web_rows(web, loaded, st, {}, today))
+    def new_cold():
+        web._rows_cache["key"] = None
+        return web.user_rows(st)
+    res["web_userrow_cold"] = measure(new_cold)
+    res["web_userrow_cached"] = measure(lambda: web.user_rows(st))
+    res["web2day_old_dicts"] = measure(lambda: old_2day_rows(web2day, loaded, ctr))
+    res["web2day_userrow"] = measure(lambda: sorted((web2day.UserRow(u, web2day.status_for_user_by_counters(u.get("port"), ctr),
+                                                      ctr.get(str(u.get("port","")), (0,0))[1]) for u in loaded),
+                                                     key=lambda r: r.sort_key))
+    for mode, path in (("web_dashboard_request", "/"),):
+        client = web.app.test_client()
+        web._rows_cache["key"] = None; client.get(path).get_data()  # warm the row cache + template
+        res[mode] = measure(lambda: client.get(path).get_data())
+
+    if a.json:
+        print(json.dumps({k: (dict(zip(("blocks", "peak_kib", "ms"), v)) if isinstance(v, tuple) else v)
+                          for k, v in res.items()}, indent=2))
+        return
+    print(f"{a.users} users          blocks   peak KiB       ms")
+    for k, v in res.items():
+        if isinstance(v, tuple): print(f"{k:24} {v[0]:>8} {v[1]:>10} {v[2]:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# /etc/zivpn/fleet.py — ZIVPN fleet controller: one registry of users and node assignments for many web.py nodes
+# - Admin API (Authorization: Bearer $FLEET_SECRET): register nodes, upsert/move/delete users, read node status + traffic
+# - Every user change is appended to a per-node change log; agents pull "changes since version N" (long-poll), not dumps
+# - A node that is new, wiped or too far behind (log pruned past its version) gets one full page instead
+# - Agents (web.py with FLEET_URL + FLEET_TOKEN) apply pages through their own store/firewall/config paths and
+#   report applied version, status and traffic in batches; reported log entries are pruned
+#
+#   FLEET_SECRET=... python3 fleet.py                          # controller on :8090 (FLEET_PORT), registry in FLEET_DB
+#   curl -H "Authorization: Bearer $FLEET_SECRET" -d '{"name":"sg1"}' -H 'Content-Type: application/json' :8090/api/nodes
+#     -> {"token": ...}; on that node: FLEET_URL=http://controller:8090 FLEET_TOKEN=... in /etc/zivpn/web.env
+
+from flask import Flask, jsonify, request, make_response
+import os, json, re, sqlite3, threading, time, secrets, hmac, sys
+
+FLEET_DB = os.environ.get("FLEET_DB", "/var/lib/zivpn/fleet.db")
+FLEET_SECRET = os.environ.get("FLEET_SECRET", "").strip()
+FLEET_PORT = int(os.environ.get("FLEET_PORT", "8090"))
+FLEET_PAGE = int(os.environ.get("FLEET_PAGE", "1000")) # change-log entries per agent pull
+FLEET_WAIT_MAX = 30 # longest long-poll an agent may ask for (seconds)
+USER_FIELDS = ("password","expires","port","bind_ip","rate_down","rate_up","quota") # what agents receive (web.py BATCH_FIELDS)
+NAME_RE = re.compile(r"[\w.@-]{1,64}")
+
+app = Flask(__name__)
+_db_local = threading.local()
+_changed = threading.Condition() # notified after every committed write, wakes long-polling agents
+_generation = [0] # bumped under _changed with each notify, so a write between query and wait is not missed
+
+def _db():
+  """Per-thread SQLite connection (WAL); first open creates the schema."""
+  con=getattr(_db_local, "con", None)
+  if con is None:
+    os.makedirs(os.path.dirname(FLEET_DB) or ".", exist_ok=True)
+    con=sqlite3.connect(FLEET_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    con.row_factory=sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL"); con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript("""
+      CREATE TABLE IF NOT EXISTS nodes(
+        name TEXT PRIMARY KEY, token TEXT NOT NULL UNIQUE, created_at REAL NOT NULL,
+        applied INTEGER NOT NULL DEFAULT 0,  -- highest change version the agent reported applied
+        floor INTEGER NOT NULL DEFAULT 0,    -- log entries <= floor are pruned; an agent behind it gets a full page
+        last_seen REAL NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT '{}');
+      CREATE TABLE IF NOT EXISTS users(
+        user TEXT NOT NULL PRIMARY KEY COLLATE NOCASE, node TEXT NOT NULL, rec TEXT NOT NULL, version INTEGER NOT NULL);
+      CREATE INDEX IF NOT EXISTS users_node ON users(node);
+      CREATE TABLE IF NOT EXISTS changes(
+        version INTEGER PRIMARY KEY AUTOINCREMENT, node TEXT NOT NULL, user TEXT NOT NULL, op TEXT NOT NULL, rec TEXT);
+      CREATE INDEX IF NOT EXISTS changes_node ON changes(node, version);
+      CREATE TABLE IF NOT EXISTS traffic(
+        node TEXT NOT NULL, user TEXT NOT NULL COLLATE NOCASE, bytes INTEGER NOT NULL, at REAL NOT NULL, PRIMARY KEY(node, user));
+    """)
+    _db_local.con=con
+  return con
+
+def _head(con):
+  r=con.execute("SELECT seq FROM sqlite_sequence WHERE name='changes'").fetchone()
+  return r[0] if r else 0
+
+def _write(fn):
+  """Run fn(con) in one IMMEDIATE transaction, then wake long-polling agents."""
+  con=_db(); con.execute("BEGIN IMMEDIATE")
+  try: res=fn(con)
+  except BaseException: con.execute("ROLLBACK"); raise
+  con.execute("COMMIT")
+  with _changed: _generation[0]+=1; _changed.notify_all()
+  return res
+
+def _log(con, node, user, op, rec=None):
+  return con.execute("INSERT INTO changes(node,user,op,rec) VALUES(?,?,?,?)",
+                     (node, user, op, json.dumps(rec, ensure_ascii=False) if rec is not None else None)).lastrowid
+
+def _bearer(): return request.headers.get("Authorization","").removeprefix("Bearer ").strip()
+
+def admin_ok(): return bool(FLEET_SECRET) and hmac.compare_digest(_bearer(), FLEET_SECRET)
+
+def agent_node():
+  """The nodes row whose token was presented, or None."""
+  tok=_bearer()
+  return _db().execute("SELECT * FROM nodes WHERE token=?", (tok,)).fetchone() if tok else None
+
+def _denied(): return make_response(jsonify({"ok":False, "err":"unauthorized"}), 401)
+
+def _rows(req):
+  data=req.get_json(silent=True)
+  if isinstance(data, dict): data=data.get("users", [data] if "user" in data else [])
+  if not isinstance(data, list) or not all(isinstance(r, dict) for r in data): raise ValueError("expected a JSON list of users")
+  return data
+
+# ---------- Admin API ----------
+@app.route("/api/nodes", methods=["POST"])
+def add_node():
+  """{"name"} -> the node's agent token; {"name", "rotate": true} issues a new one."""
+  if not admin_ok(): return _denied()
+  d=request.get_json(silent=True) or {}
+  name=str(d.get("name") or "").strip()
+  if not NAME_RE.fullmatch(name): return jsonify({"ok":False, "err":"name: letters, digits, . _ @ -"}), 400
+  tok=secrets.token_urlsafe(24)
+  def put(con):
+    if con.execute("SELECT 1 FROM nodes WHERE name=?", (name,)).fetchone():
+      if not d.get("rotate"): return False
+      con.execute("UPDATE nodes SET token=? WHERE name=?", (tok, name))
+    else: con.execute("INSERT INTO nodes(name,token,created_at) VALUES(?,?,?)", (name, tok, time.time()))
+    return True
+  if not _write(put): return jsonify({"ok":False, "err":"node exists (send rotate: true for a new token)"}), 409
+  return jsonify({"ok":True, "name":name, "token":tok})
+
+@app.route("/api/nodes", methods=["GET"])
+def list_nodes():
+  if not admin_ok(): return _denied()
+  con=_db(); head=_head(con); now=time.time()
+  users=dict(con.execute("SELECT node, COUNT(*) FROM users GROUP BY node").fetchall())
+  pending={r[0]:r[1] for r in con.execute("SELECT node, COUNT(*) FROM changes GROUP BY node")}
+  return jsonify({"ok":True, "head":head, "nodes":[
+    {"name":n["name"], "users":users.get(n["name"],0), "applied":n["applied"], "pending":pending.get(n["name"],0),
+     "last_seen":round(n["last_seen"]) or None, "age":round(now-n["last_seen"]) if n["last_seen"] else None,
+     "status":json.loads(n["status"] or "{}")} for n in con.execute("SELECT * FROM nodes ORDER BY name")]})
+
+@app.route("/api/nodes/<name>", methods=["DELETE"])
+def delete_node(name):
+  if not admin_ok(): return _denied()
+  def rm(con):
+    if con.execute("SELECT 1 FROM users WHERE node=? LIMIT 1", (name,)).fetchone(): return "has users"
+    if not con.execute("DELETE FROM nodes WHERE name=?", (name,)).rowcount: return "no such node"
+    con.execute("DELETE FROM changes WHERE node=?", (name,)); con.execute("DELETE FROM traffic WHERE node=?", (name,))
+    return ""
+  err=_write(rm)
+  return jsonify({"ok":not err, **({"err":err} if err else {})}), (409 if err else 200)
+
+@app.route("/api/users", methods=["GET"])
+def list_users():
+  """?node= filters; traffic is the node's last reported total for the user."""
+  if not admin_ok(): return _denied()
+  node=request.args.get("node")
+  q="SELECT u.user, u.node, u.rec, u.version, t.bytes FROM users u LEFT JOIN traffic t ON t.node=u.node AND t.user=u.user"
+  rows=_db().execute(q+(" WHERE u.node=?" if node else "")+" ORDER BY u.user", (node,) if node else ())
+  return jsonify({"ok":True, "users":[{"user":r["user"], "node":r["node"], **json.loads(r["rec"]),
+                                       "version":r["version"], "traffic_bytes":r["bytes"] or 0} for r in rows]})
+
+@app.route("/api/users", methods=["POST"])
+def upsert_users():
+  """[{user, node, password, expires, port, bind_ip, rate_down, rate_up, quota}, ...]: create, edit or move users.
+  Omitted fields keep their value; a new node moves the user (delete on the old node, create on the new one).
+  Valid rows are written together, bad rows are reported."""
+  if not admin_ok(): return _denied()
+  try: rows=_rows(request)
+  except ValueError as e: return jsonify({"ok":False, "err":str(e)}), 400
+  def apply(con):
+    nodes={r[0] for r in con.execute("SELECT name FROM nodes")}
+    cur={r["user"].lower():r for r in con.execute("SELECT * FROM users")}
+    ports={(r["node"], json.loads(r["rec"]).get("port","")):k for k,r in cur.items()}
+    results=[]
+    for i,row in enumerate(rows, 1):
+      name=str(row.get("user") or "").strip(); key=name.lower(); old=cur.get(key)
+      res={"row":i, "user":name, "ok":False}; results.append(res)
+      node=str(row.get("node") or (old["node"] if old else "")).strip()
+      rec={**(json.loads(old["rec"]) if old else {}), **{k:str(row[k]).strip() for k in USER_FIELDS if row.get(k) is not None}}
+      if not NAME_RE.fullmatch(name): res["err"]="bad user name"; continue
+      if node not in nodes: res["err"]=f"unknown node {node!r}"; continue
+      if not rec.get("password"): res["err"]="password required"; continue
+      moved=old is not None and old["node"]!=node
+      if moved and "port" not in row: rec["port"]="" # the old node's port means nothing on the new one
+      if rec.get("port") and ports.get((node, rec["port"]), key)!=key: res["err"]=f"port {rec['port']} in use on {node}"; continue
+      if old: ports.pop((old["node"], json.loads(old["rec"]).get("port","")), None)
+      if rec.get("port"): ports[(node, rec["port"])]=key
+      user=old["user"] if old else name
+      if moved: _log(con, old["node"], user, "delete")
+      v=_log(con, node, user, "upsert", {"user":user, **rec})
+      con.execute("INSERT INTO users(user,node,rec,version) VALUES(?,?,?,?) ON CONFLICT(user) DO UPDATE SET node=excluded.node, "
+                  "rec=excluded.rec, version=excluded.version", (user, node, json.dumps(rec, ensure_ascii=False), v))
+      cur[key]=con.execute("SELECT * FROM users WHERE user=?", (user,)).fetchone()
+      res.update(ok=True, action="moved" if moved else "updated" if old else "created", node=node, version=v)
+    return results
+  results=_write(apply)
+  return jsonify({"ok":all(r["ok"] for r in results), "results":results, "head":_head(_db())})
+
+@app.route("/api/users/<user>", methods=["DELETE"])
+def delete_user(user):
+  if not admin_ok(): return _denied()
+  def rm(con):
+    r=con.execute("SELECT user, node FROM users WHERE user=?", (user,)).fetchone()
+    if not r: return None
+    con.execute("DELETE FROM users WHERE user=?", (r["user"],)); con.execute("DELETE FROM traffic WHERE user=?", (r["user"],))
+    return _log(con, r["node"], r["user"], "delete")
+  v=_write(rm)
+  if v is None: return jsonify({"ok":False, "err":"no such user"}), 404
+  return jsonify({"ok":True, "version":v})
+
+# ---------- Agent API ----------
+@app.route("/agent/v1/changes", methods=["GET"])
+def agent_changes():
+  """?since=N[&wait=S]: this node's changes after version N, oldest first, at most FLEET_PAGE per call.
+  -> {"version": resume from here, "more", "full", "changes": [{"op": "upsert"|"delete", "user", "rec"}]}
+  since=-1 (never synced), a since older than the pruned log, or one past the head (a controller restored from an older
+  backup) returns every user assigned to the node with full=true (the agent then drops fleet users the page doesn't list). Blocks up to wait seconds while nothing is pending."""
+  node=agent_node()
+  if not node: return _denied()
+  try: since=int(request.args.get("since") or -1); wait=min(max(float(request.args.get("wait") or 0), 0), FLEET_WAIT_MAX)
+  except ValueError: return jsonify({"ok":False, "err":"since/wait must be numbers"}), 400
+  con=_db(); name=node["name"]
+  con.execute("UPDATE nodes SET last_seen=? WHERE name=?", (time.time(), name))
+  if since<0 or since<node["floor"] or since>_head(con):
+    con.execute("BEGIN") # users and head from one snapshot
+    try:
+      head=_head(con)
+      users=[{"op":"upsert", "user":r["user"], "rec":{"user":r["user"], **json.loads(r["rec"])}}
+             for r in con.execute("SELECT user, rec FROM users WHERE node=? ORDER BY user", (name,))]
+    finally: con.execute("COMMIT")
+    return jsonify({"ok":True, "version":head, "full":True, "more":False, "changes":users})
+  deadline=time.monotonic()+wait
+  while True:
+    gen=_generation[0]
+    con.execute("BEGIN")
+    try:
+      head=_head(con)
+      rows=con.execute("SELECT version, user, op, rec FROM changes WHERE node=? AND version>? ORDER BY version LIMIT ?",
+                       (name, since, FLEET_PAGE+1)).fetchall()
+    finally: con.execute("COMMIT")
+    left=deadline-time.monotonic()
+    if rows or left<=0: break
+    with _changed:
+      if _generation[0]==gen: _changed.wait(left)
+  more=len(rows)>FLEET_PAGE; rows=rows[:FLEET_PAGE]
+  return jsonify({"ok":True, "version":rows[-1]["version"] if more else max(head, since), "full":False, "more":more,
+                  "changes":[{"op":r["op"], "user":r["user"], "rec":json.loads(r["rec"]) if r["rec"] else None} for r in rows]})
+
+@app.route("/agent/v1/report", methods=["POST"])
+def agent_report():
+  """{"applied": N, "status": {...}, "traffic": {user: total bytes}, "ports": {user: port}, "errors": [...]}
+  traffic/ports carry only what changed since the agent's last report. Log entries <= applied are pruned."""
+  node=agent_node()
+  if not node: return _denied()
+  d=request.get_json(silent=True) or {}
+  try: applied=int(d.get("applied") or 0)
+  except ValueError: return jsonify({"ok":False, "err":"applied must be a number"}), 400
+  name=node["name"]; now=time.time()
+  def put(con):
+    if con.execute("UPDATE nodes SET applied=?, floor=MAX(floor, ?) WHERE name=? AND applied<?", (applied, applied, name, applied)).rowcount:
+      con.execute("DELETE FROM changes WHERE node=? AND version<=?", (name, applied))
+    con.execute("UPDATE nodes SET last_seen=?, status=? WHERE name=?",
+                (now, json.dumps({**(d.get("status") or {}), "errors":(d.get("errors") or [])[:50]}), name))
+    con.executemany("INSERT INTO traffic(node,user,bytes,at) VALUES(?,?,?,?) ON CONFLICT(node,user) DO UPDATE SET bytes=excluded.bytes, at=excluded.at",
+                    [(name, u, int(b), now) for u,b in (d.get("traffic") or {}).items()])
+    for u,p in (d.get("ports") or {}).items(): # ports the node picked itself; stored without a change entry (the node has them)
+      r=con.execute("SELECT rec FROM users WHERE user=? AND node=?", (u, name)).fetchone()
+      if r and not json.loads(r["rec"]).get("port"):
+        con.execute("UPDATE users SET rec=? WHERE user=? AND node=?", (json.dumps({**json.loads(r["rec"]), "port":str(p)}), u, name))
+  _write(put)
+  return jsonify({"ok":True})
+
+@app.route("/api/health", methods=["GET"])
+def health(): return jsonify({"ok":True, "head":_head(_db())})
+
+if __name__ == "__main__":
+  if not FLEET_SECRET: sys.exit("set FLEET_SECRET (admin bearer token)")
+  app.run(host=os.environ.get("FLEET_BIND", "0.0.0.0"), port=FLEET_PORT, threaded=True)
@@ -79,7 +79,8 @@ apt_guard_end(){
 say "${Y}📦 Packages တင်နေ...${Z}"
 apt_guard_start
 apt-get update -y -o APT::Update::Post-Invoke::= >/dev/null
-apt-get install -y curl ufw jq python3 python3-flask python3-apt iproute2 conntrack ca-certificates openssl >/dev/null || true
+apt-get install -y curl ufw jq python3 python3-flask python3-apt iproute2 conntrack ipset ca-certificates openssl >/dev/null || true
+apt-get install -y python3-gunicorn >/dev/null 2>&1 || true   # optional: WEB_WORKERS>1 serving mode
 apt_guard_end
 
 # stop old services to avoid text busy
@@ -199,6 +200,10 @@ After=network.target
 [Service]
 Type=simple
 User=root
+# WEB_WORKERS=4 / WEB_THREADS=8 in web.env -> gunicorn workers (one collects, the rest mirror its state)
+# SLOW_REQUEST_MS=1000 logs slower requests with a breakdown; PROFILE_REQUESTS=1 lets /?profile=1 sample cProfile (see /debug)
+# METRICS_TOKEN=... -> /metrics for Prometheus (Authorization: Bearer ...); METRICS_USER_LIMIT=500 caps per-user series
+# FLEET_URL=http://<controller>:8090 FLEET_TOKEN=<node token> -> users come from a fleet.py controller (see fleet.py)
 EnvironmentFile=-/etc/zivpn/web.env
 ExecStart=/usr/bin/python3 /etc/zivpn/web.py
 Restart=always
@@ -1,12 +1,18 @@
-from flask import Flask, jsonify, render_template_string, request, redirect, url_for, session, make_response
-import json, subprocess, os, tempfile, hmac, re
+from flask import Flask, Response, jsonify, request, redirect, url_for, session, make_response, stream_with_context
+import json, subprocess, os, tempfile, hmac, re, threading, time, shutil, sqlite3, sys, fcntl, csv, hashlib, base64, bisect, heapq, zlib, itertools, collections, struct, mmap, pickle, cProfile, pstats, io, urllib.request
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 USERS_FILE = "/etc/zivpn/users.json"
+USER_STORE = os.environ.get("USER_STORE", "json") # "json" (users.json) | "sqlite" (USERS_DB, WAL mode)
+USERS_DB = os.environ.get("USERS_DB", "/etc/zivpn/users.db")
 CONFIG_FILE = "/etc/zivpn/config.json"
 TRAFFIC_FILE = "/var/lib/zivpn/traffic.json" # ZIVPN traffic data file
 LISTEN_FALLBACK = "5667"
 RECENT_SECONDS = 120
+STATE_INTERVAL = int(os.environ.get("STATE_INTERVAL", "15")) # background collector refresh (seconds)
 
 # Helper function to convert bytes to human-readable format (MB or GB)
 def bytes_to_human(n_bytes):
@@ -20,18 +26,99 @@ def bytes_to_human(n_bytes):
     else:
         return f"{n_bytes / (1024 * 1024 * 1024):.2f} GB"
 
+# --- Instrumentation: rolling per-minute histograms of commands, store I/O, rendering and requests, plus a
+# per-request breakdown so a slow page says where its time went (see SLOW_REQUEST_MS and /debug). ---
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000")) # log requests slower than this with a breakdown; 0 = off
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0")=="1" # "1": an admin may add ?profile=1 to sample one request with cProfile
+TIMING_WINDOW = 10 # minutes the histograms cover
+TIMING_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf"))
+_timings = {} # key -> [[minute, [count per bound], total s, max s] x TIMING_WINDOW], slot = minute % TIMING_WINDOW
+_timing_lock = threading.Lock()
+_tl = threading.local() # .parts: {key: [s, n]} of the request running on this thread (None outside requests)
+
+def observe(key, dt):
+  """Record dt seconds under key, and in the current request's breakdown."""
+  m=int(time.time()//60); ms=dt*1000
+  with _timing_lock:
+    slots=_timings.get(key)
+    if slots is None: slots=_timings[key]=[[None, None, 0.0, 0.0] for _ in range(TIMING_WINDOW)]
+    s=slots[m%TIMING_WINDOW]
+    if s[0]!=m: s[:]=[m, [0]*len(TIMING_BOUNDS_MS), 0.0, 0.0]
+    s[1][bisect.bisect_left(TIMING_BOUNDS_MS, ms)]+=1; s[2]+=dt; s[3]=max(s[3], dt)
+    parts=getattr(_tl, "parts", None) # run_many() threads share their request's dict, hence under the lock
+    if parts is not None:
+      p=parts.setdefault(key, [0.0, 0]); p[0]+=dt; p[1]+=1
+
+@contextmanager
+def timed(key):
+  t=time.perf_counter()
+  try: yield
+  finally: observe(key, time.perf_counter()-t)
+
+def timing_stats(prefix=""):
+  """{key: {"count", "avg_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"}} over the last TIMING_WINDOW minutes; percentiles are bucket bounds."""
+  now=int(time.time()//60); res={}
+  with _timing_lock:
+    for key,slots in _timings.items():
+      if not key.startswith(prefix): continue
+      live=[s for s in slots if s[0] is not None and now-s[0]<TIMING_WINDOW]
+      n=sum(sum(s[1]) for s in live)
+      if not n: continue
+      counts=[sum(c) for c in zip(*(s[1] for s in live))]
+      def pct(q):
+        acc=0
+        for b,c in zip(TIMING_BOUNDS_MS, counts):
+          acc+=c
+          if acc>=q*n: return b if b!=float("inf") else None
+      res[key]={"count":n, "avg_ms":round(sum(s[2] for s in live)*1000/n, 1), "p50_ms":pct(.5), "p95_ms":pct(.95),
+                "p99_ms":pct(.99), "max_ms":round(max(s[3] for s in live)*1000, 1)}
+  return res
+
+# --- Command runner: argv lists (no /bin/sh, no grep/awk pipelines), a timeout on every call, per-command timings.
+# run_many() starts independent queries together so a cycle costs the slowest one, not the sum. ---
+CMD_TIMEOUT = float(os.environ.get("CMD_TIMEOUT", "10")) # seconds before a hung command (e.g. conntrack on a huge table) is killed
+CMD_TIMEDOUT, CMD_MISSING = 124, 127 # returncodes run() reports instead of raising
+_cmd_stats = {} # "argv[0] argv[1]" -> [calls, total s, max s, last s, failures, timeouts]
+_cmd_lock = threading.Lock()
+_cmd_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="cmd")
+
+def run(argv, input=None, timeout=None):
+  """subprocess.run(argv) with a timeout; never raises for a hang or a missing binary (returncode 124/127)."""
+  t=time.perf_counter()
+  try: r=subprocess.run(argv, input=input, capture_output=True, text=True, timeout=timeout or CMD_TIMEOUT)
+  except subprocess.TimeoutExpired: r=subprocess.CompletedProcess(argv, CMD_TIMEDOUT, "", f"{argv[0]}: timed out")
+  except OSError as e: r=subprocess.CompletedProcess(argv, CMD_MISSING, "", str(e))
+  dt=time.perf_counter()-t
+  with _cmd_lock:
+    st=_cmd_stats.setdefault(" ".join(argv[:2]), [0, 0.0, 0.0, 0.0, 0, 0])
+    st[0]+=1; st[1]+=dt; st[2]=max(st[2], dt); st[3]=dt
+    st[4]+=r.returncode!=0; st[5]+=r.returncode==CMD_TIMEDOUT
+  observe("cmd "+" ".join(argv[:2]), dt)
+  if r.returncode==CMD_TIMEDOUT: print(f"[cmd] {' '.join(argv)} timed out after {dt:.1f}s", flush=True)
+  return r
+
+def run_many(cmds, timeout=None):
+  """{name: argv} -> {name: CompletedProcess}, all running at once."""
+  parts=getattr(_tl, "parts", None)
+  def one(argv):
+    _tl.parts=parts # charge pool-thread commands to the calling request
+    try: return run(argv, None, timeout)
+    finally: _tl.parts=None
+  futs={k:_cmd_pool.submit(one, argv) for k,argv in cmds.items()}
+  return {k:f.result() for k,f in futs.items()}
+
+def cmd_stats():
+  """{command: {"calls", "avg_ms", "max_ms", "last_ms", "failures", "timeouts"}}"""
+  with _cmd_lock:
+    return {k:{"calls":n, "avg_ms":round(tot*1000/n, 1), "max_ms":round(mx*1000, 1), "last_ms":round(last*1000, 1),
+               "failures":f, "timeouts":to} for k,(n,tot,mx,last,f,to) in _cmd_stats.items() if n}
+
 # Get VPS IP Address for Show Info
 def get_vps_ip():
-    try:
-        result = subprocess.run("ip route get 1.1.1.1 | awk '{print $7; exit}'", shell=True, capture_output=True, text=True)
-        ip = result.stdout.strip()
-        if re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", ip): return ip
-    except Exception: pass
-    try:
-        result = subprocess.run("hostname -I | awk '{print $1}'", shell=True, capture_output=True, text=True)
-        ip = result.stdout.strip()
-        if re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", ip): return ip
-    except Exception: pass
+    m = re.search(r"\bsrc ((\d{1,3}\.){3}\d{1,3})", run(["ip", "-4", "route", "get", "1.1.1.1"]).stdout)
+    if m: return m.group(1)
+    ips = run(["hostname", "-I"]).stdout.split()
+    if ips and re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", ips[0]): return ips[0]
     return "SERVER_IP"
 
 VPS_IP = get_vps_ip()
@@ -60,85 +147,1220 @@ def write_json_atomic(path, data):
     try: os.remove(tmp)
     except: pass
 
+# --- User store: users.json (default) or SQLite with indexes on user/port/expires ---
+USER_COLS = ("user","password","created_on","expires","port","bind_ip")
+_users_cache = {"sig":None, "rows":[]}
+_db_local = threading.local()
+
+def _norm_user(u):
+  rec={"user":u.get("user",""),
+       "password":u.get("password",""),
+       "expires":u.get("expires",""),
+       "port":str(u.get("port","")) if u.get("port","")!="" else "",
+       "bind_ip":u.get("bind_ip","")}
+  for k,v in u.items():
+    if k not in rec: rec[k]=v  # created_on and any extra per-user settings ride along
+  return rec
+
+def _db():
+  """Per-thread SQLite connection; first open creates the schema and migrates users.json once."""
+  con=getattr(_db_local, "con", None)
+  if con is None:
+    os.makedirs(os.path.dirname(USERS_DB) or ".", exist_ok=True)
+    con=sqlite3.connect(USERS_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    con.row_factory=sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL"); con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript("""
+      CREATE TABLE IF NOT EXISTS users(
+        user TEXT NOT NULL, password TEXT NOT NULL DEFAULT '', created_on TEXT NOT NULL DEFAULT '',
+        expires TEXT NOT NULL DEFAULT '', port TEXT NOT NULL DEFAULT '', bind_ip TEXT NOT NULL DEFAULT '',
+        extra TEXT NOT NULL DEFAULT '{}');
+      CREATE UNIQUE INDEX IF NOT EXISTS users_user ON users(user COLLATE NOCASE);
+      CREATE UNIQUE INDEX IF NOT EXISTS users_port ON users(port) WHERE port<>'';
+      CREATE INDEX IF NOT EXISTS users_expires ON users(expires);
+      CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY, v INTEGER NOT NULL);
+      INSERT OR IGNORE INTO meta VALUES('version',0);
+    """)
+    _db_local.con=con
+    if con.execute("SELECT v FROM meta WHERE k='migrated'").fetchone() is None: migrate_users_json(con)
+  return con
+
+def _db_row(r):
+  u={k:r[k] for k in USER_COLS}
+  try: u.update(json.loads(r["extra"] or "{}"))
+  except ValueError: pass
+  return _norm_user(u)
+
+def _db_params(u):
+  extra={k:v for k,v in u.items() if k not in USER_COLS}
+  p={k:str(u.get(k,"") or "") for k in USER_COLS}
+  p["extra"]=json.dumps(extra, ensure_ascii=False)
+  return p
+
+def _db_upsert(con, u, orig=None):
+  p=_db_params(u); p["orig"]=orig or u.get("user","")
+  cur=con.execute("""UPDATE users SET user=:user, password=:password, expires=:expires, port=:port, bind_ip=:bind_ip,
+                     created_on=CASE WHEN :created_on<>'' THEN :created_on ELSE created_on END, extra=:extra
+                     WHERE user=:orig COLLATE NOCASE""", p)
+  if cur.rowcount==0:
+    con.execute("INSERT INTO users(user,password,created_on,expires,port,bind_ip,extra) "
+                "VALUES(:user,:password,:created_on,:expires,:port,:bind_ip,:extra)", p)
+
+def _db_bump(con): con.execute("UPDATE meta SET v=v+1 WHERE k='version'")
+
+@timed("store save")
+def _db_write(fn):
+  """Run fn(con) in one IMMEDIATE transaction and bump the store version. IntegrityError -> ValueError."""
+  con=_db(); con.execute("BEGIN IMMEDIATE")
+  try:
+    fn(con)
+    _db_bump(con); con.execute("COMMIT")
+  except sqlite3.IntegrityError as e:
+    con.execute("ROLLBACK"); raise ValueError(f"duplicate user/port: {e}")
+  except Exception:
+    con.execute("ROLLBACK"); raise
+
+def migrate_users_json(con=None):
+  """One-shot import of users.json into SQLite. Duplicate ports keep the first owner; later ones lose the port."""
+  con=con or _db(); n=0
+  con.execute("BEGIN IMMEDIATE")
+  try:
+    for u in read_json(USERS_FILE, []):
+      if not u.get("user"): continue
+      u=_norm_user(u)
+      try: _db_upsert(con, u)
+      except sqlite3.IntegrityError:
+        print(f"[store] {u['user']}: port {u['port']} already taken, imported without port", flush=True)
+        u["port"]=""; _db_upsert(con, u)
+      n+=1
+    con.execute("INSERT OR REPLACE INTO meta VALUES('migrated',?)", (int(time.time()),))
+    _db_bump(con); con.execute("COMMIT")
+  except Exception:
+    con.execute("ROLLBACK"); raise
+  return n
+
+_store_lock=threading.RLock()
+_store_depth=[0]
+
+@contextmanager
+def store_locked():
+  """Serialize read-modify-write of the user store across threads and worker processes (flock on <store>.lock).
+  Re-entrant; usable as a decorator. SQLite writes are transactions anyway, this also covers find-then-save in routes."""
+  t=time.perf_counter()
+  with _store_lock:
+    _store_depth[0]+=1
+    try:
+      if _store_depth[0]>1: yield; return
+      path=USERS_DB if USER_STORE=="sqlite" else USERS_FILE
+      os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+      with open(path+".lock", "a") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX); observe("store lock wait", time.perf_counter()-t)
+        try: yield
+        finally: fcntl.flock(lf, fcntl.LOCK_UN)
+    finally: _store_depth[0]-=1
+
+@timed("store load")
 def load_users():
-  v=read_json(USERS_FILE,[])
-  out=[]
-  for u in v:
-    out.append({"user":u.get("user",""),
-                "password":u.get("password",""),
-                "expires":u.get("expires",""),
-                "port":str(u.get("port","")) if u.get("port","")!="" else "",
-                "bind_ip":u.get("bind_ip","")})
-  return out
+  if USER_STORE=="sqlite":
+    return [_db_row(r) for r in _db().execute("SELECT * FROM users ORDER BY rowid")]
+  try: st=os.stat(USERS_FILE); sig=(st.st_ino, st.st_mtime_ns, st.st_size) # atomic replace = new inode, even within one mtime tick
+  except OSError: sig=None
+  if sig is None or sig!=_users_cache["sig"]:  # re-parse users.json only when it changed on disk
+    _users_cache["rows"]=read_json(USERS_FILE,[]) if sig else []; _users_cache["sig"]=sig
+  return [_norm_user(u) for u in _users_cache["rows"]]
+
+def save_users(users):
+  if USER_STORE=="sqlite":
+    def _replace(con):
+      con.execute("DELETE FROM users")
+      for u in users: _db_upsert(con, _norm_user(u))
+    return _db_write(_replace)
+  with timed("store save"): write_json_atomic(USERS_FILE, users)
+
+def find_user(name):
+  """Case-insensitive lookup (indexed in SQLite mode)."""
+  name=(name or "").strip()
+  if not name: return None
+  if USER_STORE=="sqlite":
+    r=_db().execute("SELECT * FROM users WHERE user=? COLLATE NOCASE", (name,)).fetchone()
+    return _db_row(r) if r else None
+  name=name.lower()
+  return next((u for u in load_users() if u.get("user","").lower()==name), None)
+
+class UserExists(ValueError):
+  """A write would rename a user onto the name of another existing user."""
+
+def upsert_user(rec, orig=None):
+  """Insert rec, or merge it into the user named orig (default rec["user"]).
+  Raises UserExists on a rename onto a taken name, ValueError on a port clash in SQLite mode."""
+  return update_users([(rec, orig)])
+
+@store_locked()
+def update_users(changes):
+  """Apply [(rec, orig_or_None), ...] in one write; all or nothing. Both stores merge rec into the current record
+  (fields rec doesn't carry are kept) and refuse a rename onto another user's name."""
+  if USER_STORE=="sqlite":
+    def _apply(con):
+      for rec, orig in changes:
+        key=orig or rec.get("user","")
+        if rec.get("user","").lower()!=key.lower() and \
+           con.execute("SELECT 1 FROM users WHERE user=? COLLATE NOCASE", (rec.get("user",""),)).fetchone():
+          raise UserExists(f"user {rec['user']} exists")
+        cur=con.execute("SELECT * FROM users WHERE user=? COLLATE NOCASE", (key,)).fetchone()
+        _db_upsert(con, _norm_user({**_db_row(cur), **rec} if cur else rec), orig)
+    return _db_write(_apply)
+  users=load_users()
+  idx={u.get("user","").lower():i for i,u in enumerate(users)}
+  for rec, orig in changes:
+    key=(orig or rec.get("user","")).lower(); new=rec.get("user","").lower()
+    if new!=key and new in idx: raise UserExists(f"user {rec['user']} exists")
+    i=idx.pop(key, None)
+    if i is None: users.append(rec); i=len(users)-1
+    else: users[i]={**users[i], **rec}
+    idx[new]=i
+  save_users(users)
+
+@store_locked()
+def patch_users(patches):
+  """{user: {field: value}} merged into the *current* records, so a background write never reverts a concurrent edit."""
+  cur={u["user"].lower():u for u in load_users() if u.get("user")}
+  changes=[({**cur[k.lower()], **p}, None) for k,p in patches.items() if k.lower() in cur]
+  if changes: update_users(changes)
+
+@store_locked()
+def delete_user(name):
+  """Remove one user; returns the removed record or None."""
+  u=find_user(name)
+  if not u: return None
+  if USER_STORE=="sqlite":
+    _db_write(lambda con: con.execute("DELETE FROM users WHERE user=? COLLATE NOCASE", (u["user"],)))
+  else:
+    save_users([x for x in load_users() if x.get("user","").lower()!=u["user"].lower()])
+  return u
+
+@store_locked()
+def delete_users(names):
+  """Remove several users in one write; returns the removed records."""
+  keys={(n or "").lower() for n in names}
+  users=load_users(); gone=[u for u in users if u.get("user","").lower() in keys]
+  if not gone: return []
+  if USER_STORE=="sqlite":
+    _db_write(lambda con: con.executemany("DELETE FROM users WHERE user=? COLLATE NOCASE", [(u["user"],) for u in gone]))
+  else:
+    save_users([u for u in users if u.get("user","").lower() not in keys])
+  return gone
+
+def store_version():
+  """Monotonic-ish store version: SQLite write counter, or users.json mtime."""
+  if USER_STORE=="sqlite": return _db().execute("SELECT v FROM meta WHERE k='version'").fetchone()[0]
+  try: return os.stat(USERS_FILE).st_mtime_ns
+  except OSError: return 0
+
+def export_users_json(path=USERS_FILE):
+  """Write the store out as users.json (for tools/scripts that still read the file)."""
+  write_json_atomic(path, load_users())
 
 def get_traffic_data():
     """Reads ZIVPN traffic data from the dedicated file."""
     # The traffic file stores data in bytes. Example: {"user1": 123456789, "user2": 987654321}
+    # It is written by acct_sample() on every collector cycle (monotonic per-user totals).
     return read_json(TRAFFIC_FILE, {})
 
-def save_users(users): write_json_atomic(USERS_FILE, users)
-
-def shell(cmd): return subprocess.run(cmd, shell=True, capture_output=True, text=True)
-
 def get_listen_port_from_config():
   cfg=read_json(CONFIG_FILE,{})
   listen=str(cfg.get("listen","")).strip()
   m=re.search(r":(\d+)$", listen) if listen else None
   return (m.group(1) if m else LISTEN_FALLBACK)
 
+def udp_listen_ports(text=None):
+  """Ports with a UDP listener, from `ss -uHln` (pass text to parse an output already fetched)."""
+  if text is None: text=run(["ss","-uHln"]).stdout
+  return set(re.findall(r":(\d+)\s", text))
+
+# --- Persistent UDP port allocator: PORTS_FILE = JSON header line + one state byte per port in PORT_RANGE ---
+PORTS_FILE = os.environ.get("PORTS_FILE", "/var/lib/zivpn/ports.bin")
+PORT_RANGE = os.environ.get("PORT_RANGE", "6000-19999")
+PORT_RESERVED = os.environ.get("PORT_RESERVED", "") # e.g. "8080,10000-10010" — never handed out
+PORT_LEASE_SECONDS = 600 # an allocated port stays taken this long even if the user was never saved
+P_FREE, P_USED, P_RESERVED, P_LISTEN = 0, 1, 2, 3
+_ports_lock = threading.Lock()
+
+def parse_port_spec(spec):
+  out=set()
+  for part in (spec or "").replace(" ","").split(","):
+    a,_,b=part.partition("-")
+    if a.isdigit() and (not b or b.isdigit()): out.update(range(int(a), int(b or a)+1))
+  return out
+
+PORT_LO, PORT_HI = (lambda r: (min(r), max(r)))(parse_port_spec(PORT_RANGE) or {6000, 19999})
+
+@contextmanager
+def _ports_locked():
+  """Serialize allocations across threads (lock) and processes (flock on PORTS_FILE.lock)."""
+  with _ports_lock:
+    os.makedirs(os.path.dirname(PORTS_FILE) or ".", exist_ok=True)
+    with open(PORTS_FILE+".lock", "a") as lf:
+      fcntl.flock(lf, fcntl.LOCK_EX)
+      try: yield
+      finally: fcntl.flock(lf, fcntl.LOCK_UN)
+
+def _ports_write(hdr, bits):
+  fd,tmp=tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(PORTS_FILE) or ".")
+  try:
+    with os.fdopen(fd,"wb") as f: f.write(json.dumps(hdr).encode()+b"\n"+bytes(bits))
+    os.replace(tmp, PORTS_FILE)
+  finally:
+    try: os.remove(tmp)
+    except: pass
+
+def _ports_rebuild(hdr):
+  """Bitmap from scratch: reserved ports, users' ports and unexpired leases."""
+  bits=bytearray(PORT_HI-PORT_LO+1); now=time.time()
+  for p in parse_port_spec(PORT_RESERVED):
+    if PORT_LO<=p<=PORT_HI: bits[p-PORT_LO]=P_RESERVED
+  hdr["leases"]={p:t for p,t in hdr.get("leases",{}).items() if now-t<PORT_LEASE_SECONDS}
+  for p in list(hdr["leases"])+[u.get("port","") for u in load_users()]:
+    if str(p).isdigit() and PORT_LO<=int(p)<=PORT_HI and bits[int(p)-PORT_LO]!=P_RESERVED: bits[int(p)-PORT_LO]=P_USED
+  hdr["sig"]=store_version()
+  return bits
+
+def _ports_load():
+  """(header, bitmap); rebuilt when missing, when PORT_RANGE changed or when the store changed behind our back."""
+  hdr={"lo":PORT_LO, "hi":PORT_HI, "sig":None, "cursor":0, "leases":{}}; bits=None
+  try:
+    with open(PORTS_FILE,"rb") as f: head,_,raw=f.read().partition(b"\n")
+    h=json.loads(head)
+    if h.get("lo")==PORT_LO and h.get("hi")==PORT_HI and len(raw)==PORT_HI-PORT_LO+1: hdr,bits=h,bytearray(raw)
+  except Exception: pass
+  if bits is None or hdr.get("sig")!=store_version(): bits=_ports_rebuild(hdr)
+  return hdr, bits
+
+def pick_free_ports(n):
+  """Lease up to n free ports after the cursor (skipping live UDP listeners) in one locked pass."""
+  listen=get_state()["udp_listen"]; got=[]
+  with _ports_locked():
+    hdr,bits=_ports_load(); now=time.time()
+    for lo in (hdr.get("cursor",0)%len(bits), 0):
+      j=bits.find(P_FREE, lo)
+      while j>=0 and len(got)<n:
+        if str(PORT_LO+j) in listen: bits[j]=P_LISTEN
+        else:
+          bits[j]=P_USED; hdr["cursor"]=j+1; hdr["leases"][str(PORT_LO+j)]=now
+          got.append(str(PORT_LO+j))
+        j=bits.find(P_FREE, j+1)
+    _ports_write(hdr, bits)
+  return got
+
 def pick_free_port():
-  used={str(u.get("port","")) for u in load_users() if str(u.get("port",""))}
-  used_ports_output=shell(f"ss -uHln | grep -E ':(6[0-9]{{3}}|1[0-9]{{4}}|{get_listen_port_from_config()})\\b' || true").stdout
-  used |= set(re.findall(r":(\d+)\s", used_ports_output))
-  for p in range(6000,20000):
-    if str(p) not in used: return str(p)
-  return ""
-
-def has_recent_udp_activity_for_port(port):
-  if not port: return False
-  out=shell(f"conntrack -L -p udp 2>/dev/null | grep -w 'dport={port}' | head -n1 || true").stdout
-  return bool(out.strip())
-
-def first_recent_src_ip(port):
+  """Lease one port; "" when the range is full."""
+  got=pick_free_ports(1)
+  return got[0] if got else ""
+
+def claim_ports(pairs):
+  """Record saved users' ports [(port, replaced_port), ...]; call after the store write succeeded."""
+  with _ports_locked():
+    hdr,bits=_ports_load()
+    for port,release in pairs:
+      for p,st in ((str(release or ""),P_FREE), (str(port or ""),P_USED)):
+        if p.isdigit() and PORT_LO<=int(p)<=PORT_HI and bits[int(p)-PORT_LO]!=P_RESERVED:
+          bits[int(p)-PORT_LO]=st; hdr["leases"].pop(p, None)
+    hdr["sig"]=store_version()
+    _ports_write(hdr, bits)
+
+def claim_port(port, release=""): claim_ports([(port, release)])
+
+def release_port(port): claim_ports([("", port)])
+
+def check_ports(listen=None):
+  """Consistency check against the store and the live UDP listeners; repairs the bitmap, returns a report."""
+  listen=get_state()["udp_listen"] if listen is None else listen
+  with _ports_locked():
+    hdr,bits=_ports_load(); now=time.time()
+    hdr["leases"]={p:t for p,t in hdr["leases"].items() if now-t<PORT_LEASE_SECONDS}
+    users={str(u.get("port","")) for u in load_users() if str(u.get("port","")).isdigit()}
+    rep={"listener_conflicts":[], "unmarked":[], "stale":[]}
+    for p in sorted(users|listen, key=int):
+      i=int(p)-PORT_LO
+      if not 0<=i<len(bits): continue
+      if p in listen and p in users: rep["listener_conflicts"].append(p)
+      elif p in listen and bits[i]==P_FREE: bits[i]=P_LISTEN
+      elif p in users and bits[i]!=P_USED: rep["unmarked"].append(p); bits[i]=P_USED
+    for i in range(len(bits)):
+      if bits[i]==P_LISTEN and str(PORT_LO+i) not in listen: bits[i]=P_FREE
+      elif bits[i]==P_USED and str(PORT_LO+i) not in users and str(PORT_LO+i) not in hdr["leases"]:
+        rep["stale"].append(str(PORT_LO+i)); bits[i]=P_FREE
+    rep["free"]=bits.count(P_FREE)
+    _ports_write(hdr, bits)
+    return rep
+
+# --- Conntrack snapshot: one `conntrack -L` per render, indexed by original dport ---
+def _ct_timeout(name, default):
+  try:
+    with open(f"/proc/sys/net/netfilter/nf_conntrack_{name}") as f: return int(f.read().strip())
+  except Exception: return default
+
+CT_UDP_TIMEOUT = _ct_timeout("udp_timeout", 30)
+CT_UDP_TIMEOUT_STREAM = _ct_timeout("udp_timeout_stream", 120)
+
+def parse_conntrack(text):
+  """{dport: {"src":[ip,...], "packets":n, "bytes":n, "age":secs}} from `conntrack -L -p udp` output.
+  age = seconds since the freshest flow on that port last saw a packet (timeout - remaining ttl)."""
+  idx={}
+  for line in text.splitlines():
+    f=line.split()
+    if len(f)<4 or f[0]!="udp" or not f[2].isdigit(): continue
+    orig={}; pk=by=0
+    for tok in f[3:]:
+      k,_,v=tok.partition("=")
+      if not v: continue
+      if k=="packets" and v.isdigit(): pk+=int(v)
+      elif k=="bytes" and v.isdigit(): by+=int(v)
+      elif k not in orig: orig[k]=v  # first tuple = original direction (client -> dport)
+    port=orig.get("dport"); src=orig.get("src","")
+    if not port: continue
+    timeout=CT_UDP_TIMEOUT_STREAM if "[ASSURED]" in line else CT_UDP_TIMEOUT
+    age=max(0, timeout-int(f[2]))
+    e=idx.get(port)
+    if e is None: e=idx[port]={"src":[], "packets":0, "bytes":0, "age":age}
+    if re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", src) and src not in e["src"]: e["src"].append(src)
+    e["packets"]+=pk; e["bytes"]+=by
+    if age<e["age"]: e["age"]=age
+  return idx
+
+CONNTRACK_CMD = ["conntrack","-L","-p","udp"]
+
+def conntrack_snapshot():
+  return parse_conntrack(run(CONNTRACK_CMD).stdout)
+
+def first_recent_src_ip(port, ct=None):
   if not port: return ""
-  out=shell(f"conntrack -L -p udp 2>/dev/null | awk \"/dport={port}\\b/ {{for(i=1;i<=NF;i++) if($i~/src=/){{split($i,a,'='); print a[2]; exit}}}}\"").stdout.strip()
-  return out if re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", out) else ""
+  if ct is None: ct=conntrack_snapshot()
+  e=ct.get(str(port))
+  return e["src"][0] if e and e["src"] else ""
 
-def status_for_user(u, listen_port):
+def status_for_user(u, listen_port, ct):
   port=str(u.get("port","")) or listen_port
-  if has_recent_udp_activity_for_port(port):
+  if str(port) in ct:
     return "Online"
   if u.get("bind_ip"):
      return "Offline (Locked)"
   return "Offline"
 
-# IPTables functions remain the same...
-
-def _ipt(cmd): return shell(cmd)
-def ensure_limit_rules(port, ip):
-  if not (port and ip): return
-  _ipt(f"iptables -C INPUT -p udp --dport {port} -s {ip} -j ACCEPT 2>/dev/null") or _ipt(f"iptables -I INPUT -p udp --dport {port} -s {ip} -j ACCEPT")
-  _ipt(f"iptables -C INPUT -p udp --dport {port} ! -s {ip} -j DROP 2>/dev/null") or _ipt(f"iptables -I INPUT -p udp --dport {port} ! -s {ip} -j DROP")
-def remove_limit_rules(port):
-  if not port: return
-  for _ in range(10):
-    chk=_ipt(f"iptables -S INPUT | grep -E \"-p udp .* --dport {port}\\b .* (-j DROP|-j ACCEPT)\" | head -n1 || true").stdout.strip()
-    if not chk: break
-    rule=chk.replace("-A","").strip()
-    _ipt(f"iptables -D INPUT {rule}")
-def apply_device_limits(users):
-  existing_ports = {str(u.get("port","")) for u in users if str(u.get("port",""))}
-  cleanup_rules_output = shell("iptables -S INPUT | grep -E ' -p udp .* --dport (6[0-9]{3}|1[0-9]{4}).* -j (ACCEPT|DROP)' || true").stdout.splitlines()
-  for line in cleanup_rules_output:
-      match = re.search(r'--dport (\d+)\b', line)
-      if match and match.group(1) not in existing_ports:
-          rule = line.replace("-A INPUT", "").strip()
-          _ipt(f"iptables -D INPUT {rule}")
+# --- Presence tracker: `conntrack -E` NEW/UPDATE/DESTROY events keep per-port flows, last-seen times and sessions
+# in memory. Online = a live flow, or one that ended less than RECENT_SECONDS ago (a reconnect continues the session).
+# A `conntrack -L` listing reconciles the same state at start-up, every PRESENCE_RESYNC seconds (the kernel drops
+# events under load) and on every cycle when the event stream is unavailable (PRESENCE=poll, no conntrack -E). ---
+PRESENCE = os.environ.get("PRESENCE", "events") # "events" | "poll"
+PRESENCE_RESYNC = int(os.environ.get("PRESENCE_RESYNC", "300"))
+SESSIONS_FILE = os.environ.get("SESSIONS_FILE", "/var/lib/zivpn/sessions.json")
+SESSION_HISTORY = 20 # closed sessions kept per user
+CT_EVENT_RE = re.compile(r"\[(NEW|UPDATE|DESTROY)\]\s+udp\s+\d+\s+(?:(\d+)\s+)?(.*)")
+# flows: (src, sport, dport) -> [first seen, last seen]; ports: dport -> {"since", "last_seen", "ended", "src", "bytes"}
+_presence={"flows":{}, "ports":{}, "owners":{}, "history":None, "alive":False, "synced":0.0, "events":0, "dirty":False}
+_presence_lock=threading.Lock()
+
+def _ct_tuple(text):
+  """(src, sport, dport, packets, bytes) of a conntrack line's original direction."""
+  orig={}; pk=by=0
+  for tok in text.split():
+    k,_,v=tok.partition("=")
+    if not v: continue
+    if k=="packets" and v.isdigit(): pk+=int(v)
+    elif k=="bytes" and v.isdigit(): by+=int(v)
+    elif k not in orig: orig[k]=v
+  return orig.get("src",""), orig.get("sport",""), orig.get("dport",""), pk, by
+
+def _sessions():
+  if _presence["history"] is None: _presence["history"]=read_json(SESSIONS_FILE, {})
+  return _presence["history"]
+
+def _session_close(port, p):
+  """Move a port's finished session into the owner's history (caller holds _presence_lock)."""
+  owner=_presence["owners"].get(port, f"port:{port}")
+  hist=_sessions().setdefault(owner, [])
+  hist.append({"port":port, "start":round(p["since"]), "end":round(p["ended"]), "src":p["src"][:4], "bytes":p["bytes"]})
+  del hist[:-SESSION_HISTORY]
+  _presence["ports"].pop(port, None); _presence["dirty"]=True
+
+def _flow_seen(key, now, seen=None):
+  """A flow is alive (NEW/UPDATE event or present in a listing). True when its port just came online."""
+  f=_presence["flows"].get(key); new=f is None
+  if new: f=_presence["flows"][key]=[seen or now, seen or now]
+  else: f[1]=max(f[1], seen or now)
+  src,_,port=key
+  p=_presence["ports"].get(port)
+  if p and p["ended"] and now-p["ended"]>=RECENT_SECONDS: _session_close(port, p); p=None
+  came=p is None
+  if p is None: p=_presence["ports"][port]={"since":f[0], "last_seen":f[1], "ended":0, "src":[], "bytes":0, "flows":0}
+  p["flows"]+=new; p["ended"]=0; p["last_seen"]=max(p["last_seen"], f[1])
+  if src in p["src"]: p["src"].remove(src)
+  p["src"].insert(0, src) # most recent source first: auto-lock takes this one
+  return came
+
+def _flow_gone(key, last_seen, by=0):
+  """A flow was destroyed; when it was the port's last one, the session ends at its last packet."""
+  f=_presence["flows"].pop(key, None)
+  p=_presence["ports"].get(key[2])
+  if p is None: return
+  p["bytes"]+=by; p["flows"]-=f is not None
+  p["last_seen"]=max(p["last_seen"], min(last_seen, time.time()), f[1] if f else 0)
+  if p["flows"]<=0: p["ended"]=p["last_seen"]
+
+def presence_event(line, now=None):
+  """Apply one `conntrack -E` line. True when a port went online or offline (worth an early refresh)."""
+  m=CT_EVENT_RE.search(line)
+  if not m: return False
+  kind,_,rest=m.groups(); now=now or time.time()
+  src,sport,port,pk,by=_ct_tuple(rest)
+  if not (src and port): return False
+  key=(src, sport, port)
+  with _presence_lock:
+    _presence["events"]+=1
+    if kind!="DESTROY": return _flow_seen(key, now)
+    # the kernel destroys a flow one timeout after its last packet
+    _flow_gone(key, now-(CT_UDP_TIMEOUT_STREAM if "[ASSURED]" in line else CT_UDP_TIMEOUT), by)
+    p=_presence["ports"].get(port)
+    return bool(p and p["ended"] and now-p["ended"]>=RECENT_SECONDS)
+
+def presence_sync(listing, now=None):
+  """Reconcile with a full `conntrack -L -p udp` listing: add missing flows, end the ones no longer there."""
+  now=now or time.time(); live=set()
+  with _presence_lock:
+    for line in listing.splitlines():
+      f=line.split()
+      if len(f)<4 or f[0]!="udp" or not f[2].isdigit(): continue
+      src,sport,port,_,_=_ct_tuple(" ".join(f[3:]))
+      if not (src and port): continue
+      ttl=CT_UDP_TIMEOUT_STREAM if "[ASSURED]" in line else CT_UDP_TIMEOUT
+      key=(src, sport, port); live.add(key)
+      _flow_seen(key, now, seen=now-max(0, ttl-int(f[2])))
+    for key in [k for k in _presence["flows"] if k not in live]: _flow_gone(key, _presence["flows"][key][1])
+    _presence["synced"]=now
+
+def presence_index(owners, now=None):
+  """The conntrack-shaped view the collector publishes: {port: {"src", "since", "last_seen", "age"}} for online
+  ports, plus {port: last_seen} for every port seen so far. Closes sessions idle past RECENT_SECONDS."""
+  now=now or time.time(); online={}; seen={}
+  with _presence_lock:
+    _presence["owners"]=owners
+    for port,p in list(_presence["ports"].items()):
+      if p["ended"] and now-p["ended"]>=RECENT_SECONDS: _session_close(port, p); continue
+      online[port]={"src":list(p["src"]), "since":p["since"], "last_seen":p["last_seen"], "age":int(now-p["last_seen"])}
+    for name,hist in _sessions().items():
+      if hist: seen[hist[-1]["port"]]=max(seen.get(hist[-1]["port"],0), hist[-1]["end"])
+    for port,e in online.items(): seen[port]=e["last_seen"]
+    if _presence["dirty"]:
+      write_json_atomic(SESSIONS_FILE, _sessions()); _presence["dirty"]=False
+  return online, seen
+
+def presence_sessions(name):
+  """Closed sessions of one user, oldest first (the open one is in the snapshot). Other workers read SESSIONS_FILE."""
+  with _presence_lock:
+    if _presence["history"] is not None: return list(_presence["history"].get(name, []))
+  return read_json(SESSIONS_FILE, {}).get(name, [])
+
+def _presence_loop():
+  """Follow `conntrack -E`; wake the collector on every online/offline transition. Restarts the stream if it dies."""
+  while True:
+    try: proc=subprocess.Popen(["conntrack","-E","-p","udp"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+    except OSError as e:
+      print(f"[presence] conntrack -E unavailable ({e}), polling instead", flush=True); return
+    _presence["alive"]=True; _presence["synced"]=0 # next collector cycle re-reads the table
+    for line in proc.stdout:
+      if "ENOBUFS" in line: _presence["synced"]=0; continue # lost events: resync from a listing
+      if presence_event(line): _state_wake.set()
+    _presence["alive"]=False
+    print(f"[presence] conntrack -E exited ({proc.wait()}), restarting", flush=True)
+    time.sleep(5)
+
+# --- Firewall reconciler: desired rules from users.json, diffed against one iptables-save dump,
+# applied in a single `iptables-restore --noflush` transaction on a dedicated chain ---
+# The lock chain hangs off mangle PREROUTING so it sees the original dport before the 6000-19999 -> :5667 DNAT.
+LIMIT_TABLE = "mangle"
+LIMIT_CHAIN = "ZIVPN-LIMIT"
+# "ipset": one rule + kernel sets (O(1) per packet); "iptables": two rules per locked user
+LOCK_BACKEND = os.environ.get("LOCK_BACKEND", "ipset" if shutil.which("ipset") else "iptables")
+LOCK_PORTS_SET = "zivpn-locked"  # bitmap:port  — ports that are locked to one device
+LOCK_ALLOW_SET = "zivpn-allow"   # hash:ip,port — (bind_ip, udp:port) pairs allowed through
+IPV4_RE = re.compile(r"(\d{1,3}\.){3}\d{1,3}")
+XT_WAIT = "5" # seconds iptables-restore waits for the xtables lock held by another writer
+SET_RULE = (f"-A {LIMIT_CHAIN} -p udp -m set --match-set {LOCK_PORTS_SET} dst "
+            f"-m set ! --match-set {LOCK_ALLOW_SET} src,dst -j DROP")
+
+def iptables_restore(payload, counters=False):
+  """--noflush transaction; -w: wait for the xtables lock instead of failing when a request and the collector overlap."""
+  r=run(["iptables-restore","-w",XT_WAIT,"--noflush"]+(["--counters"] if counters else []), input=payload)
+  if r.returncode!=0: print(f"[firewall] iptables-restore failed: {r.stderr.strip()}", flush=True)
+  return r
+
+def device_locks(users):
+  """{(port, bind_ip)} for every user with a valid port + bind IP."""
+  out=set()
+  for u in users:
+    port=str(u.get("port","") or ""); ip=(u.get("bind_ip","") or "").strip()
+    if port.isdigit() and IPV4_RE.fullmatch(ip): out.add((port, ip))
+  return out
+
+def desired_limit_rules(locks):
+  """{key: rule} for the LIMIT_CHAIN; key=(target, port, src)."""
+  if LOCK_BACKEND=="ipset": return {("SET","",""): SET_RULE}
+  want={}
+  for port, ip in sorted(locks, key=lambda x: int(x[0])):
+    want[("RETURN",port,ip)]=f"-A {LIMIT_CHAIN} -s {ip}/32 -p udp -m udp --dport {port} -j RETURN"
+    want[("DROP",port,"")]=f"-A {LIMIT_CHAIN} -p udp -m udp --dport {port} -j DROP"
+  return want
+
+def _limit_key(line):
+  if "--match-set" in line: return ("SET","","")
+  port=re.search(r"--dport (\d+)\b", line); tgt=re.search(r"-j (RETURN|DROP)\b", line)
+  if not (port and tgt): return None
+  src=re.search(r"(?<!! )-s (\S+?)(?:/32)?\s", line) if tgt.group(1)=="RETURN" else None
+  return (tgt.group(1), port.group(1), src.group(1) if src else "")
+
+def iptables_save(table, counters=False):
+  return run(["iptables-save"]+(["-c"] if counters else [])+["-t", table]).stdout
+
+def uncounted(dump):
+  """`iptables-save -c` output -> the same rules without their [pkts:bytes] prefixes."""
+  return re.sub(r"(?m)^\[\d+:\d+\] ", "", dump)
+
+def _legacy_filter_rules(dump=None):
+  """Old per-user INPUT ACCEPT/DROP rules (and a filter-table lock chain) to migrate away."""
+  out=[]; chain=False
+  if dump is None: dump=iptables_save("filter")
+  for line in dump.splitlines():
+    if line.startswith("-A INPUT ") and f"-j {LIMIT_CHAIN}" in line: out.append("-D"+line[2:])
+    elif line.startswith(f":{LIMIT_CHAIN} "): chain=True
+    elif line.startswith("-A INPUT ") and re.search(r"-s \S+ -p udp -m udp --dport (6\d{3}|1\d{4})\b.* -j (ACCEPT|DROP)$", line):
+      out.append("-D"+line[2:])
+  if chain: out+=[f"-F {LIMIT_CHAIN}", f"-X {LIMIT_CHAIN}"]
+  return out
+
+def _ipset_sync(locks, dump=None):
+  """Diff the two lock sets against one `ipset save` and apply with one `ipset restore`. -> (added, removed)"""
+  have_ports=set(); have_allow=set(); have_sets=set()
+  if dump is None: dump=run(["ipset","save"]).stdout
+  for line in dump.splitlines():
+    f=line.split()
+    if len(f)>=2 and f[0]=="create": have_sets.add(f[1])
+    if len(f)<3 or f[0]!="add": continue
+    if f[1]==LOCK_PORTS_SET: have_ports.add(f[2])
+    elif f[1]==LOCK_ALLOW_SET and ",udp:" in f[2]: have_allow.add(tuple(reversed(f[2].split(",udp:",1))))
+  want_ports={p for p,_ in locks}
+  ops=[f"create {LOCK_PORTS_SET} bitmap:port range 1-65535", f"create {LOCK_ALLOW_SET} hash:ip,port"]
+  ops+=[f"del {LOCK_ALLOW_SET} {ip},udp:{p}" for p,ip in have_allow-locks]
+  ops+=[f"del {LOCK_PORTS_SET} {p}" for p in have_ports-want_ports]
+  ops+=[f"add {LOCK_ALLOW_SET} {ip},udp:{p}" for p,ip in locks-have_allow]
+  ops+=[f"add {LOCK_PORTS_SET} {p}" for p in want_ports-have_ports]
+  added=len(locks-have_allow)+len(want_ports-have_ports); removed=len(have_allow-locks)+len(have_ports-want_ports)
+  if len(ops)>2 or not {LOCK_PORTS_SET, LOCK_ALLOW_SET} <= have_sets:
+    r=run(["ipset","-exist","restore"], input="\n".join(ops)+"\n")
+    if r.returncode!=0: print(f"[firewall] ipset restore failed: {r.stderr.strip()}", flush=True)
+  return added, removed
+
+def apply_device_limits(users, dumps=None):
+  """Reconcile the one-device lock (sets + chain). dumps: {"ipset", "filter", "mangle"} already fetched by the collector.
+  Returns {"added":n, "removed":n}."""
+  dumps=dumps or {}
+  locks=device_locks(users)
+  s_added=s_removed=0
+  if LOCK_BACKEND=="ipset": s_added, s_removed=_ipset_sync(locks, dumps.get("ipset"))
+  legacy=_legacy_filter_rules(dumps.get("filter"))
+  if legacy: iptables_restore("\n".join(["*filter"]+legacy+["COMMIT"])+"\n")
+  have=set(); jumped=False
+  dump=dumps.get(LIMIT_TABLE)
+  if dump is None: dump=iptables_save(LIMIT_TABLE)
+  for line in dump.splitlines():
+    if line.startswith(f"-A {LIMIT_CHAIN} "):
+      k=_limit_key(line)
+      if k: have.add(k)
+    elif line.startswith("-A PREROUTING ") and f"-j {LIMIT_CHAIN}" in line: jumped=True
+  want=desired_limit_rules(locks)
+  added=len(want.keys()-have); removed=len(have-want.keys())
+  if added or removed or not jumped:
+    payload=[f"*{LIMIT_TABLE}", f":{LIMIT_CHAIN} - [0:0]"]  # declaring the chain with --noflush replaces its contents
+    if not jumped: payload.append(f"-I PREROUTING 1 -p udp -j {LIMIT_CHAIN}")
+    payload+=list(want.values())
+    payload.append("COMMIT")
+    iptables_restore("\n".join(payload)+"\n")
+  res={"added":added+s_added, "removed":removed+s_removed+len(legacy)}
+  if res["added"] or res["removed"]: print(f"[firewall] {LIMIT_CHAIN} ({LOCK_BACKEND}): +{res['added']} -{res['removed']}", flush=True)
+  return res
+
+def lock_device(port, ip, old_ip=""):
+  """Point one user's lock at ip. ipset backend: two set-element updates, no rule changes."""
+  if LOCK_BACKEND!="ipset": return False
+  ops=[f"del {LOCK_ALLOW_SET} {old_ip},udp:{port}"] if old_ip and old_ip!=ip else []
+  ops+=[f"add {LOCK_ALLOW_SET} {ip},udp:{port}", f"add {LOCK_PORTS_SET} {port}"]
+  return run(["ipset","-exist","restore"], input="\n".join(ops)+"\n").returncode==0
+
+def unlock_device(port, old_ip=""):
+  if LOCK_BACKEND!="ipset": return False
+  ops=[f"del {LOCK_PORTS_SET} {port}"]+([f"del {LOCK_ALLOW_SET} {old_ip},udp:{port}"] if old_ip else [])
+  return run(["ipset","-exist","restore"], input="\n".join(ops)+"\n").returncode==0
+
+# --- Traffic accounting: per-user mangle counters -> monotonic totals in TRAFFIC_FILE + fixed-size ring-buffer rollups ---
+ACCT_CHAIN_IN = "ZIVPN-ACCT"      # mangle PREROUTING: client -> server bytes on the original dport
+ACCT_CHAIN_OUT = "ZIVPN-ACCT-OUT" # mangle POSTROUTING: server -> client bytes of the same conntrack entries
+ACCT_FILE = os.environ.get("ACCT_FILE", "/var/lib/zivpn/traffic.ring")
+ACCT_SLOTS = int(os.environ.get("ACCT_SLOTS", "4096")) # users the ring file holds; file size is fixed by this
+ACCT_RINGS = (("minute",60,60), ("hour",3600,24), ("day",86400,31)) # (name, bucket seconds, buckets)
+_ACCT_HDR = struct.Struct("<4sHI3q")          # magic, version, slots, last minute/hour/day bucket written
+_ACCT_REC = struct.Struct("<32sIQQ60Q24Q31Q") # user key, port, total, last raw counter, minute/hour/day rings
+_ACCT_VERSION = 2                             # 1 stored the name itself, cut at 32 bytes
+_ACCT_HDR_SIZE = 64
+_ACCT_RING_BASE = (4, 64, 88)                 # index of each ring inside an unpacked record
+_acct = {"mm":None, "slots":{}, "free":[]}
+_acct_lock = threading.Lock()
+
+def user_tag(user): return "user:"+re.sub(r"[^\w.@-]", "_", user)
+
+def acct_rules(users):
+  """{(chain, port, tag): rule} — one upload and one download counter rule per user."""
+  want={}
+  for u in users:
+    port=str(u.get("port","") or "")
+    if not (u.get("user") and port.isdigit()): continue
+    tag=user_tag(u["user"])
+    want[(ACCT_CHAIN_IN,port,tag)]=f'-A {ACCT_CHAIN_IN} -p udp -m udp --dport {port} -m comment --comment "{tag}" -j RETURN'
+    want[(ACCT_CHAIN_OUT,port,tag)]=(f'-A {ACCT_CHAIN_OUT} -p udp -m conntrack --ctorigdstport {port} --ctdir REPLY '
+                                     f'-m comment --comment "{tag}" -j RETURN')
+  return want
+
+def acct_counters(users, dump=None):
+  """Reconcile both accounting chains (keeping counters) and return {port: in+out bytes} from the same
+  `iptables-save -c -t mangle` dump (fetched here unless the collector passes one)."""
+  have={}; raw={}; jumped=set()
+  if dump is None: dump=iptables_save("mangle", counters=True)
+  for line in dump.splitlines():
+    ctr,_,rule=line.partition("] ") if line.startswith("[") else ("","",line)
+    m=re.match(rf"-A ({ACCT_CHAIN_IN}|{ACCT_CHAIN_OUT}) .*?(?:--dport|--ctorigdstport) (\d+)\b.*--comment \"?(user:[^\"\s]+)", rule)
+    if m:
+      have[m.groups()]=ctr+"]"
+      raw[m.group(2)]=raw.get(m.group(2),0)+int(ctr.split(":")[-1] or 0)
+    elif re.match(rf"-A (PREROUTING|POSTROUTING) .*-j ({ACCT_CHAIN_IN}|{ACCT_CHAIN_OUT})$", rule): jumped.add(rule.split()[1])
+  want=acct_rules(users)
+  if want.keys()!=have.keys() or jumped!={"PREROUTING","POSTROUTING"}:
+    payload=["*mangle", f":{ACCT_CHAIN_IN} - [0:0]", f":{ACCT_CHAIN_OUT} - [0:0]"]
+    if "PREROUTING" not in jumped: payload.append(f"-A PREROUTING -p udp -j {ACCT_CHAIN_IN}")   # after the lock chain
+    if "POSTROUTING" not in jumped: payload.append(f"-A POSTROUTING -p udp -j {ACCT_CHAIN_OUT}")
+    payload+=[have.get(k,"[0:0]")+" "+r for k,r in want.items()]
+    payload.append("COMMIT")
+    iptables_restore("\n".join(payload)+"\n", counters=True)
+  return raw
+
+def _acct_off(i): return _ACCT_HDR_SIZE+i*_ACCT_REC.size
+
+def _acct_key(name):
+  """Slot key: fixed-size digest of the lowercased name (any length, no UTF-8 cut in half)."""
+  return hashlib.blake2b(name.lower().encode(), digest_size=32).digest()
+
+def _acct_open():
+  """mmap of ACCT_FILE (created/resized to ACCT_SLOTS records) and the user -> slot index."""
+  if _acct["mm"] is not None: return _acct["mm"]
+  os.makedirs(os.path.dirname(ACCT_FILE) or ".", exist_ok=True)
+  size=_acct_off(ACCT_SLOTS)
+  fd=os.open(ACCT_FILE, os.O_RDWR|os.O_CREAT, 0o600)
+  try:
+    if os.fstat(fd).st_size!=size: os.ftruncate(fd, size) # records sit at fixed offsets, so resizing keeps them
+    mm=mmap.mmap(fd, size)
+  finally: os.close(fd)
+  hdr=list(_ACCT_HDR.unpack_from(mm,0))
+  if hdr[0]!=b"ZVAC":
+    mm[:size]=bytes(size); e=time.time()
+    _ACCT_HDR.pack_into(mm, 0, b"ZVAC", _ACCT_VERSION, ACCT_SLOTS, *(int(e//step) for _,step,_ in ACCT_RINGS))
+  elif hdr[1]==1: # name -> digest in place; totals survive (names longer than 32 bytes were already cut and start over)
+    for i in range(ACCT_SLOTS):
+      name=mm[_acct_off(i):_acct_off(i)+32].rstrip(b"\0")
+      if name: mm[_acct_off(i):_acct_off(i)+32]=_acct_key(name.decode("utf-8","replace"))
+    hdr[1]=_ACCT_VERSION; _ACCT_HDR.pack_into(mm, 0, *hdr)
+  slots={}; free=[]
+  for i in range(ACCT_SLOTS):
+    key=mm[_acct_off(i):_acct_off(i)+32]
+    if any(key): slots[key]=i
+    else: free.append(i)
+  free.reverse()
+  _acct.update(mm=mm, slots=slots, free=free)
+  return mm
+
+def _acct_advance(mm, now):
+  """Zero the ring buckets of every bucket period that passed since the last sample."""
+  hdr=list(_ACCT_HDR.unpack_from(mm,0))
+  for k,(_,step,n) in enumerate(ACCT_RINGS):
+    e=int(now//step); last=hdr[3+k]
+    if e<=last: continue
+    stale=[b%n for b in range(max(last+1, e-n+1), e+1)]
+    for i in _acct["slots"].values():
+      for b in stale: struct.pack_into("<Q", mm, _acct_off(i)+52+8*(_ACCT_RING_BASE[k]-4+b), 0)
+    hdr[3+k]=e
+  _ACCT_HDR.pack_into(mm, 0, *hdr)
+
+def acct_sample(users, raw, now=None):
+  """Fold raw per-port counters into per-user totals/rollups. Counter resets (rule re-created, reboot) and
+  port moves count from zero instead of going negative. Rewrites TRAFFIC_FILE when a total moved."""
+  now=now or time.time()
+  with _acct_lock:
+    mm=_acct_open(); slots=_acct["slots"]
+    _acct_advance(mm, now)
+    idx=[base+int(now//step)%n for base,(_,step,n) in zip(_ACCT_RING_BASE, ACCT_RINGS)]
+    totals={}; seen=set(); moved=False
+    for u in users:
+      name=u.get("user",""); port=str(u.get("port","") or "")
+      if not name: continue
+      key=_acct_key(name); i=slots.get(key)
+      if i is None:
+        if not _acct["free"]: continue # ring file full: raise ACCT_SLOTS
+        i=slots[key]=_acct["free"].pop(); rec=[key]+[0]*118; moved=True
+      else: rec=list(_ACCT_REC.unpack_from(mm, _acct_off(i)))
+      cur=raw.get(port)
+      if cur is not None:
+        delta=cur if rec[1]!=int(port) or cur<rec[3] else cur-rec[3]
+        rec[1]=int(port); rec[3]=cur
+        if delta:
+          rec[2]+=delta; moved=True
+          for j in idx: rec[j]+=delta
+      _ACCT_REC.pack_into(mm, _acct_off(i), *rec)
+      totals[name]=rec[2]; seen.add(key)
+    for key in [k for k in slots if k not in seen]: # deleted users give their slot back
+      i=slots.pop(key); mm[_acct_off(i):_acct_off(i+1)]=bytes(_ACCT_REC.size); _acct["free"].append(i); moved=True
+    mm.flush()
+  if moved or not os.path.exists(TRAFFIC_FILE): write_json_atomic(TRAFFIC_FILE, totals)
+  return totals
+
+def acct_history(name, res="hour"):
+  """{"total", "buckets":[[bucket_start_epoch, bytes], ...] oldest first} for one user, or None."""
+  k=[r[0] for r in ACCT_RINGS].index(res) # ValueError for an unknown resolution
+  _,step,n=ACCT_RINGS[k]
+  with _acct_lock:
+    mm=_acct_open(); i=_acct["slots"].get(_acct_key(name))
+    if i is None: return None
+    rec=_ACCT_REC.unpack_from(mm, _acct_off(i)); last=_ACCT_HDR.unpack_from(mm,0)[3+k]
+  e=int(time.time()//step)
+  return {"total":rec[2], "buckets":[[b*step, rec[_ACCT_RING_BASE[k]+b%n] if b<=last else 0] for b in range(e-n+1, e+1)]}
+
+# --- Per-user bandwidth limits (rate_down / rate_up kbps on the user record; "" = node default, "0" = unlimited) ---
+# Download: HTB class 1:<port hex> on SHAPE_DEV, picked by a mangle POSTROUTING CLASSIFY rule on the user's conntrack
+# entries (no tc filters). Upload: a hashlimit DROP policer on the original dport in mangle PREROUTING.
+# Everything is diffed and applied in bulk from the collector: one iptables-restore + one `tc -batch`.
+SHAPE_CHAIN = "ZIVPN-SHAPE"   # mangle POSTROUTING -> CLASSIFY
+POLICE_CHAIN = "ZIVPN-POLICE" # mangle PREROUTING -> hashlimit DROP
+SHAPE_DEV = os.environ.get("SHAPE_DEV", "") # egress interface; default: the one holding the default route
+SHAPE_DEFAULT_DOWN = os.environ.get("SHAPE_DEFAULT_DOWN", "0") # node-wide default kbps, 0 = unlimited
+SHAPE_DEFAULT_UP = os.environ.get("SHAPE_DEFAULT_UP", "0")
+RATE_RE = re.compile(r"\d{1,7}")
+
+def user_rates(u):
+  """(down_kbps, up_kbps) after applying the node defaults; 0 = unlimited."""
+  out=[]
+  for k,dflt in (("rate_down",SHAPE_DEFAULT_DOWN), ("rate_up",SHAPE_DEFAULT_UP)):
+    v=str(u.get(k,"") or "").strip()
+    out.append(int(v) if RATE_RE.fullmatch(v) else int(dflt) if RATE_RE.fullmatch(str(dflt)) else 0)
+  return tuple(out)
+
+def shape_dev():
+  if SHAPE_DEV: return SHAPE_DEV
+  m=re.search(r"\bdev (\S+)", run(["ip","route","show","default"]).stdout)
+  return m.group(1) if m else ""
+
+def desired_shaping(users):
+  """({comment: rule} for both chains, {class minor hex: down kbps})."""
+  rules={}; classes={}
   for u in users:
     port=str(u.get("port","") or "")
-    ip=(u.get("bind_ip","") or "").strip()
-    if port and ip: ensure_limit_rules(port, ip)
-    elif port and not ip: remove_limit_rules(port)
+    if not port.isdigit(): continue
+    down,up=user_rates(u)
+    if down:
+      minor=f"{int(port):x}"; classes[minor]=down; tag=f"shape:{port}:{down}"
+      rules[tag]=(f'-A {SHAPE_CHAIN} -p udp -m conntrack --ctorigdstport {port} --ctdir REPLY '
+                  f'-m comment --comment "{tag}" -j CLASSIFY --set-class 1:{minor}')
+    if up:
+      tag=f"police:{port}:{up}"
+      rules[tag]=(f'-A {POLICE_CHAIN} -p udp -m udp --dport {port} -m comment --comment "{tag}" '
+                  f'-m hashlimit --hashlimit-above {up*125}b/s --hashlimit-name zup{port} -j DROP')
+  return rules, classes
+
+def _tc_kbit(s):
+  m=re.fullmatch(r"([\d.]+)([KMG]?)bit", s or "")
+  return int(round(float(m.group(1))*{"":0.001,"K":1,"M":1000,"G":1000000}[m.group(2)])) if m else 0
+
+def apply_shaping(users, dump=None):
+  """Reconcile classifier/policer rules and HTB classes. Returns {"rules":(+,-), "classes":(+,-)}."""
+  rules,classes=desired_shaping(users)
+  have=set(); jumped=set()
+  if dump is None: dump=iptables_save("mangle")
+  for line in dump.splitlines():
+    m=re.match(rf"-A ({SHAPE_CHAIN}|{POLICE_CHAIN}) .*--comment \"?((?:shape|police):\d+:\d+)", line)
+    if m: have.add(m.group(2))
+    elif re.match(rf"-A (PREROUTING|POSTROUTING) .*-j ({SHAPE_CHAIN}|{POLICE_CHAIN})$", line): jumped.add(line.split()[1])
+  if have!=rules.keys() or (rules and jumped!={"PREROUTING","POSTROUTING"}):
+    payload=["*mangle", f":{SHAPE_CHAIN} - [0:0]", f":{POLICE_CHAIN} - [0:0]"]
+    if "PREROUTING" not in jumped: payload.append(f"-A PREROUTING -p udp -j {POLICE_CHAIN}")
+    if "POSTROUTING" not in jumped: payload.append(f"-A POSTROUTING -p udp -j {SHAPE_CHAIN}")
+    payload+=list(rules.values())+["COMMIT"]
+    iptables_restore("\n".join(payload)+"\n")
+  res={"rules":(len(rules.keys()-have), len(have-rules.keys())), "classes":(0,0)}
+  dev=shape_dev()
+  if not dev: return res
+  tc=run_many({"qdisc":["tc","qdisc","show","dev",dev], "class":["tc","class","show","dev",dev]})
+  root="qdisc htb 1: root" in tc["qdisc"].stdout
+  if not classes and not root: return res # never shaped on this node: leave the interface qdisc alone
+  cur={}
+  for line in tc["class"].stdout.splitlines():
+    m=re.match(r"class htb 1:([0-9a-f]+) .*?\brate (\S+)", line)
+    if m: cur[m.group(1)]=_tc_kbit(m.group(2))
+  ops=[] if root else [f"qdisc replace dev {dev} root handle 1: htb default 0"] # unclassified traffic is not shaped
+  for minor,kbit in classes.items():
+    if cur.get(minor)!=kbit:
+      ops.append(f"class replace dev {dev} parent 1: classid 1:{minor} htb rate {kbit}kbit ceil {kbit}kbit")
+      if minor not in cur: ops.append(f"qdisc replace dev {dev} parent 1:{minor} fq_codel")
+  ops+=[f"class del dev {dev} classid 1:{minor}" for minor in cur.keys()-classes.keys()]
+  if ops:
+    r=run(["tc","-force","-batch","-"], input="\n".join(ops)+"\n")
+    if r.returncode!=0: print(f"[shaping] tc batch failed: {r.stderr.strip()}", flush=True)
+  res["classes"]=(sum(cur.get(m)!=k for m,k in classes.items()), len(cur.keys()-classes.keys()))
+  return res
+
+# --- Per-user data quotas (quota = bytes on the user record). One xt_quota rule per user in a chain jumped to from
+# both PREROUTING and POSTROUTING, matched on the conntrack original dport: upload and download drain the same
+# in-kernel counter and traffic is dropped the moment it runs out. usage = acct total - quota_base. ---
+QUOTA_CHAIN = "ZIVPN-QUOTA"
+BYTES_RE = re.compile(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", re.I)
+
+def parse_bytes(s):
+  """'10G', '500m', '1.5GB', '1048576' -> bytes (binary units); '' -> 0. ValueError otherwise."""
+  m=BYTES_RE.fullmatch((s or "0").strip())
+  if not m: raise ValueError(s)
+  return int(float(m.group(1))*1024**"_KMGT".index(m.group(2).upper() or "_"))
+
+def fmt_quota(n):
+  """Exact, editable form of a byte count: 10G, 512M, or plain bytes."""
+  n=int(n or 0)
+  for k,unit in ((4,"T"),(3,"G"),(2,"M"),(1,"K")):
+    if n and n%1024**k==0: return f"{n//1024**k}{unit}"
+  return str(n) if n else ""
+
+def set_quota(u, quota_bytes, traffic):
+  """Apply a new quota to record u; a changed quota restarts usage from the current total."""
+  if quota_bytes==int(u.get("quota") or 0): return
+  u["quota"]=str(quota_bytes) if quota_bytes else ""
+  u["quota_base"]=str(int(traffic.get(u.get("user",""),0) or 0)) if quota_bytes else ""
+  u["quota_exhausted"]=""
+
+def quota_used(u, traffic):
+  return max(int(traffic.get(u.get("user",""),0) or 0)-int(u.get("quota_base") or 0), 0)
+
+def quota_marks(users, traffic):
+  """[(user, None), ...] whose quota_exhausted flag has to flip (set when used >= quota, cleared when topped up)."""
+  out=[]
+  for u in users:
+    q=int(u.get("quota") or 0)
+    over=bool(q) and quota_used(u, traffic)>=q
+    if over!=bool(u.get("quota_exhausted")):
+      u["quota_exhausted"]=datetime.now().strftime("%Y-%m-%d %H:%M") if over else ""
+      out.append((u, None))
+  return out
+
+def apply_quotas(users, traffic, dump=None):
+  """Reconcile ZIVPN-QUOTA. Rules are (re)written with quota - used; untouched rules keep draining in the kernel."""
+  want={}
+  for u in users:
+    q=int(u.get("quota") or 0); port=str(u.get("port","") or "")
+    if not (q and port.isdigit()): continue
+    tag=f"quota:{port}:{q}:{int(u.get('quota_base') or 0)}"
+    left=max(q-quota_used(u, traffic), 0)
+    want[tag]=[f'-A {QUOTA_CHAIN} -p udp -m conntrack --ctorigdstport {port} -m comment --comment "{tag}" -m quota --quota {left} -j RETURN',
+               f'-A {QUOTA_CHAIN} -p udp -m conntrack --ctorigdstport {port} -m comment --comment "{tag}" -j DROP']
+  have=set(); jumped=set()
+  if dump is None: dump=iptables_save("mangle")
+  for line in dump.splitlines():
+    m=re.match(rf"-A {QUOTA_CHAIN} .*--comment \"?(quota:[\d:]+)", line)
+    if m: have.add(m.group(1))
+    elif re.match(rf"-A (PREROUTING|POSTROUTING) .*-j {QUOTA_CHAIN}$", line): jumped.add(line.split()[1])
+  if have!=want.keys() or (want and jumped!={"PREROUTING","POSTROUTING"}):
+    payload=["*mangle", f":{QUOTA_CHAIN} - [0:0]"]
+    payload+=[f"-A {hook} -p udp -j {QUOTA_CHAIN}" for hook in ("PREROUTING","POSTROUTING") if hook not in jumped]
+    payload+=[r for rules in want.values() for r in rules]+["COMMIT"]
+    iptables_restore("\n".join(payload)+"\n")
+  return {"added":len(want.keys()-have), "removed":len(have-want.keys())}
+
+# --- Background state collector: page requests only read the latest snapshot ---
+_state={"version":0, "at":0.0, "conntrack":{}, "firewall":{}, "udp_listen":set(), "listen_port":LISTEN_FALLBACK, "bind_ips":{}}
+_state_cv=threading.Condition()
+_state_wake=threading.Event()
+_collector=None
+
+def collect_state():
+  """One collection cycle: conntrack + ss dump, auto-lock, firewall limits. Publishes a new snapshot.
+  All read-only queries run concurrently up front; every reconciler then parses the same mangle dump."""
+  global _state
+  t0=time.perf_counter()
+  users=load_users()
+  listing=not _presence["alive"] or time.time()-_presence["synced"]>=PRESENCE_RESYNC
+  q=run_many({"ss":["ss","-uHln"], "mangle":["iptables-save","-c","-t","mangle"],
+              "filter":["iptables-save","-t","filter"], "service":["systemctl","is-active","zivpn.service"],
+              **({"ct":CONNTRACK_CMD} if listing else {}), **({"ipset":["ipset","save"]} if LOCK_BACKEND=="ipset" else {})})
+  if listing and q["ct"].returncode==0: presence_sync(q["ct"].stdout) # a timed-out listing keeps the last view
+  listen_port=get_listen_port_from_config()
+  ct,last_seen=presence_index({str(u["port"]):u["user"] for u in users if u.get("port")})
+  locked=[]
+  for u in users:
+    if u.get("port") and not u.get("bind_ip") and str(u["port"]) in ct:
+      ip=first_recent_src_ip(u["port"], ct)
+      if ip: u["bind_ip"]=ip; locked.append(u)
+  if locked: patch_users({u["user"]:{"bind_ip":u["bind_ip"]} for u in locked})
+  if q["mangle"].returncode==0 and q["filter"].returncode==0:
+    mangle=uncounted(q["mangle"].stdout)
+    fw=apply_device_limits(users, {"mangle":mangle, "filter":q["filter"].stdout, "ipset":q["ipset"].stdout if "ipset" in q else None})
+    traffic=acct_sample(users, acct_counters(users, q["mangle"].stdout))
+    marks=quota_marks(users, traffic)
+    if marks: patch_users({u["user"]:{"quota_exhausted":u["quota_exhausted"]} for u,_ in marks})
+    quotas=apply_quotas(users, traffic, mangle)
+    shaping=apply_shaping(users, mangle)
+    rules=rule_counts(mangle, q["filter"].stdout, q["ipset"].stdout if "ipset" in q else "")
+  else: # no trustworthy dump: reconciling against it would re-add every jump rule
+    print(f"[collector] iptables-save failed, firewall left as is: {(q['mangle'].stderr or q['filter'].stderr).strip()}", flush=True)
+    fw=_state["firewall"]; traffic=get_traffic_data(); quotas=_state.get("quotas",{}); shaping=_state.get("shaping",{})
+    rules=_state.get("rules",{})
+  listen=udp_listen_ports(q["ss"].stdout)
+  live=live_rows(users, listen_port, ct, traffic)
+  online_sig=zlib.crc32(",".join(sorted(ct)).encode()) # changes only when the set of active ports does
+  seen_sig=zlib.crc32(repr(sorted((p,int(t)//60) for p,t in last_seen.items())).encode()) # last_seen at the minute the rows show
+  now=time.time()
+  same=(online_sig, seen_sig)==(_state.get("online_sig"), _state.get("seen_sig"))
+  snap={"version":_state["version"]+1, "at":now, "conntrack":ct, "firewall":fw,
+        "online_sig":online_sig, "seen_sig":seen_sig, "changed_at":_state.get("changed_at",0) if same else now,
+        "udp_listen":listen, "listen_port":listen_port, "ports":check_ports(listen),
+        "bind_ips":{u["user"]:u["bind_ip"] for u in users if u.get("bind_ip")}, "live":live, "shaping":shaping, "quotas":quotas, "rules":rules,
+        "last_seen":last_seen, "presence":"events" if _presence["alive"] else "poll",
+        "service":q["service"].stdout.strip() or "unknown", "collect_ms":round((time.perf_counter()-t0)*1000), "commands":cmd_stats()}
+  with _state_cv:
+    publish_live(snap, _state)
+    _state=snap
+    _state_cv.notify_all()
+  return snap
+
+def rule_counts(*dumps):
+  """{chain or set: entries} of the panel's ZIVPN-* chains and zivpn-* ipsets, as of this cycle's dumps (before reconciling)."""
+  c=collections.Counter()
+  for dump in dumps:
+    for line in (dump or "").splitlines():
+      if line.startswith("-A ZIVPN") or line.startswith("add zivpn-"): c[line.split(None, 2)[1]]+=1
+  return dict(c)
+
+# --- Live push: the collector diffs per-user status between snapshots; /events fans the diffs out over SSE ---
+SSE_KEEPALIVE = 20 # seconds between keepalive comments on an idle stream
+SSE_MAX_CLIENTS = int(os.environ.get("SSE_MAX_CLIENTS", "20")) # per process; serve() lowers it to WEB_THREADS-2 under gunicorn
+_events = collections.deque(maxlen=64) # (state version, json diff); guarded by _state_cv
+_events_floor = [0] # newest version already evicted from _events
+_sse_clients = [0] # open /events streams in this worker; checked and counted together under _sse_lock
+_sse_lock = threading.Lock()
+_sse_cap = [SSE_MAX_CLIENTS] # effective per-process limit
+
+def live_rows(users, listen_port, ct, traffic):
+  """{user: (status, traffic_bytes, bind_ip)} — the part of a row the page patches in place."""
+  return {u["user"]:(status_for_user(u, listen_port, ct), int(traffic.get(u["user"],0) or 0), u.get("bind_ip",""))
+          for u in users if u.get("user")}
+
+def live_diff(old, new):
+  """Status transitions, traffic deltas, new bind IPs and removed users between two live_rows() maps."""
+  changes=[]
+  for name,row in new.items():
+    o=old.get(name)
+    if o==row: continue
+    d={"user":name}
+    if not o or o[0]!=row[0]: d["status"]=row[0]
+    if not o or o[1]!=row[1]: d["traffic"]=bytes_to_human(row[1]); d["traffic_delta"]=row[1]-(o[1] if o else 0)
+    if not o or o[2]!=row[2]: d["bind_ip"]=row[2]
+    changes.append(d)
+  return changes, [n for n in old if n not in new]
+
+def sse_stream(last):
+  """One subscriber: waits on the shared snapshot condition and replays queued diffs; never queries anything itself."""
+  yield "retry: 5000\n\n"
+  while True:
+    with _state_cv:
+      _state_cv.wait_for(lambda: _state["version"]!=last, timeout=SSE_KEEPALIVE)
+      cur=_state["version"]; evs=[e for e in _events if e[0]>last]
+    if cur==last:
+      yield ": keepalive\n\n"; continue
+    if last and (last<_events_floor[0] or last>cur): # fell behind the ring buffer, or an id from before a panel restart
+      yield f"id: {cur}\nevent: reset\ndata: {{}}\n\n" # reload the page
+      last=cur; continue
+    for v,data in evs: yield f"id: {v}\nevent: diff\ndata: {data}\n\n"
+    last=cur
+
+def publish_live(snap, prev):
+  """Called by the collector with _state_cv held: queue the diff against the previous snapshot."""
+  if not prev.get("version"): return # first snapshot: nothing to diff against
+  changes,removed=live_diff(prev.get("live",{}), snap["live"])
+  if not (changes or removed): return
+  if len(_events)==_events.maxlen: _events_floor[0]=_events[0][0]
+  _events.append((snap["version"], json.dumps({"changes":changes, "removed":removed,
+                  "online":sum(r[0]=="Online" for r in snap["live"].values())})))
+
+def _collector_loop():
+  threading.Thread(target=_expiry_loop, name="expiry", daemon=True).start()
+  if PRESENCE=="events": threading.Thread(target=_presence_loop, name="presence", daemon=True).start()
+  if FLEET_URL: threading.Thread(target=_fleet_loop, name="fleet", daemon=True).start()
+  while True:
+    try:
+      snap=collect_state()
+      if WEB_WORKERS>1: share_state(snap)
+    except Exception as e: print(f"[collector] {e}", flush=True)
+    wait_for_wake(STATE_INTERVAL)
+
+def start_collector():
+  """Start this process's collector, or, when another worker already leads, a mirror of its snapshots."""
+  global _collector
+  with _state_cv:
+    if _collector is None:
+      lead=WEB_WORKERS<=1 or try_lead()
+      _collector=threading.Thread(target=_collector_loop if lead else _mirror_loop,
+                                  name="state-collector" if lead else "state-mirror", daemon=True)
+      _collector.start()
+
+def get_state(wait=5.0):
+  """Latest snapshot; only the very first call after startup blocks until the collector has run once."""
+  start_collector()
+  with _state_cv:
+    if _state["version"]==0: _state_cv.wait_for(lambda: _state["version"]>0, timeout=wait)
+    return _state
+
+def request_refresh(wait=0):
+  """Wake the collector early (after a mutation / Scan). Optionally wait for the new snapshot."""
+  seen=_state["version"]
+  _state_wake.set(); _expiry_wake.set()
+  if WEB_WORKERS>1 and not _leader["lock"]:
+    try: os.utime(STATE_FILE+".wake", None)
+    except OSError: open(STATE_FILE+".wake", "a").close()
+  if wait:
+    with _state_cv: _state_cv.wait_for(lambda: _state["version"]>seen, timeout=wait)
+
+# --- Serving: WEB_WORKERS>1 runs gunicorn; one worker (flock leader) collects, the rest mirror its STATE_FILE ---
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", "1")) # processes; 1 = single process (dev server if gunicorn is missing)
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "8")) # request threads per process (SSE viewers hold one each)
+STATE_FILE = os.environ.get("STATE_FILE", "/run/zivpn/web-state.pickle")
+_leader={"lock":None, "fh":None, "wake":0}
+
+def try_lead():
+  """Take the collector role unless another worker holds it; the flock goes away with the process that held it."""
+  if _leader["lock"]: return True
+  if _leader["fh"] is None:
+    os.makedirs(os.path.dirname(STATE_FILE) or ".", exist_ok=True)
+    _leader["fh"]=open(STATE_FILE+".lock", "a")
+  try: fcntl.flock(_leader["fh"], fcntl.LOCK_EX|fcntl.LOCK_NB)
+  except OSError: return False
+  _leader["lock"]=_leader["fh"]
+  try: _leader["wake"]=os.stat(STATE_FILE+".wake").st_mtime_ns # only touches from now on wake the collector
+  except OSError: pass
+  print(f"[serve] pid {os.getpid()} collects for all workers", flush=True)
+  return True
+
+def share_state(snap):
+  """Leader: publish the snapshot for the other workers (atomic replace)."""
+  fd,tmp=tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(STATE_FILE) or ".")
+  try:
+    with os.fdopen(fd,"wb") as f: pickle.dump(snap, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, STATE_FILE)
+  finally:
+    try: os.remove(tmp)
+    except OSError: pass
+
+def wait_for_wake(timeout):
+  """Collector sleep; in multi-worker mode a follower's request_refresh() touches STATE_FILE.wake to end it early."""
+  if WEB_WORKERS<=1:
+    _state_wake.wait(timeout); _state_wake.clear(); return
+  end=time.time()+timeout
+  while time.time()<end and not _state_wake.wait(min(1, max(end-time.time(), 0))):
+    try: m=os.stat(STATE_FILE+".wake").st_mtime_ns
+    except OSError: continue
+    if m!=_leader["wake"]:
+      _leader["wake"]=m; _expiry_wake.set(); break
+  _state_wake.clear()
+
+def _mirror_loop():
+  """Follower: load each new STATE_FILE into _state (and the SSE ring) until the leader goes away, then lead."""
+  global _state
+  seen=None
+  while not try_lead():
+    try:
+      st=os.stat(STATE_FILE); sig=(st.st_ino, st.st_mtime_ns)
+      if sig!=seen:
+        with open(STATE_FILE,"rb") as f: snap=pickle.load(f)
+        seen=sig
+        with _state_cv:
+          if snap["version"]!=_state["version"]:
+            if not _state["version"]: _events_floor[0]=snap["version"] # joined mid-stream: nothing before this is in the ring
+            publish_live(snap, _state); _state=snap; _state_cv.notify_all()
+    except (OSError, EOFError, pickle.UnpicklingError): pass
+    time.sleep(0.5)
+  _collector_loop()
+
+def serve():
+  """gunicorn (gthread) with WEB_WORKERS x WEB_THREADS when asked for and installed, else the threaded dev server."""
+  if WEB_WORKERS>1:
+    try: from gunicorn.app.base import BaseApplication
+    except ImportError: print("[serve] gunicorn not installed (apt install python3-gunicorn); using one process", flush=True)
+    else:
+      class Server(BaseApplication):
+        def load_config(self):
+          for k,v in {"bind":f"0.0.0.0:{WEB_PORT}", "workers":WEB_WORKERS, "threads":WEB_THREADS,
+                      "worker_class":"gthread", "timeout":60, "graceful_timeout":5}.items(): self.cfg.set(k, v)
+          if FLEET_URL: self.cfg.set("post_worker_init", lambda worker: start_collector())
+        def load(self): return app
+      _sse_cap[0]=max(min(SSE_MAX_CLIENTS, WEB_THREADS-2), 0) # each viewer holds a gthread; keep two for forms, /api, /metrics
+      return Server().run()
+  if FLEET_URL: start_collector() # an agent node may see no page views; start pulling right away
+  app.run(host="0.0.0.0", port=int(WEB_PORT), threaded=True)
+
+# --- Expiry scheduler: a min-heap of expiry instants; one thread sleeps until the next account runs out ---
+EXPIRY_GRACE_HOURS = float(os.environ.get("EXPIRY_GRACE_HOURS", "0")) # keep expired users this long past their last day
+EXPIRY_PRUNE = os.environ.get("EXPIRY_PRUNE", "1")!="0" # "0": never remove expired users (they only show as Expired)
+EXPIRY_RECHECK = 300 # max sleep, so store edits made outside this process are picked up
+_expiry={"heap":[], "version":None, "removed":0}
+_expiry_wake=threading.Event()
+
+def expiry_due(expires):
+  """Epoch seconds when a YYYY-MM-DD expiry (valid through that day) plus the grace period runs out; None if unset/bad."""
+  try: d=datetime.strptime(expires or "", "%Y-%m-%d")
+  except ValueError: return None
+  return (d+timedelta(days=1, hours=EXPIRY_GRACE_HOURS)).timestamp()
+
+def _expiry_heap():
+  """(due, user) min-heap, rebuilt only when the store changed since the last build."""
+  v=store_version()
+  if v!=_expiry["version"]:
+    heap=[(t, u["user"]) for u in load_users() for t in (expiry_due(u.get("expires")),) if t and u.get("user")]
+    heapq.heapify(heap)
+    _expiry["heap"]=heap; _expiry["version"]=v
+  return _expiry["heap"]
+
+def prune_expired(now=None):
+  """Remove every user past expiry + grace in one store write, then one firewall pass and one config sync."""
+  now=now or time.time()
+  with store_locked(): # decide and delete under one lock, so an expiry extended meanwhile is honoured
+    gone=delete_users([u["user"] for u in load_users() if u.get("user") and (expiry_due(u.get("expires")) or float("inf"))<=now])
+  if not gone: return []
+  ports=[("", u["port"]) for u in gone if u.get("port")]
+  if ports: claim_ports(ports)
+  apply_device_limits(load_users())
+  sync_config_passwords(mode="mirror")
+  _expiry["removed"]+=len(gone)
+  print(f"[expiry] removed {len(gone)}: {', '.join(u['user'] for u in gone[:20])}", flush=True)
+  request_refresh()
+  return gone
+
+def _expiry_loop():
+  while True:
+    wait=EXPIRY_RECHECK
+    try:
+      heap=_expiry_heap(); now=time.time()
+      if heap and heap[0][0]<=now:
+        while heap and heap[0][0]<=now: heapq.heappop(heap)
+        if EXPIRY_PRUNE: prune_expired(now)
+      if heap: wait=min(wait, max(heap[0][0]-time.time(), 0.5))
+    except Exception as e: print(f"[expiry] {e}", flush=True)
+    _expiry_wake.wait(wait); _expiry_wake.clear()
 
 # ... (Auth and Config sync functions remain the same) ...
 
@@ -149,34 +1371,89 @@ def require_login():
     return False
   return True
 
-def sync_config_passwords(mode="mirror"):
-  cfg=read_json(CONFIG_FILE,{})
-  users=load_users()
-  users_pw=sorted({str(u["password"]) for u in users if u.get("password")})
-  
-  if mode=="merge":
-    old=[]
-    if isinstance(cfg.get("auth",{}).get("config",None), list):
-      old=list(map(str, cfg["auth"]["config"]))
-    new_pw=sorted(set(old)|set(users_pw))
+# --- zivpn config sync: write only when the config actually changes, restart at most once per SYNC_DEBOUNCE window ---
+# With WEB_WORKERS>1 the applied digest, the pending restart and the counters live in STATE_FILE.sync under the
+# store flock, so a restart one worker has scheduled absorbs the syncs of all the others.
+SYNC_DEBOUNCE = float(os.environ.get("SYNC_DEBOUNCE", "2"))
+SYNC_PENDING_STALE = 60 # a pending restart this far past due belonged to a worker that went away
+_sync = {"applied":None, "pending":0.0, "restarts":0, "avoided":0} # pending: when the scheduled restart is due
+_sync_lock = threading.Lock()
+
+def _cfg_digest(cfg): return json.dumps(cfg, sort_keys=True)
+
+@contextmanager
+def _sync_state():
+  """The debounce state, read-modify-written under the store lock (lock order: store, then sync)."""
+  with store_locked(), _sync_lock:
+    if WEB_WORKERS<=1: yield _sync; return
+    path=STATE_FILE+".sync"
+    st={**_sync, **read_json(path,{})}; before=dict(st)
+    yield st
+    if st!=before: write_json_atomic(path, st)
+
+def _pending(st): return bool(st["pending"]) and time.time()<st["pending"]+SYNC_PENDING_STALE
+
+def _restart_zivpn():
+  """Restart only if the file on disk differs from what the service was last (re)started with."""
+  with _sync_state() as st:
+    st["pending"]=0.0
+    cur=_cfg_digest(read_json(CONFIG_FILE,{}))
+    if cur==st["applied"]:
+      st["avoided"]+=1; return False
+    st["applied"]=cur; st["restarts"]+=1
+  run(["systemctl","restart","zivpn.service"], timeout=60)
+  return True
+
+def schedule_restart():
+  if SYNC_DEBOUNCE<=0: return _restart_zivpn()
+  with _sync_state() as st:
+    if _pending(st):
+      st["avoided"]+=1; return False # folded into the pending restart, whichever worker scheduled it
+    st["pending"]=time.time()+SYNC_DEBOUNCE
+  t=threading.Timer(SYNC_DEBOUNCE, _restart_zivpn); t.daemon=True; t.start()
+  return True
+
+def sync_stats():
+  """No lock: STATE_FILE.sync is replaced atomically."""
+  if WEB_WORKERS>1: st={**_sync, **read_json(STATE_FILE+".sync",{})}
   else:
-    new_pw=users_pw
+    with _sync_lock: st=dict(_sync)
+  return {"restarts":st["restarts"], "avoided":st["avoided"], "pending":_pending(st)}
+
+@timed("config sync")
+def sync_config_passwords(mode="mirror"):
+  """Rewrite the auth password list; returns False (no write, no restart) when nothing changed."""
+  with _sync_state() as st:
+    cfg=read_json(CONFIG_FILE,{})
+    before=_cfg_digest(cfg)
+    if st["applied"] is None: st["applied"]=before # the running service was started with this file
+    users=load_users()
+    users_pw=sorted({str(u["password"]) for u in users if u.get("password")})
     
-  if not isinstance(cfg.get("auth"),dict): cfg["auth"]={}
-  cfg["auth"]["mode"]="passwords"
-  cfg["auth"]["config"]=new_pw
-  cfg["listen"]=cfg.get("listen") or ":5667"
-  cfg["cert"]=cfg.get("cert") or "/etc/zivpn/zivpn.crt"
-  cfg["key"]=cfg.get("key") or "/etc/zivpn/zivpn.key"
-  cfg["obfs"]=cfg.get("obfs") or "zivpn"
-  write_json_atomic(CONFIG_FILE,cfg)
+    if mode=="merge":
+      old=[]
+      if isinstance(cfg.get("auth",{}).get("config",None), list):
+        old=list(map(str, cfg["auth"]["config"]))
+      new_pw=sorted(set(old)|set(users_pw))
+    else:
+      new_pw=users_pw
+      
+    if not isinstance(cfg.get("auth"),dict): cfg["auth"]={}
+    cfg["auth"]["mode"]="passwords"
+    cfg["auth"]["config"]=new_pw
+    cfg["listen"]=cfg.get("listen") or ":5667"
+    cfg["cert"]=cfg.get("cert") or "/etc/zivpn/zivpn.crt"
+    cfg["key"]=cfg.get("key") or "/etc/zivpn/zivpn.key"
+    cfg["obfs"]=cfg.get("obfs") or "zivpn"
+    if _cfg_digest(cfg)==before:
+      st["avoided"]+=1; return False
+    write_json_atomic(CONFIG_FILE,cfg)
   
-  shell("systemctl restart zivpn.service")
+  return schedule_restart()
 
 HTML = """<!doctype html>
 <html lang="my"><head><meta charset="utf-8">
 <meta name="viewport" content="width=device-width,initial-scale=1,viewport-fit=cover">
-<meta http-equiv="refresh" content="120">
 <title>ZIVPN User Panel - DEV-U PHOE KAUNT</title>
 <style>
  /* Light Theme CSS */
@@ -212,6 +1489,7 @@ HTML = """<!doctype html>
  .unk{color:#fff;background:var(--unk)}
  .locked{color:#fff;background:#3b82f6}
  .muted{color:var(--muted)}
+ .pager{display:flex;gap:10px;align-items:center;justify-content:center;margin:12px 0}
  .box{margin:14px 0;padding:16px;border:1px solid var(--bd);border-radius:12px;background:var(--card)}
  label{display:block;margin:6px 0 3px;font-size:13px;color:var(--muted);font-weight:500}
  input, select{width:100%;padding:11px 12px;border:1px solid var(--btnbd);border-radius:8px;background:#fff;color:var(--fg);box-sizing:border-box;}
@@ -341,6 +1619,9 @@ HTML = """<!doctype html>
         <div><label>သက်တမ်းကုန်ဆုံးရက် (YYYY-MM-DD)</label><input name='expires' value='{{ edit_user.expires or "" }}' placeholder='2025-12-31 or 30 (ရက်)'></div>
         <div><label>UDP Port (6000-19999)</label><input name='port' value='{{ edit_user.port or "" }}' placeholder='အလိုအလျောက် ရွေးမယ်'></div>
         <div><label>📱 ချိတ်ထားသော IP (Device Lock)</label><input name='bind_ip' value='{{ edit_user.bind_ip or "" }}' placeholder='ချိတ်ထားသည့် IP (သို့) ရှင်းလင်းထားရန်'></div>
+        <div><label>⬇️ Download limit (kbps)</label><input name='rate_down' value='{{ edit_user.rate_down or "" }}' placeholder='default {{ shape_default[0] if shape_default[0]!="0" else "unlimited" }} • 0 = unlimited'></div>
+        <div><label>⬆️ Upload limit (kbps)</label><input name='rate_up' value='{{ edit_user.rate_up or "" }}' placeholder='default {{ shape_default[1] if shape_default[1]!="0" else "unlimited" }} • 0 = unlimited'></div>
+        <div><label>📦 Data quota (10G / 500M, blank = none)</label><input name='quota' value='{{ edit_user.quota or "" }}' placeholder='unlimited'></div>
       </div>
       
       <div class="actions" style="margin-top:16px">
@@ -368,7 +1649,7 @@ HTML = """<!doctype html>
    <img src="{{ logo }}" alt="DEV-U PHOE KAUNT" style="height:40px;width:auto;border-radius:8px">
    <div style="flex:1">
      <h1>DEV-U PHOE KAUNT</h1>
-     <div class="sub">ZIVPN User Panel • Total: <span class="count">{{ total }}</span></div>
+     <div class="sub">ZIVPN User Panel • Total: <span class="count">{{ total }}</span>{% if state_version %} • Status {{ state_age }}s ago ({{ collect_ms }} ms){% endif %}{% if service and service!="active" %} • <span style="color:var(--bad)">zivpn {{ service }}</span>{% endif %}{% if sync %} • Restarts {{ sync.restarts }} (avoided {{ sync.avoided }}){% endif %}</div>
    </div>
    <div class="row">
      <a class="btn" href="https://m.me/upkvpnfastvpn" target="_blank" rel="noopener">💬 Messenger</a>
@@ -420,14 +1701,14 @@ HTML = """<!doctype html>
   </thead>
   <tbody>
   {% for u in users %}
-  <tr class="{% if u.expires and u.expires < today %}expired-row{% endif %}">
+  <tr class="{% if u.expires and u.expires < today %}expired-row{% endif %}" data-user="{{u.user}}">
     <td>{{u.user}}</td>
     <td>{{u.password}}</td>
     <td style="white-space:nowrap">{% if u.expires %}{{u.expires}}{% else %}<span class="muted">—</span>{% endif %}</td>
-    <td><span class="muted">{{ u.traffic }}</span></td>
-    <td>
+    <td class="tr"><span class="muted">{{ u.traffic }}</span>{% if u.quota %}<div class="muted" style="font-size:11px">{% if u.quota_exhausted %}<span style="color:var(--bad)">quota used up</span>{% else %}{{ u.quota_left }} left{% endif %}</div>{% endif %}</td>
+    <td class="st">
       {% if u.status == "Online" %}<span class="pill ok">Online</span>
-      {% elif u.status.startswith("Offline") %}<span class="pill bad">Offline</span>
+      {% elif u.status.startswith("Offline") %}<span class="pill bad">Offline</span>{% if u.last_seen %}<div class="muted" style="font-size:11px">seen {{ u.seen_ago }}</div>{% endif %}
       {% else %}<span class="pill unk">Unknown</span>
       {% endif %}
     </td>
@@ -442,6 +1723,33 @@ HTML = """<!doctype html>
   {% endfor %}
   </tbody>
 </table>
+{% if pages > 1 %}
+<div class="pager">
+  {% if page > 1 %}<a class="btn btn-primary" href="{{ url_for('index', filter=filter_type, page=page-1) }}">‹ Prev</a>{% endif %}
+  <span class="muted">{{ page }} / {{ pages }} ({{ matched }})</span>
+  {% if page < pages %}<a class="btn btn-primary" href="{{ url_for('index', filter=filter_type, page=page+1) }}">Next ›</a>{% endif %}
+</div>
+{% endif %}
+<script>
+// live status: patch rows in place from /events diffs; plain reload every 120s without EventSource
+(function(){
+  if(!window.EventSource){ setTimeout(function(){ location.reload(); }, 120000); return; }
+  var es=new EventSource("{{ url_for('events', since=state_version) }}");
+  function row(u){ return document.querySelector('tr[data-user="'+CSS.escape(u)+'"]'); }
+  es.addEventListener('diff', function(e){
+    var d=JSON.parse(e.data);
+    d.changes.forEach(function(c){
+      var r=row(c.user); if(!r) return;
+      if(c.status) r.querySelector('.st').innerHTML = c.status=="Online" ? '<span class="pill ok">Online</span>' : '<span class="pill bad">Offline</span>';
+      if(c.traffic) r.querySelector('.tr span').textContent=c.traffic;
+    });
+    d.removed.forEach(function(u){ var r=row(u); if(r) r.remove(); });
+    document.getElementById('online-count').textContent=d.online;
+  });
+  es.addEventListener('reset', function(){ location.reload(); });
+  es.onerror=function(){ if(es.readyState===2) setTimeout(function(){ location.reload(); }, 120000); }; // refused (503): poll
+})();
+</script>
 
 {% endif %}
 </div>
@@ -454,19 +1762,84 @@ HTML = """<!doctype html>
             <a href="{{ url_for('index', filter='expired') }}" class="nav-link {% if filter_type == 'expired' %}active{% endif %}">⏰ သက်တမ်းကုန် ({{ expired_count }})</a>
         </div>
         <div class="nav-item">
-            <a href="{{ url_for('index', filter='online') }}" class="nav-link {% if filter_type == 'online' %}active{% endif %}">🟢 Online ({{ online_count }})</a>
+            <a href="{{ url_for('index', filter='online') }}" class="nav-link {% if filter_type == 'online' %}active{% endif %}">🟢 Online (<span id="online-count">{{ online_count }}</span>)</a>
         </div>
     </div>
 </footer>
 {% endif %}
 </body></html>
 """
+PAGE = app.jinja_env.from_string(HTML) # compiled once at startup, not per request
+
+# --- Per-user view rows, shared by the dashboard and /api/v1/users ---
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "50")) # dashboard rows per page
+_rows_cache = {"key":None, "rows":[], "keys":[], "online":0, "expired":0}
+_rows_lock = threading.Lock()
+
+class UserRow:
+  """One dashboard/API row. __slots__: no per-row class or __dict__, just a fixed-size record."""
+  __slots__=("user","password","expires","port","bind_ip","status","expired","traffic_bytes","key",
+             "quota","quota_used","quota_exhausted","last_seen")
+  def __init__(self, u, status, today, traffic_bytes=0, last_seen=0):
+    self.user=u.get("user",""); self.password=u.get("password",""); self.expires=u.get("expires","")
+    self.port=u.get("port",""); self.bind_ip=u.get("bind_ip",""); self.status=status
+    self.expired=bool(self.expires and self.expires<today); self.traffic_bytes=int(traffic_bytes or 0)
+    self.key=self.user.lower()
+    self.quota=int(u.get("quota") or 0); self.quota_exhausted=u.get("quota_exhausted","")
+    self.quota_used=max(self.traffic_bytes-int(u.get("quota_base") or 0), 0) if self.quota else 0
+    self.last_seen=int(last_seen or 0)
+  @property
+  def traffic(self): return bytes_to_human(self.traffic_bytes)
+  @property
+  def seen_ago(self):
+    if not self.last_seen: return ""
+    d=max(int(time.time())-self.last_seen, 0)
+    return f"{d//86400}d ago" if d>=86400 else f"{d//3600}h ago" if d>=3600 else f"{d//60}m ago" if d>=60 else "just now"
+  @property
+  def quota_left(self): return bytes_to_human(max(self.quota-self.quota_used, 0))
+  def as_dict(self, fields): return {k:getattr(self,k) for k in fields}
+
+def _mtime(path):
+  try: return os.stat(path).st_mtime
+  except OSError: return 0
+
+def view_key(st):
+  """Everything a user row depends on: store, online port set, last_seen minutes, listen port, traffic file and today's date."""
+  return (store_version(), st.get("online_sig"), st.get("seen_sig"), st["listen_port"], _mtime(TRAFFIC_FILE),
+          datetime.now().strftime("%Y-%m-%d"))
+
+def user_rows(st):
+  """Sorted per-user rows (+ keys and counts) for a snapshot; rebuilt only when view_key() changed."""
+  key=view_key(st)
+  with _rows_lock:
+    if _rows_cache["key"]!=key:
+      traffic=get_traffic_data(); today=key[-1]; lp=st["listen_port"]; ct=st["conntrack"]; seen=st.get("last_seen",{})
+      rows=[UserRow(u, status_for_user(u, lp, ct), today, traffic.get(u.get("user"),0), seen.get(str(u.get("port","")),0))
+            for u in load_users()]
+      rows.sort(key=attrgetter("key"))
+      _rows_cache.update(key=key, rows=rows, keys=[r.key for r in rows],
+                         online=sum(r.status=="Online" for r in rows), expired=sum(r.expired for r in rows))
+    return dict(_rows_cache)
+
+def render_page(**ctx):
+  """Stream the precompiled PAGE template; the header and KPIs reach the client before the user list renders."""
+  app.update_template_context(ctx)
+  out=PAGE.stream(**ctx); out.enable_buffering(16)
+  def chunks(): # rendering happens while the response is sent: time the template's own steps, not the socket writes
+    it=iter(out); spent=0.0
+    try:
+      while True:
+        t=time.perf_counter(); chunk=next(it, None); spent+=time.perf_counter()-t
+        if chunk is None: return
+        yield chunk
+    finally: observe("render", spent)
+  return Response(stream_with_context(chunks()), mimetype="text/html")
 
 def build_view(msg="", err="", info_user=None, edit_user_data=None):
   # Handle special pages first
   if info_user:
     today=datetime.now().strftime("%Y-%m-%d")
-    return render_template_string(HTML, info_page=True, info={
+    return render_page(info_page=True, info={
         "user":info_user["user"],
         "password":info_user["password"],
         "expires":info_user["expires"] or today,
@@ -475,78 +1848,105 @@ def build_view(msg="", err="", info_user=None, edit_user_data=None):
     })
   
   if edit_user_data:
-      return render_template_string(HTML, edit_page=True, edit_user=edit_user_data, msg=msg, err=err)
+      return render_page(edit_page=True, edit_user=edit_user_data, msg=msg, err=err,
+                         shape_default=(SHAPE_DEFAULT_DOWN, SHAPE_DEFAULT_UP))
 
   if not require_login():
-    return render_template_string(HTML, authed=False, logo=LOGO_URL, err=session.pop("login_err", None))
+    return render_page(authed=False, logo=LOGO_URL, err=session.pop("login_err", None))
   
-  users=load_users()
-  traffic_data = get_traffic_data()
-  changed=False
-  today_str=datetime.now().strftime("%Y-%m-%d")
-  listen_port=get_listen_port_from_config()
-  
-  processed_users = []
-  online_count = 0
-  expired_count = 0
-  
-  for u in users:
-    current_status = status_for_user(u, listen_port)
-    is_online = (current_status == "Online")
-    is_expired = (u.get("expires") and u["expires"] < today_str)
-    
-    # Auto-Lock logic
-    if u.get("port") and not u.get("bind_ip") and is_online:
-        ip=first_recent_src_ip(u["port"])
-        if ip:
-            u["bind_ip"]=ip
-            changed=True
-    
-    if is_online: online_count += 1
-    if is_expired: expired_count += 1
-    
-    # Get Traffic Data
-    traffic_bytes = traffic_data.get(u.get("user"), 0)
-    traffic_human = bytes_to_human(traffic_bytes)
-    
-    processed_users.append(type("U",(),{
-      "user":u.get("user",""),
-      "password":u.get("password",""),
-      "expires":u.get("expires",""),
-      "port":u.get("port",""),
-      "bind_ip":u.get("bind_ip",""),
-      "status":current_status,
-      "traffic":traffic_human # New field
-    }))
-    
-  if changed: save_users(users)
-  apply_device_limits(users)
+  st=get_state()
+  v=user_rows(st)
+  today_str=v["key"][-1]
   
-  # Filtering Logic
+  # Filtering Logic (server-side, before paging; no intermediate list copies)
   filter_type = request.args.get('filter', 'all')
+  rows=v["rows"]
+  keep={"online":lambda r: r.status=="Online", "expired":attrgetter("expired")}.get(filter_type)
+  matched=sum(1 for r in rows if keep(r)) if keep else len(rows)
   
-  if filter_type == 'online':
-      view = [u for u in processed_users if u.status == "Online"]
-  elif filter_type == 'expired':
-      view = [u for u in processed_users if u.expires and u.expires < today_str]
-  else: # 'all'
-      view = processed_users
-  
-  view.sort(key=lambda x:(x.user or "").lower())
+  pages=max(1, -(-matched//PAGE_SIZE))
+  try: page=min(max(int(request.args.get("page") or 1),1), pages)
+  except ValueError: page=1
+  start=(page-1)*PAGE_SIZE
+  view=itertools.islice(filter(keep, rows) if keep else rows, start, start+PAGE_SIZE)
   
-  return render_template_string(HTML, authed=True, logo=LOGO_URL, users=view, msg=msg, err=err, 
-                                today=today_str, total=len(users), 
-                                filter_type=filter_type, 
-                                online_count=online_count, 
-                                expired_count=expired_count)
+  return render_page(authed=True, logo=LOGO_URL, users=view, msg=msg, err=err, 
+                     today=today_str, total=len(v["rows"]), 
+                     filter_type=filter_type, page=page, pages=pages, matched=matched,
+                     online_count=v["online"], 
+                     expired_count=v["expired"],
+                     state_age=int(time.time()-st["at"]), state_version=st["version"],
+                     collect_ms=st.get("collect_ms", 0), service=st.get("service", ""), sync=sync_stats())
+
+# --- Per-request timing: breakdown of every request, slow-request log, optional cProfile sample ---
+_slow = collections.deque(maxlen=50) # most recent first
+_profiles = collections.deque(maxlen=5)
+_profile_lock = threading.Lock() # one profiler at a time
+
+@app.before_request
+def _request_start():
+  _request_done(None) # whatever a failed request on this thread left behind
+  _tl.parts={}; _tl.t0=time.perf_counter(); _tl.prof=None
+  if PROFILE_REQUESTS and request.args.get("profile")=="1" and require_login() and _profile_lock.acquire(blocking=False):
+    _tl.prof=cProfile.Profile(); _tl.prof.enable()
+
+@app.after_request
+def _request_timed(resp):
+  info=(request.method, request.full_path.rstrip("?"), request.endpoint)
+  resp.call_on_close(lambda: _request_done(info)) # after a streamed page has been fully sent, so rendering counts
+  return resp
+
+@app.teardown_request
+def _request_failed(exc):
+  if exc is not None: _request_done(None)
+
+def _request_done(info):
+  """Close out this thread's request timing; info=(method, path, endpoint), or None to just discard it."""
+  parts=getattr(_tl, "parts", None)
+  if parts is None: return
+  _tl.parts=None; dt=time.perf_counter()-_tl.t0; ms=dt*1000
+  prof=_tl.prof; _tl.prof=None
+  if prof:
+    prof.disable(); _profile_lock.release()
+    if info:
+      out=io.StringIO(); pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(40)
+      _profiles.appendleft({"at":int(time.time()), "path":info[1], "ms":round(ms, 1), "stats":out.getvalue()})
+  if not info or info[2]=="events": return # SSE streams stay open by design
+  method, path, endpoint = info
+  observe("request "+(endpoint or "-"), dt)
+  if SLOW_REQUEST_MS and ms>=SLOW_REQUEST_MS:
+    parts=sorted(parts.items(), key=lambda kv:-kv[1][0])
+    _slow.appendleft({"at":int(time.time()), "method":method, "path":path, "ms":round(ms, 1),
+                      "parts":{k:{"ms":round(t*1000, 1), "calls":n} for k,(t,n) in parts}})
+    print(f"[slow] {method} {path} {ms:.0f} ms: "
+          +(", ".join(f"{k} {t*1000:.0f} ms"+(f" x{n}" if n>1 else "") for k,(t,n) in parts) or "no instrumented work"), flush=True)
 
 # --- Routes (mostly remain the same, ensuring filter is preserved on refresh/redirect) ---
 
 @app.route("/refresh_status", methods=["POST"])
 def refresh_status():
     if not require_login(): return redirect(url_for('login'))
+    request_refresh(wait=10)
     return redirect(url_for('index', filter=request.args.get('filter', 'all')))
 
+@app.route("/events", methods=["GET"])
+def events():
+  """SSE stream of per-user diffs; every tab shares the collector's snapshots, none triggers queries."""
+  if not require_login(): return make_response("login required", 401)
+  st=get_state()
+  try: last=int(request.headers.get("Last-Event-ID") or request.args.get("since") or st["version"])
+  except ValueError: last=st["version"]
+  with _sse_lock:
+    if _sse_clients[0]>=_sse_cap[0]: return make_response("too many live viewers", 503) # the page falls back to polling
+    _sse_clients[0]+=1
+  resp=Response(sse_stream(last), mimetype="text/event-stream")
+  resp.call_on_close(_sse_release) # also runs when the client goes away before the stream started
+  resp.headers["Cache-Control"]="no-cache"; resp.headers["X-Accel-Buffering"]="no"
+  return resp
+
+def _sse_release():
+  with _sse_lock: _sse_clients[0]-=1
+
 @app.route("/login", methods=["GET","POST"])
 def login():
   # ... (login logic) ...
@@ -557,7 +1957,7 @@ def login():
     if hmac.compare_digest(u, ADMIN_USER) and hmac.compare_digest(p, ADMIN_PASS):
       session["auth"]=True; return redirect(url_for('index'))
     session["auth"]=False; session["login_err"]="မှန်ကန်မှုမရှိပါ (username/password)"; return redirect(url_for('login'))
-  return render_template_string(HTML, authed=False, logo=LOGO_URL, err=session.pop("login_err", None))
+  return render_page(authed=False, logo=LOGO_URL, err=session.pop("login_err", None))
 
 @app.route("/logout", methods=["GET"])
 def logout():
@@ -586,22 +1986,26 @@ def add_user():
     try: datetime.strptime(expires,"%Y-%m-%d")
     except ValueError: return build_view(err="Expires format မမှန်ပါ (YYYY-MM-DD)")
   
+  leased=""
   if port:
-    if not re.fullmatch(r"\d{2,5}",port) or not (6000 <= int(port) <= 19999):
-      return build_view(err="Port အကွာအဝေး 6000-19999")
+    if not re.fullmatch(r"\d{2,5}",port) or not (PORT_LO <= int(port) <= PORT_HI):
+      return build_view(err=f"Port အကွာအဝေး {PORT_LO}-{PORT_HI}")
   else:
     port=pick_free_port()
     if not port: return build_view(err="အသုံးပြုရန် port မရှိပါ")
+    leased=port
 
-  users=load_users(); replaced=False; new_user_info={}
-  for u in users:
-    if u.get("user","").lower()==user.lower():
-      u.update({"password":password,"expires":expires,"port":port,"bind_ip":bind_ip}); replaced=True; new_user_info=u; break
-  if not replaced:
-    new_user_info={"user":user,"password":password,"expires":expires,"port":port,"bind_ip":bind_ip}
-    users.append(new_user_info)
+  with store_locked():
+    existing=find_user(user)
+    new_user_info={**(existing or {}), "user":(existing or {}).get("user",user),
+                   "password":password,"expires":expires,"port":port,"bind_ip":bind_ip}
+    try: upsert_user(new_user_info)
+    except ValueError:
+      if leased: release_port(leased)
+      return build_view(err=f"Port {port} ကို အခြား user သုံးနေပါသည်")
+  claim_port(port, release=(existing or {}).get("port",""))
     
-  save_users(users); sync_config_passwords()
+  sync_config_passwords(); request_refresh()
   
   session["new_user_info"] = new_user_info
   return redirect(url_for('show_info'))
@@ -618,10 +2022,10 @@ def edit_user():
   if not require_login(): return redirect(url_for('login'))
   
   if request.method=="GET":
-    q=(request.args.get("user") or "").strip().lower()
-    users=load_users(); target=[u for u in users if u.get("user","").lower()==q]
+    target=find_user(request.args.get("user"))
     if not target: return build_view(err="မတွေ့ပါ")
-    return build_view(edit_user_data=target[0])
+    target["quota"]=fmt_quota(target.get("quota"))
+    return build_view(edit_user_data=target)
     
   orig=(request.form.get("orig") or "").strip().lower()
   # ... (save logic remains the same) ...
@@ -630,58 +2034,71 @@ def edit_user():
   expires=(request.form.get("expires") or "").strip()
   port=(request.form.get("port") or "").strip()
   bind_ip=(request.form.get("bind_ip") or "").strip()
+  rate_down=(request.form.get("rate_down") or "").strip()
+  rate_up=(request.form.get("rate_up") or "").strip()
   
   if expires.isdigit():
     try: expires=(datetime.now() + timedelta(days=int(expires))).strftime("%Y-%m-%d")
     except Exception: pass
     
   if not user or not password: return build_view(err="User/Password လိုအပ်", edit_user_data=request.form)
+  if any(r and not RATE_RE.fullmatch(r) for r in (rate_down, rate_up)):
+    return build_view(err="Speed limit ကို kbps ဂဏန်းဖြင့်သာ ထည့်ပါ (0 = unlimited)", edit_user_data=request.form)
+  try: quota=parse_bytes(request.form.get("quota"))
+  except ValueError: return build_view(err="Quota ကို 10G / 500M / bytes ပုံစံဖြင့် ထည့်ပါ", edit_user_data=request.form)
   
-  if port and (not re.fullmatch(r"\d{2,5}",port) or not (6000<=int(port)<=19999)):
-    return build_view(err="Port အကွာအဝေး 6000-19999", edit_user_data=request.form)
+  if port and (not re.fullmatch(r"\d{2,5}",port) or not (PORT_LO<=int(port)<=PORT_HI)):
+    return build_view(err=f"Port အကွာအဝေး {PORT_LO}-{PORT_HI}", edit_user_data=request.form)
 
-  users=load_users(); found=False
-  for u in users:
-    if u.get("user","").lower()==orig:
-      old_port=u.get("port",""); old_ip=u.get("bind_ip","")
-      
-      if old_port and (str(old_port)!=str(port) or old_ip!=bind_ip):
-        remove_limit_rules(old_port)
-        
-      u.update({"user":user,"password":password,"expires":expires,"port":port,"bind_ip":bind_ip})
-      found=True; break
-      
-  if not found: return build_view(err="မတွေ့ပါ")
+  with store_locked():
+    u=find_user(orig)
+    if not u: return build_view(err="မတွေ့ပါ")
+    old_port=str(u.get("port","")); old_ip=u.get("bind_ip","")
+    u.update({"user":user,"password":password,"expires":expires,"port":port,"bind_ip":bind_ip,
+              "rate_down":rate_down,"rate_up":rate_up})
+    set_quota(u, quota, get_traffic_data())
+    try: upsert_user(u, orig)
+    except UserExists: return build_view(err=f"User {user} ရှိပြီးသားဖြစ်ပါသည်", edit_user_data=request.form)
+    except ValueError: return build_view(err=f"Port {port} ကို အခြား user သုံးနေပါသည်", edit_user_data=request.form)
+  if old_port!=port: claim_port(port, release=old_port)
   
-  save_users(users); sync_config_passwords(); apply_device_limits(users)
+  sync_config_passwords()
+  if old_port!=port or old_ip!=bind_ip:
+    done=False  # same port: just move set elements; anything else goes through the reconciler
+    if port and old_port==port and IPV4_RE.fullmatch(bind_ip): done=lock_device(port, bind_ip, old_ip)
+    elif port and old_port==port and not bind_ip: done=unlock_device(port, old_ip)
+    if not done: apply_device_limits(load_users())
+  request_refresh()
   return redirect(url_for('index', filter=request.args.get('filter', 'all')))
 
 @app.route("/lock", methods=["POST"])
 def lock_now():
   if not require_login(): return redirect(url_for('login'))
-  user=(request.form.get("user") or "").strip().lower()
   op=(request.form.get("op") or "").strip()
-  users=load_users()
-  
-  u_data=[u for u in users if u.get("user","").lower()==user]
-  if not u_data: return build_view(err="မတွေ့ပါ")
-  u = u_data[0]
+  u=find_user(request.form.get("user"))
+  if not u: return build_view(err="မတွေ့ပါ")
   port = u.get("port","")
   
   if op=="clear":
-    u["bind_ip"]=""
-    save_users(users); apply_device_limits(users)
+    with store_locked():
+      u=find_user(u["user"]) or u; old_ip=u.get("bind_ip",""); u["bind_ip"]=""
+      upsert_user(u)
+    if not (port and unlock_device(port, old_ip)): apply_device_limits(load_users())
+    request_refresh()
     return redirect(url_for('index', filter=request.args.get('filter', 'all')))
     
   if op=="lock":
     if not port:
         return build_view(err="User တွင် Port မသတ်မှတ်ရသေးပါ")
-    ip=first_recent_src_ip(port)
+    ip=first_recent_src_ip(port, get_state()["conntrack"])
     if not ip:
       return build_view(err="လက်ရှိ UDP traffic မတွေ့ — client ချိတ်ပြီး Lock now ကိုပြန်နှိပ်ပါ")
       
-    u["bind_ip"]=ip
-    save_users(users); apply_device_limits(users)
+    with store_locked():
+      u=find_user(u["user"]) or u; old_ip=u.get("bind_ip",""); u["bind_ip"]=ip
+      upsert_user(u)
+    if not lock_device(port, ip, old_ip): apply_device_limits(load_users())
+    request_refresh()
     return redirect(url_for('index', filter=request.args.get('filter', 'all')))
 
   return redirect(url_for('index', filter=request.args.get('filter', 'all')))
@@ -692,15 +2109,331 @@ def delete_user_html():
   user = (request.form.get("user") or "").strip()
   if not user: return build_view(err="User လိုအပ်သည်")
   # ... (delete logic remains the same) ...
-  remain=[]; removed=None
-  for u in load_users():
-    if u.get("user","").lower()==user.lower():
-      removed=u
+  removed=delete_user(user)
+  if removed and removed.get("port"): release_port(removed["port"])
+  sync_config_passwords(mode="mirror")
+  if removed and removed.get("port") and not unlock_device(removed["port"], removed.get("bind_ip","")):
+    apply_device_limits(load_users())
+  request_refresh()
+  return build_view(msg=f"Deleted: {user}")
+
+# --- Bulk provisioning: one validation pass, one port allocation, one store write, one firewall reconcile, one sync ---
+BATCH_MAX = int(os.environ.get("BATCH_MAX", "1000"))
+BATCH_FIELDS = ("user","password","expires","port","bind_ip","rate_down","rate_up","quota") # CSV column order without a header row
+EXPIRES_MAX_DAYS = 36500 # "expires" given as a number of days: larger values are rejected, not turned into a date
+
+def parse_batch(req):
+  """Rows from a JSON body ([{...}] or {"users":[...]}) or CSV (text/csv body, `csv` form field or `file` upload)."""
+  if req.is_json:
+    data=req.get_json(silent=True)
+    rows=data.get("users") if isinstance(data,dict) else data
+    if not isinstance(rows,list): raise ValueError("expected a JSON list of users")
+    return [r if isinstance(r,dict) else {} for r in rows]
+  if "file" in req.files: text=req.files["file"].read().decode("utf-8-sig","replace")
+  else: text=req.form.get("csv") or req.get_data(as_text=True)
+  lines=[l for l in text.splitlines() if l.strip() and not l.lstrip().startswith("#")]
+  if not lines: return []
+  head=[c.strip().lower() for c in next(csv.reader(lines[:1]))]
+  cols=head if "user" in head else BATCH_FIELDS
+  if cols is head: lines=lines[1:]
+  return [{k:v.strip() for k,v in zip(cols,r)} for r in csv.reader(lines)]
+
+@store_locked()
+def provision_users(rows, fleet=False):
+  """Create/update many users at once. Empty expires/port/bind_ip/rate_*/quota keep the existing user's value.
+  fleet: rows from the fleet controller. They only ever match users stamped fleet="1", never local ones, and their
+  fields are applied exactly (empty clears), except an empty port, which keeps the port this node picked.
+  Returns per-row results; bad rows are reported and skipped, the rest are written together."""
+  users=[u for u in load_users() if u.get("user")]
+  existing={u["user"].lower():u for u in users if u.get("fleet") or not fleet}
+  local={u["user"].lower() for u in users if not u.get("fleet")} if fleet else set()
+  traffic=get_traffic_data()
+  owners={u["port"]:u["user"].lower() for u in users if u.get("port")}
+  results=[]; good=[]; seen=set()
+  for i,r in enumerate(rows, 1):
+    f={k:str(r.get(k) if r.get(k) is not None else "").strip() for k in BATCH_FIELDS}
+    key=f["user"].lower(); old=existing.get(key)
+    res={"row":i, "user":f["user"], "ok":False}; results.append(res)
+    if f["expires"].isdigit() and int(f["expires"])<=EXPIRES_MAX_DAYS: # bigger would overflow datetime; rejected below
+      f["expires"]=(datetime.now()+timedelta(days=int(f["expires"]))).strftime("%Y-%m-%d")
+    for k in ("port",) if fleet else ("expires","port","bind_ip","rate_down","rate_up"):
+      if old and not f[k]: f[k]=old.get(k,"")
+    quota=f.pop("quota")
+    err=""
+    if not f["user"] or not f["password"]: err="user/password required"
+    elif key in local: err="name taken by a local user"
+    elif key in seen: err="duplicate user in batch"
+    elif f["port"] and (not re.fullmatch(r"\d{2,5}",f["port"]) or not (PORT_LO<=int(f["port"])<=PORT_HI)):
+      err=f"port must be {PORT_LO}-{PORT_HI}"
+    elif f["port"] and owners.get(f["port"],key)!=key: err=f"port {f['port']} in use"
+    elif f["bind_ip"] and not IPV4_RE.fullmatch(f["bind_ip"]): err="invalid bind_ip"
+    elif any(f[k] and not RATE_RE.fullmatch(f[k]) for k in ("rate_down","rate_up")): err="rate_down/rate_up must be kbps (0 = unlimited)"
+    elif quota and not BYTES_RE.fullmatch(quota): err="quota must look like 10G, 500M or a byte count"
     else:
-      remain.append(u)
-  if removed and removed.get("port"): remove_limit_rules(removed.get("port"))
-  save_users(remain); sync_config_passwords(mode="mirror")
-  return build_view(msg=f"Deleted: {user}", filter_type=request.args.get('filter', 'all'))
+      try:
+        if f["expires"]: datetime.strptime(f["expires"],"%Y-%m-%d")
+      except ValueError: err=f"expires must be YYYY-MM-DD or a number of days up to {EXPIRES_MAX_DAYS}"
+    if err: res["err"]=err; continue
+    seen.add(key)
+    if f["port"]: owners[f["port"]]=key
+    rec={**(old or {}), **f, "user":(old or {}).get("user",f["user"])}
+    if fleet: rec["fleet"]="1"
+    if quota or fleet: set_quota(rec, parse_bytes(quota), traffic) # a fleet row without a quota removes it
+    good.append((res, rec, old))
+
+  need=[g for g in good if not g[1]["port"]]
+  ports=pick_free_ports(len(need)) if need else []
+  for g,p in zip(need, ports): g[1]["port"]=p
+  for g in need[len(ports):]: g[0]["err"]="no free port"
+  good=[g for g in good if g[1]["port"]]
+  if not good: return results
+
+  try: update_users([(rec, old["user"] if old else None) for _,rec,old in good])
+  except ValueError as e:
+    for p in ports: release_port(p)
+    for res,_,_ in good: res["err"]=str(e)
+    return results
+  claim_ports([(rec["port"], (old or {}).get("port","")) for _,rec,old in good])
+  for res,rec,old in good:
+    res.update(ok=True, action="updated" if old else "created", port=rec["port"], expires=rec["expires"])
+  apply_device_limits(load_users())
+  sync_config_passwords(); request_refresh()
+  return results
+
+@app.route("/api/users/batch", methods=["POST"])
+def api_users_batch():
+  if not require_login(): return make_response(jsonify({"ok":False, "err":"login required"}), 401)
+  try: rows=parse_batch(request)
+  except (ValueError, csv.Error) as e: return jsonify({"ok":False, "err":str(e)}), 400
+  if not rows: return jsonify({"ok":False, "err":"no rows"}), 400
+  if len(rows)>BATCH_MAX: return jsonify({"ok":False, "err":f"at most {BATCH_MAX} rows per batch"}), 413
+  results=provision_users(rows)
+  done=[r for r in results if r["ok"]]
+  return jsonify({"ok":len(done)==len(results), "created":sum(r["action"]=="created" for r in done),
+                  "updated":sum(r["action"]=="updated" for r in done), "failed":len(results)-len(done),
+                  "results":results})
+
+# --- Fleet agent (FLEET_URL + FLEET_TOKEN from fleet.py): long-poll this node's user changes since the last applied
+# version, apply them like any other edit (provision_users / delete_users), report status and traffic in batches ---
+FLEET_URL = os.environ.get("FLEET_URL", "").strip().rstrip("/") # controller base URL; unset = standalone panel
+FLEET_TOKEN = os.environ.get("FLEET_TOKEN", "").strip() # this node's token (POST /api/nodes on the controller)
+FLEET_STATE_FILE = os.environ.get("FLEET_STATE_FILE", "/var/lib/zivpn/fleet.json") # last applied change version (-1: never synced)
+FLEET_REPORT = float(os.environ.get("FLEET_REPORT", "30")) # max seconds between reports; sooner after applying changes
+FLEET_WAIT = 25 # long-poll per pull (seconds)
+_fleet = {"applied":0, "pulls":0, "changes":0, "full":0, "reported":0.0, "sent":{}, "ports":{}, "errors":[], "err":""}
+
+def fleet_call(method, path, body=None, timeout=FLEET_WAIT+10):
+  """JSON request to the controller; OSError (incl. HTTP errors) or ValueError on failure."""
+  req=urllib.request.Request(FLEET_URL+path, method=method, data=None if body is None else json.dumps(body).encode(),
+                             headers={"Authorization":f"Bearer {FLEET_TOKEN}", "Content-Type":"application/json"})
+  with urllib.request.urlopen(req, timeout=timeout) as r: return json.loads(r.read())
+
+def fleet_apply(page):
+  """Apply one /agent/v1/changes page; a full page also drops fleet users it doesn't list. Returns (provision results, removed)."""
+  last={}
+  for c in page["changes"]: last[c["user"].lower()]=c # only the newest op per user counts
+  with store_locked():
+    mine={u["user"].lower() for u in load_users() if u.get("fleet")} # never touch users created on this panel
+    drop=[k for k,c in last.items() if c["op"]=="delete" and k in mine]
+    if page.get("full"): drop+=[k for k in mine if k not in last]
+    gone=delete_users(drop) if drop else [] # first, so a port freed here can be reused by an upsert below
+    if gone: claim_ports([("", u["port"]) for u in gone if u.get("port")])
+    ups=[c["rec"] for c in last.values() if c["op"]=="upsert"]
+    results=provision_users(ups, fleet=True) if ups else []
+  if gone and not any(r["ok"] for r in results): # provision_users() did no firewall/config pass of its own
+    apply_device_limits(load_users()); sync_config_passwords(); request_refresh()
+  for r,rec in zip(results, ups):
+    if not r["ok"]: _fleet["errors"].append({"user":r["user"], "err":r.get("err","")})
+    elif not rec.get("port"): _fleet["ports"][r["user"]]=r["port"] # picked here; tell the controller
+  return results, gone
+
+def fleet_report():
+  """Applied version, node status, and totals of fleet users whose traffic changed since the last report."""
+  st=get_state(); traffic=get_traffic_data(); live=st.get("live",{})
+  mine={u["user"] for u in load_users() if u.get("fleet")}
+  delta={u:int(b) for u,b in traffic.items() if u in mine and _fleet["sent"].get(u)!=b}
+  status={"service":st.get("service",""), "users":len(live), "online":sum(r[0]=="Online" for r in live.values()),
+          "collect_ms":st.get("collect_ms",0), "state_age":round(time.time()-st["at"])}
+  fleet_call("POST", "/agent/v1/report", {"applied":_fleet["applied"], "status":status, "traffic":delta,
+                                          "ports":_fleet["ports"], "errors":_fleet["errors"]}, timeout=30)
+  _fleet["sent"].update(delta); _fleet["ports"]={}; _fleet["errors"]=[]; _fleet["reported"]=time.time()
+
+def fleet_stats():
+  return {k:_fleet[k] for k in ("applied","pulls","changes","full","err")} | {"url":FLEET_URL, "reported":round(_fleet["reported"])}
+
+def _fleet_loop():
+  _fleet["applied"]=int(read_json(FLEET_STATE_FILE, {}).get("applied", -1))
+  print(f"[fleet] agent of {FLEET_URL}, applied up to {_fleet['applied']}", flush=True)
+  backoff=0
+  while True:
+    try:
+      due=_fleet["reported"]+FLEET_REPORT-time.time()
+      page=fleet_call("GET", f"/agent/v1/changes?since={_fleet['applied']}&wait={max(0, min(FLEET_WAIT, due)):.1f}")
+      _fleet["pulls"]+=1
+      if page["changes"] or page.get("full"):
+        results,gone=fleet_apply(page)
+        _fleet["changes"]+=len(page["changes"]); _fleet["full"]+=bool(page.get("full"))
+        print(f"[fleet] v{page['version']}: {sum(r['ok'] for r in results)} upserted, {len(gone)} removed"
+              +(f", {len(results)-sum(r['ok'] for r in results)} rejected" if not all(r["ok"] for r in results) else ""), flush=True)
+      if page["version"]!=_fleet["applied"]:
+        _fleet["applied"]=page["version"]; write_json_atomic(FLEET_STATE_FILE, {"applied":page["version"]})
+      if page.get("more"): continue
+      if page["changes"] or page.get("full") or time.time()>=_fleet["reported"]+FLEET_REPORT: fleet_report()
+      _fleet["err"]=""; backoff=0
+    except Exception as e: # anything else (a store error, a bad record) must not end the agent thread
+      err=str(e) if isinstance(e, (OSError, ValueError, KeyError)) else f"{type(e).__name__}: {e}"
+      if err!=_fleet["err"]: print(f"[fleet] {err}", flush=True)
+      _fleet["err"]=err; backoff=min(backoff*2 or 2, 60)
+      time.sleep(backoff)
+
+# --- JSON API: /api/v1/users with cursor pagination, server-side filters and conditional GET ---
+API_PAGE_DEFAULT = 100
+API_PAGE_MAX = 1000
+API_FIELDS = ("user","expires","port","bind_ip","status","expired","traffic_bytes",
+              "quota","quota_used","quota_exhausted","last_seen") # no passwords over the API
+def _api_filter(args):
+  """Predicate from ?status=online|offline|locked&expired=0|1&port_min=&port_max= (ValueError on bad input)."""
+  status=(args.get("status") or "").lower()
+  if status not in ("","online","offline","locked"): raise ValueError("status must be online, offline or locked")
+  expired=(args.get("expired") or "").lower()
+  if expired not in ("","0","1","true","false"): raise ValueError("expired must be 0 or 1")
+  try: lo=int(args.get("port_min") or 0); hi=int(args.get("port_max") or 65535)
+  except ValueError: raise ValueError("port_min/port_max must be numbers")
+  def keep(r):
+    if status=="online" and r.status!="Online": return False
+    if status=="offline" and r.status=="Online": return False
+    if status=="locked" and not r.bind_ip: return False
+    if expired and r.expired!=(expired in ("1","true")): return False
+    if (lo or hi<65535) and not (r.port.isdigit() and lo<=int(r.port)<=hi): return False
+    return True
+  return keep
+
+@app.route("/api/v1/users", methods=["GET"])
+def api_v1_users():
+  if not require_login(): return make_response(jsonify({"ok":False, "err":"login required"}), 401)
+  st=get_state()
+  key=view_key(st)
+  etag=hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+  modified=int(max(_mtime(USERS_DB if USER_STORE=="sqlite" else USERS_FILE), _mtime(USERS_DB+"-wal") if USER_STORE=="sqlite" else 0,
+                   _mtime(TRAFFIC_FILE), st.get("changed_at",0)))
+  inm=request.if_none_match # weak: the body also carries state_version/state_age, which move without the rows changing
+  if inm.contains_weak(etag) or (not inm and request.if_modified_since and modified<=request.if_modified_since.timestamp()):
+    resp=make_response("", 304)
+  else:
+    try:
+      keep=_api_filter(request.args)
+      limit=min(max(int(request.args.get("limit") or API_PAGE_DEFAULT),1), API_PAGE_MAX)
+      after=base64.urlsafe_b64decode((request.args.get("cursor") or "").encode()+b"==").decode() if request.args.get("cursor") else ""
+    except (ValueError, UnicodeDecodeError) as e:
+      return jsonify({"ok":False, "err":str(e) or "bad query"}), 400
+    v=user_rows(st); rows,keys=v["rows"],v["keys"]
+    page=[]; nxt=None
+    for i in range(bisect.bisect_right(keys, after) if after else 0, len(rows)):
+      if not keep(rows[i]): continue
+      if len(page)==limit:
+        nxt=base64.urlsafe_b64encode(page[-1]["user"].lower().encode()).decode().rstrip("="); break
+      page.append(rows[i].as_dict(API_FIELDS))
+    resp=jsonify({"ok":True, "users":page, "count":len(page), "total":len(rows), "next_cursor":nxt,
+                  "state_version":st["version"], "state_age":int(time.time()-st["at"])})
+  resp.set_etag(etag, weak=True)
+  resp.last_modified=modified
+  resp.headers["Cache-Control"]="private, no-cache"
+  return resp
+
+@app.route("/api/v1/traffic/<user>", methods=["GET"])
+def api_v1_traffic(user):
+  """Per-user byte history: ?res=minute (last hour), hour (last day) or day (last month)."""
+  if not require_login(): return make_response(jsonify({"ok":False, "err":"login required"}), 401)
+  u=find_user(user)
+  if not u: return jsonify({"ok":False, "err":"no such user"}), 404
+  try: h=acct_history(u["user"], (request.args.get("res") or "hour").lower())
+  except ValueError: return jsonify({"ok":False, "err":"res must be minute, hour or day"}), 400
+  if h is None: h={"total":0, "buckets":[]}
+  return jsonify({"ok":True, "user":u["user"], "res":(request.args.get("res") or "hour").lower(), **h})
+
+@app.route("/api/v1/sessions/<user>", methods=["GET"])
+def api_v1_sessions(user):
+  """Presence of one user: the open session (if online) and the last SESSION_HISTORY closed ones."""
+  if not require_login(): return make_response(jsonify({"ok":False, "err":"login required"}), 401)
+  u=find_user(user)
+  if not u: return jsonify({"ok":False, "err":"no such user"}), 404
+  st=get_state(); port=str(u.get("port",""))
+  cur=st["conntrack"].get(port)
+  return jsonify({"ok":True, "user":u["user"], "port":port, "online":cur is not None, "source":st.get("presence","poll"),
+                  "current":{"start":round(cur["since"]), "last_seen":round(cur["last_seen"]), "src":cur["src"]} if cur and "since" in cur else None,
+                  "last_seen":round(st.get("last_seen",{}).get(port) or 0) or None, "sessions":presence_sessions(u["user"])})
+
+# --- Prometheus /metrics: rendered from the collector snapshot and the cached rows, never from a fresh query ---
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "").strip() # "Authorization: Bearer <token>" for scrapers; unset: panel login applies
+METRICS_USER_LIMIT = int(os.environ.get("METRICS_USER_LIMIT", "500")) # per-user series cap (online first, then most bytes); 0 = none
+_metrics_cache = {"key":None, "text":""}
+
+def _prom_labels(labels):
+  """{k: v} -> '{k="v",...}' with Prometheus escaping."""
+  esc=lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+  return "{"+",".join(f'{k}="{esc(v)}"' for k,v in labels.items())+"}" if labels else ""
+
+def _prom_metric(out, name, kind, help, samples):
+  out.append(f"# HELP {name} {help}"); out.append(f"# TYPE {name} {kind}")
+  out.extend(f"{name}{_prom_labels(labels)} {val}" for labels,val in samples)
+
+def metrics_text(st):
+  """Exposition text for one snapshot; re-rendered only when the snapshot or the rows changed."""
+  v=user_rows(st); key=(st["version"], v["key"])
+  if _metrics_cache["key"]==key: return _metrics_cache["text"]
+  out=[]; metric=lambda *a: _prom_metric(out, *a)
+  rows=v["rows"]
+  metric("zivpn_users", "gauge", "Users in the store.", [({}, len(rows))])
+  metric("zivpn_users_online", "gauge", "Users with recent UDP traffic.", [({}, v["online"])])
+  metric("zivpn_users_expired", "gauge", "Users past their expiry date.", [({}, v["expired"])])
+  metric("zivpn_users_locked", "gauge", "Users locked to one device.", [({}, sum(1 for r in rows if r.bind_ip))])
+  metric("zivpn_firewall_rules", "gauge", "Entries in the panel's chains and ipsets at the last collection.",
+         [({"chain":k}, n) for k,n in sorted(st.get("rules",{}).items())])
+  metric("zivpn_service_up", "gauge", "1 if zivpn.service was active at the last collection.", [({}, int(st.get("service")=="active"))])
+  metric("zivpn_collector_cycles_total", "counter", "Collector snapshots published.", [({}, st["version"])])
+  metric("zivpn_collector_last_run_timestamp_seconds", "gauge", "When the last snapshot was taken.", [({}, round(st["at"], 3))])
+  metric("zivpn_collector_duration_seconds", "gauge", "How long the last collection took.", [({}, st.get("collect_ms", 0)/1000)])
+  if METRICS_USER_LIMIT>0:
+    top=sorted(rows, key=lambda r:(r.status!="Online", -r.traffic_bytes, r.key))[:METRICS_USER_LIMIT]
+    metric("zivpn_user_bytes_total", "counter", "Bytes through each user's port.", [({"user":r.user}, r.traffic_bytes) for r in top])
+    metric("zivpn_user_online", "gauge", "1 if the user has recent UDP traffic.", [({"user":r.user}, int(r.status=="Online")) for r in top])
+    metric("zivpn_user_series_dropped", "gauge", "Users left out of the per-user series by METRICS_USER_LIMIT.", [({}, len(rows)-len(top))])
+  text="\n".join(out)+"\n"
+  _metrics_cache.update(key=key, text=text)
+  return text
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+  """Prometheus text format: the cached snapshot part plus the few values that move between snapshots."""
+  if METRICS_TOKEN:
+    if not hmac.compare_digest(request.headers.get("Authorization",""), f"Bearer {METRICS_TOKEN}"): return make_response("unauthorized", 401)
+  elif not require_login(): return make_response("login required", 401)
+  st=get_state(); sync=sync_stats(); out=[]
+  _prom_metric(out, "zivpn_collector_age_seconds", "gauge", "Seconds since the last snapshot.", [({}, round(time.time()-st["at"], 3))])
+  _prom_metric(out, "zivpn_config_restarts_total", "counter", "zivpn restarts after config syncs.", [({}, sync["restarts"])])
+  _prom_metric(out, "zivpn_config_restarts_avoided_total", "counter", "Config syncs that needed no restart.", [({}, sync["avoided"])])
+  return Response(metrics_text(st)+"\n".join(out)+"\n", mimetype="text/plain; version=0.0.4")
+
+@app.route("/debug", methods=["GET"])
+def debug():
+  """This worker's slowest commands, rolling timings, recent slow requests and cProfile samples (?profile=1 on any page)."""
+  if not require_login(): return make_response(jsonify({"ok":False, "err":"login required"}), 401)
+  t=timing_stats()
+  cmds=sorted(((k[4:], v) for k,v in t.items() if k.startswith("cmd ")),
+              key=lambda kv:(kv[1]["p95_ms"] or float("inf"), kv[1]["max_ms"]), reverse=True)
+  return jsonify({"ok":True, "window_min":TIMING_WINDOW, "slow_request_ms":SLOW_REQUEST_MS, "profiling":PROFILE_REQUESTS,
+                  "top_commands":[{"cmd":k, **v} for k,v in cmds[:10]], "timings":t, "commands":cmd_stats(),
+                  **({"fleet":fleet_stats()} if FLEET_URL else {}),
+                  "slow_requests":list(_slow), "profiles":[{k:v for k,v in p.items() if k!="stats"} for p in _profiles]})
+
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+  """pstats text of a sampled request: ?n=0 is the latest."""
+  if not require_login(): return make_response("login required", 401)
+  try: p=_profiles[int(request.args.get("n") or 0)]
+  except (ValueError, IndexError):
+    return make_response("no profile yet" if PROFILE_REQUESTS else "profiling is off (PROFILE_REQUESTS=1)", 404)
+  return Response(f"{p['path']}  {p['ms']} ms\n\n{p['stats']}", mimetype="text/plain")
 
 @app.route("/favicon.ico", methods=["GET"])
 def favicon(): return ("",204)
@@ -709,4 +2442,9 @@ def favicon(): return ("",204)
 def handle_405(e): return redirect(url_for('index'))
 
 if __name__ == "__main__":
-  app.run(host="0.0.0.0", port=int(WEB_PORT))
+  # maintenance: `web.py migrate-users` (users.json -> USERS_DB), `web.py export-users [path]` (store -> JSON)
+  if sys.argv[1:2]==["migrate-users"]:
+    print(f"imported {migrate_users_json()} users into {USERS_DB}"); sys.exit(0)
+  if sys.argv[1:2]==["export-users"]:
+    export_users_json(*sys.argv[2:3]); sys.exit(0)
+  serve()
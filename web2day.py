@@ -1,22 +1,32 @@
 # /etc/zivpn/web2day.py — ZIVPN Public Panel (no login, no edit/delete)
 # Solid Online/Data detection via mangle PREROUTING counters
 # - Add user only
-# - Auto expiry 2 days + auto prune (+ cleanup NAT & MANGLE rules)
-# - Per-user DNAT (nat PREROUTING) for port mapping
-# - Per-user COUNTERS (mangle PREROUTING) -> Online & Data (bytes/KB/MB/GB)
+# - Auto expiry 2 days + auto prune on a heap-driven timer (+ cleanup NAT & MANGLE rules, one config sync)
+# - Per-user DNAT (nat ZIVPN-DNAT chain) for port mapping
+# - Per-user COUNTERS (mangle ZIVPN-COUNT chain) -> Online & Data (bytes/KB/MB/GB)
+# - Optional per-user data quota (DEFAULT_QUOTA for new users), enforced in the kernel (xt_quota / nft quota)
+# - Rules reconciled in one iptables-restore transaction per table (or FW_BACKEND=nft: set/map + named counters)
 # - Auto bind first seen client IP (best-effort)
 # - KPI: Today Created, This Month Created, Online, Expired
 # - Mobile-first light UI
 
-from flask import Flask, render_template_string, request, redirect, url_for, session
-import json, subprocess, os, tempfile, re
+from flask import Flask, Response, request, redirect, url_for, session, stream_with_context
+import json, subprocess, os, tempfile, hmac, re, threading, time, sqlite3, sys, fcntl, itertools, collections, struct, mmap, heapq, pickle, hashlib, zlib
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date
 
 # ---------- CONFIG ----------
 USERS_FILE   = "/etc/zivpn/users.json"
+USER_STORE   = os.environ.get("USER_STORE", "json")              # "json" | "sqlite" (USERS_DB, WAL mode)
+USERS_DB     = os.environ.get("USERS_DB", "/etc/zivpn/users.db")
 CONFIG_FILE  = "/etc/zivpn/config.json"
+TRAFFIC_FILE = "/var/lib/zivpn/traffic.json"   # per-user byte totals, written by acct_sample()
 WEB_PORT     = int(os.environ.get("WEB_PORT", "8080"))
 DEFAULT_DAYS = 2
+STATE_INTERVAL = int(os.environ.get("STATE_INTERVAL", "15"))   # background collector refresh (seconds)
+FW_BACKEND   = os.environ.get("FW_BACKEND", "iptables")          # "iptables" | "nft"
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("WEB_SECRET", "change-me-dev")
@@ -40,34 +50,233 @@ def write_json_atomic(path, data):
         try: os.remove(tmp)
         except: pass
 
-def save_users(users): write_json_atomic(USERS_FILE, users)
+# ---------- USER STORE (users.json or SQLite) ----------
+USER_COLS = ("user","password","created_on","expires","port","bind_ip")
+_users_cache = {"sig": None, "rows": []}
+_db_local = threading.local()
+
+def _norm_user(u):
+    rec = {
+        "user": u.get("user",""),
+        "password": u.get("password",""),
+        "created_on": u.get("created_on",""),
+        "expires": u.get("expires",""),
+        "port": str(u.get("port","")) if u.get("port","")!="" else "",
+        "bind_ip": u.get("bind_ip",""),
+    }
+    for k, v in u.items():
+        if k not in rec: rec[k] = v
+    return rec
+
+def _db():
+    # per-thread connection; first open creates schema + migrates users.json once
+    con = getattr(_db_local, "con", None)
+    if con is None:
+        os.makedirs(os.path.dirname(USERS_DB) or ".", exist_ok=True)
+        con = sqlite3.connect(USERS_DB, timeout=30, isolation_level=None, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL"); con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS users(
+                user TEXT NOT NULL, password TEXT NOT NULL DEFAULT '', created_on TEXT NOT NULL DEFAULT '',
+                expires TEXT NOT NULL DEFAULT '', port TEXT NOT NULL DEFAULT '', bind_ip TEXT NOT NULL DEFAULT '',
+                extra TEXT NOT NULL DEFAULT '{}');
+            CREATE UNIQUE INDEX IF NOT EXISTS users_user ON users(user COLLATE NOCASE);
+            CREATE UNIQUE INDEX IF NOT EXISTS users_port ON users(port) WHERE port<>'';
+            CREATE INDEX IF NOT EXISTS users_expires ON users(expires);
+            CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY, v INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta VALUES('version',0);
+        """)
+        _db_local.con = con
+        if con.execute("SELECT v FROM meta WHERE k='migrated'").fetchone() is None: migrate_users_json(con)
+    return con
+
+def _db_row(r):
+    u = {k: r[k] for k in USER_COLS}
+    try: u.update(json.loads(r["extra"] or "{}"))
+    except ValueError: pass
+    return _norm_user(u)
+
+def _db_upsert(con, u, orig=None):
+    p = {k: str(u.get(k,"") or "") for k in USER_COLS}
+    p["extra"] = json.dumps({k: v for k, v in u.items() if k not in USER_COLS}, ensure_ascii=False)
+    p["orig"] = orig or u.get("user","")
+    cur = con.execute("""UPDATE users SET user=:user, password=:password, expires=:expires, port=:port, bind_ip=:bind_ip,
+                         created_on=CASE WHEN :created_on<>'' THEN :created_on ELSE created_on END, extra=:extra
+                         WHERE user=:orig COLLATE NOCASE""", p)
+    if cur.rowcount == 0:
+        con.execute("INSERT INTO users(user,password,created_on,expires,port,bind_ip,extra) "
+                    "VALUES(:user,:password,:created_on,:expires,:port,:bind_ip,:extra)", p)
+
+def _db_write(fn):
+    # run fn(con) in one IMMEDIATE transaction and bump the store version
+    con = _db(); con.execute("BEGIN IMMEDIATE")
+    try:
+        fn(con)
+        con.execute("UPDATE meta SET v=v+1 WHERE k='version'"); con.execute("COMMIT")
+    except sqlite3.IntegrityError as e:
+        con.execute("ROLLBACK"); raise ValueError(f"duplicate user/port: {e}")
+    except Exception:
+        con.execute("ROLLBACK"); raise
 
-def load_users():
-    vs = read_json(USERS_FILE, [])
-    out=[]
-    for u in vs:
-        out.append({
-            "user": u.get("user",""),
-            "password": u.get("password",""),
-            "created_on": u.get("created_on",""),
-            "expires": u.get("expires",""),
-            "port": str(u.get("port","")) if u.get("port","")!="" else "",
-            "bind_ip": u.get("bind_ip",""),
-        })
-    return out
+def migrate_users_json(con=None):
+    # one-shot users.json -> SQLite; a duplicate port keeps its first owner
+    con = con or _db(); n = 0
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        for u in read_json(USERS_FILE, []):
+            if not u.get("user"): continue
+            u = _norm_user(u)
+            try: _db_upsert(con, u)
+            except sqlite3.IntegrityError:
+                print(f"[store] {u['user']}: port {u['port']} already taken, imported without port", flush=True)
+                u["port"] = ""; _db_upsert(con, u)
+            n += 1
+        con.execute("INSERT OR REPLACE INTO meta VALUES('migrated',?)", (int(time.time()),))
+        con.execute("UPDATE meta SET v=v+1 WHERE k='version'"); con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK"); raise
+    return n
+
+def save_users(users):
+    if USER_STORE == "sqlite":
+        def _replace(con):
+            con.execute("DELETE FROM users")
+            for u in users: _db_upsert(con, _norm_user(u))
+        return _db_write(_replace)
+    write_json_atomic(USERS_FILE, users)
+
+_store_lock = threading.RLock()
+_store_depth = [0]
+
+@contextmanager
+def store_locked():
+    # serialize read-modify-write of the store across threads and worker processes (flock on <store>.lock);
+    # re-entrant, usable as a decorator
+    with _store_lock:
+        _store_depth[0] += 1
+        try:
+            if _store_depth[0] > 1: yield; return
+            path = USERS_DB if USER_STORE == "sqlite" else USERS_FILE
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path + ".lock", "a") as lf:
+                fcntl.flock(lf, fcntl.LOCK_EX)
+                try: yield
+                finally: fcntl.flock(lf, fcntl.LOCK_UN)
+        finally: _store_depth[0] -= 1
 
-def shell(cmd):
-    return subprocess.run(cmd, shell=True, capture_output=True, text=True)
+def load_users():
+    if USER_STORE == "sqlite":
+        return [_db_row(r) for r in _db().execute("SELECT * FROM users ORDER BY rowid")]
+    try: st = os.stat(USERS_FILE); sig = (st.st_ino, st.st_mtime_ns, st.st_size)   # atomic replace = new inode
+    except OSError: sig = None
+    if sig is None or sig != _users_cache["sig"]:   # re-parse only when users.json changed on disk
+        _users_cache["rows"] = read_json(USERS_FILE, []) if sig else []; _users_cache["sig"] = sig
+    return [_norm_user(u) for u in _users_cache["rows"]]
+
+def find_user(name):
+    name = (name or "").strip()
+    if not name: return None
+    if USER_STORE == "sqlite":
+        r = _db().execute("SELECT * FROM users WHERE user=? COLLATE NOCASE", (name,)).fetchone()
+        return _db_row(r) if r else None
+    return next((u for u in load_users() if u.get("user","").lower() == name.lower()), None)
+
+class UserExists(ValueError):
+    # a write would rename a user onto the name of another existing user
+    pass
+
+@store_locked()
+def update_users(changes):
+    # [(rec, orig_or_None), ...] in one write, all or nothing; both stores merge rec into the current record
+    # (fields rec doesn't carry are kept). UserExists on a rename onto a taken name, ValueError on a port clash (SQLite)
+    if USER_STORE == "sqlite":
+        def _apply(con):
+            for rec, orig in changes:
+                key = orig or rec.get("user","")
+                if rec.get("user","").lower() != key.lower() and \
+                   con.execute("SELECT 1 FROM users WHERE user=? COLLATE NOCASE", (rec.get("user",""),)).fetchone():
+                    raise UserExists(f"user {rec['user']} exists")
+                cur = con.execute("SELECT * FROM users WHERE user=? COLLATE NOCASE", (key,)).fetchone()
+                _db_upsert(con, _norm_user({**_db_row(cur), **rec} if cur else rec), orig)
+        return _db_write(_apply)
+    users = load_users()
+    idx = {u.get("user","").lower(): i for i, u in enumerate(users)}
+    for rec, orig in changes:
+        key = (orig or rec.get("user","")).lower(); new = rec.get("user","").lower()
+        if new != key and new in idx: raise UserExists(f"user {rec['user']} exists")
+        i = idx.pop(key, None)
+        if i is None: users.append(rec); i = len(users) - 1
+        else: users[i] = {**users[i], **rec}
+        idx[new] = i
+    save_users(users)
+
+def upsert_user(rec, orig=None): return update_users([(rec, orig)])
+
+@store_locked()
+def patch_users(patches):
+    # {user: {field: value}} merged into the *current* records, so a background write never reverts an edit
+    cur = {u["user"].lower(): u for u in load_users() if u.get("user")}
+    changes = [({**cur[k.lower()], **p}, None) for k, p in patches.items() if k.lower() in cur]
+    if changes: update_users(changes)
+
+@store_locked()
+def delete_users(names):
+    # remove several users in one write; returns the removed records
+    keys = {(n or "").lower() for n in names}
+    users = load_users(); gone = [u for u in users if u.get("user","").lower() in keys]
+    if not gone: return []
+    if USER_STORE == "sqlite":
+        _db_write(lambda con: con.executemany("DELETE FROM users WHERE user=? COLLATE NOCASE", [(u["user"],) for u in gone]))
+    else:
+        save_users([u for u in users if u.get("user","").lower() not in keys])
+    return gone
+
+def store_version():
+    if USER_STORE == "sqlite": return _db().execute("SELECT v FROM meta WHERE k='version'").fetchone()[0]
+    try: return os.stat(USERS_FILE).st_mtime_ns
+    except OSError: return 0
+
+def export_users_json(path=USERS_FILE):
+    write_json_atomic(path, load_users())
+
+# ---------- Command runner: argv lists (no /bin/sh, no grep/awk), a timeout on every call, per-command timings ----------
+# run_many() starts independent queries together, so a collector cycle costs the slowest one instead of the sum.
+CMD_TIMEOUT  = float(os.environ.get("CMD_TIMEOUT", "10"))   # seconds before a hung command is killed
+CMD_TIMEDOUT, CMD_MISSING = 124, 127                         # returncodes run() reports instead of raising
+_cmd_stats = {}   # "argv[0] argv[1]" -> [calls, total s, max s, last s, failures, timeouts]
+_cmd_lock = threading.Lock()
+_cmd_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="cmd")
+
+def run(argv, input=None, timeout=None):
+    # subprocess.run(argv) with a timeout; a hang or a missing binary comes back as returncode 124/127
+    t = time.perf_counter()
+    try: r = subprocess.run(argv, input=input, capture_output=True, text=True, timeout=timeout or CMD_TIMEOUT)
+    except subprocess.TimeoutExpired: r = subprocess.CompletedProcess(argv, CMD_TIMEDOUT, "", f"{argv[0]}: timed out")
+    except OSError as e: r = subprocess.CompletedProcess(argv, CMD_MISSING, "", str(e))
+    dt = time.perf_counter() - t
+    with _cmd_lock:
+        st = _cmd_stats.setdefault(" ".join(argv[:2]), [0, 0.0, 0.0, 0.0, 0, 0])
+        st[0] += 1; st[1] += dt; st[2] = max(st[2], dt); st[3] = dt
+        st[4] += r.returncode != 0; st[5] += r.returncode == CMD_TIMEDOUT
+    if r.returncode == CMD_TIMEDOUT: print(f"[cmd] {' '.join(argv)} timed out after {dt:.1f}s", flush=True)
+    return r
+
+def run_many(cmds, timeout=None):
+    # {name: argv} -> {name: CompletedProcess}, all running at once
+    futs = {k: _cmd_pool.submit(run, argv, None, timeout) for k, argv in cmds.items()}
+    return {k: f.result() for k, f in futs.items()}
+
+def cmd_stats():
+    with _cmd_lock:
+        return {k: {"calls": n, "avg_ms": round(tot*1000/n, 1), "max_ms": round(mx*1000, 1), "last_ms": round(last*1000, 1),
+                    "failures": f, "timeouts": to} for k, (n, tot, mx, last, f, to) in _cmd_stats.items() if n}
 
 def vps_ip():
-    for c in [
-        "ip route get 1.1.1.1 | awk '{print $7; exit}'",
-        "hostname -I | awk '{print $1}'"
-    ]:
-        try:
-            ip = shell(c).stdout.strip()
-            if re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", ip): return ip
-        except: pass
+    m = re.search(r"\bsrc ((\d{1,3}\.){3}\d{1,3})", run(["ip", "-4", "route", "get", "1.1.1.1"]).stdout)
+    if m: return m.group(1)
+    ips = run(["hostname", "-I"]).stdout.split()
+    if ips and re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", ips[0]): return ips[0]
     return "SERVER_IP"
 VPS_IP = vps_ip()
 
@@ -85,71 +294,360 @@ def get_listen_port():
     m = re.search(r":(\d+)$", s) if s else None
     return m.group(1) if m else "5667"
 
+# ---------- Persistent UDP port allocator ----------
+# PORTS_FILE = JSON header line + one state byte per port in PORT_RANGE; flock-guarded so both panels
+# (or several workers) can share it. Rebuilt from the store whenever the store changed behind our back.
+PORTS_FILE = os.environ.get("PORTS_FILE", "/var/lib/zivpn/ports.bin")
+PORT_RANGE = os.environ.get("PORT_RANGE", "6000-19999")
+PORT_RESERVED = os.environ.get("PORT_RESERVED", "")   # e.g. "8080,10000-10010" — never handed out
+PORT_LEASE_SECONDS = 600   # an allocated port stays taken this long even if the user was never saved
+P_FREE, P_USED, P_RESERVED, P_LISTEN = 0, 1, 2, 3
+_ports_lock = threading.Lock()
+
+def parse_port_spec(spec):
+    out = set()
+    for part in (spec or "").replace(" ", "").split(","):
+        a, _, b = part.partition("-")
+        if a.isdigit() and (not b or b.isdigit()): out.update(range(int(a), int(b or a) + 1))
+    return out
+
+PORT_LO, PORT_HI = (lambda r: (min(r), max(r)))(parse_port_spec(PORT_RANGE) or {6000, 19999})
+
+def _port_index(p):
+    p = str(p or "")
+    return int(p) - PORT_LO if p.isdigit() and PORT_LO <= int(p) <= PORT_HI else None
+
+@contextmanager
+def _ports_locked():
+    with _ports_lock:
+        os.makedirs(os.path.dirname(PORTS_FILE) or ".", exist_ok=True)
+        with open(PORTS_FILE + ".lock", "a") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(lf, fcntl.LOCK_UN)
+
+def _ports_write(hdr, bits):
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(PORTS_FILE) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f: f.write(json.dumps(hdr).encode() + b"\n" + bytes(bits))
+        os.replace(tmp, PORTS_FILE)
+    finally:
+        try: os.remove(tmp)
+        except: pass
+
+def _ports_rebuild(hdr):
+    bits = bytearray(PORT_HI - PORT_LO + 1); now = time.time()
+    for p in parse_port_spec(PORT_RESERVED):
+        if _port_index(p) is not None: bits[_port_index(p)] = P_RESERVED
+    hdr["leases"] = {p: t for p, t in hdr.get("leases", {}).items() if now - t < PORT_LEASE_SECONDS}
+    for p in list(hdr["leases"]) + [u.get("port", "") for u in load_users()]:
+        i = _port_index(p)
+        if i is not None and bits[i] != P_RESERVED: bits[i] = P_USED
+    hdr["sig"] = store_version()
+    return bits
+
+def _ports_load():
+    hdr = {"lo": PORT_LO, "hi": PORT_HI, "sig": None, "cursor": 0, "leases": {}}; bits = None
+    try:
+        with open(PORTS_FILE, "rb") as f: head, _, raw = f.read().partition(b"\n")
+        h = json.loads(head)
+        if h.get("lo") == PORT_LO and h.get("hi") == PORT_HI and len(raw) == PORT_HI - PORT_LO + 1:
+            hdr, bits = h, bytearray(raw)
+    except Exception: pass
+    if bits is None or hdr.get("sig") != store_version(): bits = _ports_rebuild(hdr)
+    return hdr, bits
+
 def pick_free_port():
-    used = {int(u.get("port") or 0) for u in load_users() if u.get("port")}
-    for p in range(6000, 20000):
-        if p not in used: return str(p)
-    return ""
-
-# ---------- NAT (DNAT to 5667) ----------
-def nat_rule_exists(user, port):
-    out = shell("iptables -t nat -S PREROUTING").stdout.splitlines()
-    tag = f"user:{user}"
-    patt = re.compile(rf"-A PREROUTING .* -p udp .* --dport {port}\b .* -j DNAT .* --to-destination :5667 .* -m comment --comment {re.escape(tag)}")
-    return any(patt.search(l) for l in out)
-
-def nat_rule_add(user, port):
-    if not (user and port): return
-    if nat_rule_exists(user, port): return
-    tag = f"user:{user}"
-    shell(f"iptables -t nat -I PREROUTING -p udp --dport {port} -m comment --comment {tag} -j DNAT --to-destination :5667")
-
-def nat_rule_del(user=None, port=None):
-    lines = shell("iptables -t nat -S PREROUTING").stdout.splitlines()
-    for l in lines:
-        if user and f"--comment user:{user}" not in l: 
-            continue
-        if port and f"--dport {port}" not in l:
-            continue
-        rule = l.replace("-A PREROUTING","").strip()
-        shell(f"iptables -t nat -D PREROUTING {rule}")
-
-# ---------- MANGLE (counters on original dport) ----------
-def mangle_rule_exists(user, port):
-    out = shell("iptables -t mangle -S PREROUTING").stdout.splitlines()
-    tag = f"user:{user}"
-    patt = re.compile(rf"-A PREROUTING .* -p udp .* --dport {port}\b .* -m comment --comment {re.escape(tag)} .* -j RETURN")
-    return any(patt.search(l) for l in out)
-
-def mangle_rule_add(user, port):
-    if not (user and port): return
-    if mangle_rule_exists(user, port): return
-    tag = f"user:{user}"
-    # RETURN doesn’t change flow; only used for counters
-    shell(f"iptables -t mangle -I PREROUTING -p udp --dport {port} -m comment --comment {tag} -j RETURN")
-
-def mangle_rule_del(user=None, port=None):
-    lines = shell("iptables -t mangle -S PREROUTING").stdout.splitlines()
-    for l in lines:
-        if user and f"--comment user:{user}" not in l:
-            continue
-        if port and f"--dport {port}" not in l:
-            continue
-        rule = l.replace("-A PREROUTING","").strip()
-        shell(f"iptables -t mangle -D PREROUTING {rule}")
-
-def mangle_counters():
-    # return {port: (pkts, bytes)}
-    out = shell("iptables -t mangle -L PREROUTING -v -x -n").stdout.splitlines()
+    # lease the next free port after the cursor, skipping live UDP listeners; "" when the range is full
+    listen = get_state()["udp_listen"]
+    with _ports_locked():
+        hdr, bits = _ports_load()
+        for lo in (hdr.get("cursor", 0) % len(bits), 0):
+            j = bits.find(P_FREE, lo)
+            while j >= 0:
+                if str(PORT_LO + j) in listen: bits[j] = P_LISTEN
+                else:
+                    bits[j] = P_USED; hdr["cursor"] = j + 1; hdr["leases"][str(PORT_LO + j)] = time.time()
+                    _ports_write(hdr, bits)
+                    return str(PORT_LO + j)
+                j = bits.find(P_FREE, j + 1)
+        _ports_write(hdr, bits)
+        return ""
+
+def claim_port(port, release=""):
+    # record a saved user's port (and free the one it replaced); call after the store write succeeded
+    with _ports_locked():
+        hdr, bits = _ports_load()
+        for p, st in ((str(release or ""), P_FREE), (str(port or ""), P_USED)):
+            i = _port_index(p)
+            if i is not None and bits[i] != P_RESERVED:
+                bits[i] = st; hdr["leases"].pop(p, None)
+        hdr["sig"] = store_version()
+        _ports_write(hdr, bits)
+
+def release_port(port): claim_port("", release=port)
+
+def check_ports(listen):
+    # consistency check against the store and live UDP listeners; repairs the bitmap, returns a report
+    with _ports_locked():
+        hdr, bits = _ports_load(); now = time.time()
+        hdr["leases"] = {p: t for p, t in hdr["leases"].items() if now - t < PORT_LEASE_SECONDS}
+        users = {str(u.get("port", "")) for u in load_users() if str(u.get("port", "")).isdigit()}
+        rep = {"listener_conflicts": [], "unmarked": [], "stale": []}
+        for p in sorted(users | listen, key=int):
+            i = _port_index(p)
+            if i is None: continue
+            if p in listen and p in users: rep["listener_conflicts"].append(p)
+            elif p in listen and bits[i] == P_FREE: bits[i] = P_LISTEN
+            elif p in users and bits[i] != P_USED: rep["unmarked"].append(p); bits[i] = P_USED
+        for i in range(len(bits)):
+            p = str(PORT_LO + i)
+            if bits[i] == P_LISTEN and p not in listen: bits[i] = P_FREE
+            elif bits[i] == P_USED and p not in users and p not in hdr["leases"]:
+                rep["stale"].append(p); bits[i] = P_FREE
+        rep["free"] = bits.count(P_FREE)
+        _ports_write(hdr, bits)
+        return rep
+
+# ---------- Firewall reconciler (NAT DNAT + MANGLE counters) ----------
+# Desired per-user rules are built from users.json, diffed against one `iptables-save -c` dump per table
+# and applied in a single `iptables-restore --noflush --counters` transaction on dedicated chains.
+NAT_CHAIN    = "ZIVPN-DNAT"     # nat: per-user DNAT to :5667
+COUNT_CHAIN  = "ZIVPN-COUNT"    # mangle: RETURN rules used only for counters on the original dport
+XT_WAIT      = "5"              # iptables-restore -w: seconds to wait for the xtables lock (/add and the collector overlap)
+
+def user_tag(user):
+    return "user:" + re.sub(r"[^\w.@-]", "_", user)
+
+def _rule_key(line):
+    # (dport, tag) of a saved rule, or None
+    m = re.search(r"--dport (\d+)\b.*--comment \"?(user:[^\"\s]+)", line)
+    return (m.group(1), m.group(2)) if m else None
+
+def _desired(users, chain, target):
+    want={}
+    for u in users:
+        port = str(u.get("port") or "")
+        if not (u.get("user") and port.isdigit()): continue
+        tag = user_tag(u["user"])
+        want[(port, tag)] = f"-A {chain} -p udp -m udp --dport {port} -m comment --comment \"{tag}\" -j {target}"
+    return want
+
+def _reconcile_table(table, chain, want, dump=None):
+    # dump: `iptables-save -c -t <table>` output if the collector already has it
+    if dump is None: dump = run(["iptables-save", "-c", "-t", table]).stdout
+    have={}; legacy=[]; jumped=False
+    for line in dump.splitlines():
+        ctr, _, rule = line.partition("] ") if line.startswith("[") else ("", "", line)
+        if rule.startswith(f"-A {chain} "):
+            k = _rule_key(rule)
+            if k: have[k] = ctr + "]"
+        elif rule.startswith("-A PREROUTING "):
+            if f"-j {chain}" in rule: jumped = True
+            elif "--comment" in rule and "user:" in rule:
+                legacy.append("-D" + rule[2:])   # old per-user PREROUTING rules -> migrate into chain
+    added = len(want.keys() - have.keys()); removed = len(have.keys() - want.keys())
+    if added or removed or legacy or not jumped:
+        payload = [f"*{table}", f":{chain} - [0:0]"]   # declaring the chain with --noflush replaces its contents
+        payload += legacy
+        if not jumped: payload.append(f"-I PREROUTING 1 -p udp -j {chain}")
+        payload += [have.get(k, "[0:0]") + " " + r for k, r in want.items()]   # keep existing counters
+        payload.append("COMMIT")
+        r = run(["iptables-restore", "-w", XT_WAIT, "--noflush", "--counters"], input="\n".join(payload) + "\n")
+        if r.returncode != 0: print(f"[firewall] iptables-restore {table} failed: {r.stderr.strip()}", flush=True)
+    return added, removed + len(legacy)
+
+# ---------- nftables backend (FW_BACKEND=nft) ----------
+# table ip zivpn: set user_ports (dport -> redirect :5667) + map user_ctr (dport -> named counter "p<port>")
+# + map user_quota (dport -> named quota "q<port>_<quota>_<base>", packets over it are dropped).
+# Adding a user is one set/map insert; every packet costs one hash lookup; all counters come from one JSON read.
+NFT_TABLE = "zivpn"
+NFT_SKELETON = f"""table ip {NFT_TABLE} {{
+  set user_ports {{ type inet_service; }}
+  map user_ctr {{ type inet_service : counter; }}
+  map user_quota {{ type inet_service : quota; }}
+  chain dnat {{ type nat hook prerouting priority dstnat; policy accept; }}
+  chain count {{ type filter hook prerouting priority mangle; policy accept; }}
+}}
+flush chain ip {NFT_TABLE} dnat
+add rule ip {NFT_TABLE} dnat udp dport @user_ports redirect to :5667
+flush chain ip {NFT_TABLE} count
+add rule ip {NFT_TABLE} count counter name udp dport map @user_ctr
+add rule ip {NFT_TABLE} count quota name udp dport map @user_quota drop
+"""
+_iptables_migrated = False
+
+NFT_LIST_TABLE = ["nft", "-j", "list", "table", "ip", NFT_TABLE]
+NFT_LIST_COUNTERS = ["nft", "-j", "list", "counters", "table", "ip", NFT_TABLE]
+
+def nft_json(text):
+    try: return json.loads(text or "{}").get("nftables", [])
+    except ValueError: return []
+
+def nft_reconcile(users, listing=None):
+    # diff user_ports {port: "user:<name>"} against one `nft -j list table`, apply in one `nft -f -` transaction
+    global _iptables_migrated
+    items = nft_json(run(NFT_LIST_TABLE).stdout if listing is None else listing)
+    have = {}
+    for it in items:
+        st = it.get("set")
+        if not (st and st.get("name") == "user_ports"): continue
+        for e in st.get("elem", []):
+            e = e.get("elem", e) if isinstance(e, dict) else {"val": e}
+            have[str(e.get("val"))] = e.get("comment", "")
+    want = {port: tag for port, tag in _desired(users, "", "").keys()}
+    gone = [p for p in have if want.get(p) != have[p]]
+    new = [p for p in want if have.get(p) != want[p]]
+    skeleton = not any((it.get("map") or {}).get("name") == "user_quota" for it in items)   # new table, or one from before quotas
+    if gone or new or skeleton:
+        ops = [NFT_SKELETON] if skeleton else []
+        for p in gone:
+            ops += [f"delete element ip {NFT_TABLE} user_ports {{ {p} }}",
+                    f"delete element ip {NFT_TABLE} user_ctr {{ {p} }}",
+                    f"delete counter ip {NFT_TABLE} p{p}"]
+        for p in new:
+            ops += [f"add counter ip {NFT_TABLE} p{p}",
+                    f'add element ip {NFT_TABLE} user_ports {{ {p} comment "{want[p]}" }}',
+                    f'add element ip {NFT_TABLE} user_ctr {{ {p} : "p{p}" }}']
+        r = run(["nft", "-f", "-"], input="\n".join(ops) + "\n")
+        if r.returncode != 0: print(f"[firewall] nft failed: {r.stderr.strip()}", flush=True)
+    if not _iptables_migrated:   # empty the iptables chains once so nothing is DNATed/counted twice
+        _reconcile_table("nat", NAT_CHAIN, {}); _reconcile_table("mangle", COUNT_CHAIN, {}); _iptables_quotas({})
+        _iptables_migrated = True
+    return {"added": len(new), "removed": len(gone)}
+
+def nft_counters(listing=None):
+    # {port: (pkts, bytes)} from one structured read of all named counters
     res={}
-    # pkts bytes ... udp dpt:6003 /* user:vip */
-    for line in out:
-        m = re.search(r"^\s*(\d+)\s+(\d+).*\budp\b.*dpt:(\d+).*(?:/\*\s*user:.*\*/)?", line)
-        if m:
-            pk, by, pt = int(m.group(1)), int(m.group(2)), m.group(3)
-            res[pt]=(pk, by)
+    for it in nft_json(run(NFT_LIST_COUNTERS).stdout if listing is None else listing):
+        c = it.get("counter")
+        if c and str(c.get("name","")).startswith("p") and c["name"][1:].isdigit():
+            res[c["name"][1:]] = (int(c.get("packets", 0)), int(c.get("bytes", 0)))
+    return res
+
+def fw_queries():
+    # {name: argv} of the read-only dumps reconcile_rules() / mangle_counters() accept, for run_many()
+    if FW_BACKEND == "nft": return {"nft_table": NFT_LIST_TABLE, "nft_counters": NFT_LIST_COUNTERS}
+    return {"nat": ["iptables-save", "-c", "-t", "nat"], "mangle": ["iptables-save", "-c", "-t", "mangle"]}
+
+def fw_dump_failed(q):
+    # True if a fw_queries() result from run_many() can't be reconciled against. iptables-save never fails on a
+    # healthy box; nft lists fail (fast, "No such file or directory") only while the zivpn table does not exist yet
+    for k in fw_queries():
+        r = q[k]
+        if r.returncode == 0: continue
+        if FW_BACKEND == "nft" and r.returncode not in (CMD_TIMEDOUT, CMD_MISSING) and "No such file or directory" in r.stderr: continue
+        return True
+    return False
+
+def reconcile_rules(users, dumps=None):
+    # -> {"added": n, "removed": n} across both tables; dumps: fw_queries() output already fetched
+    dumps = dumps or {}
+    if FW_BACKEND == "nft": res = nft_reconcile(users, dumps.get("nft_table"))
+    else:
+        a1, r1 = _reconcile_table("nat", NAT_CHAIN, _desired(users, NAT_CHAIN, "DNAT --to-destination :5667"), dumps.get("nat"))
+        a2, r2 = _reconcile_table("mangle", COUNT_CHAIN, _desired(users, COUNT_CHAIN, "RETURN"), dumps.get("mangle"))
+        res = {"added": a1 + a2, "removed": r1 + r2}
+    if res["added"] or res["removed"]: print(f"[firewall] {FW_BACKEND}: +{res['added']} -{res['removed']}", flush=True)
     return res
 
+def mangle_counters(dumps=None):
+    # return {port: (pkts, bytes)} from the COUNT_CHAIN rules of one `iptables-save -c -t mangle`
+    dumps = dumps or {}
+    if FW_BACKEND == "nft": return nft_counters(dumps.get("nft_counters"))
+    dump = dumps.get("mangle")
+    if dump is None: dump = run(["iptables-save", "-c", "-t", "mangle"]).stdout
+    res={}
+    # [pkts:bytes] -A ZIVPN-COUNT -p udp -m udp --dport 6003 -m comment --comment "user:vip" -j RETURN
+    for line in dump.splitlines():
+        m = re.match(rf"\[(\d+):(\d+)\] -A {COUNT_CHAIN} .*--dport (\d+)\b", line)
+        if m: res[m.group(3)] = (int(m.group(1)), int(m.group(2)))
+    return res
+
+# ---------- Per-user data quotas (quota = bytes on the user record; usage = acct total - quota_base) ----------
+# The kernel quota sits on the same packets the counters see (original dport, mangle prerouting), so the panel's
+# "used" and the kernel's drain agree: iptables gets an xt_quota RETURN + DROP pair per user in ZIVPN-QUOTA,
+# nft a named quota object "over <left> bytes" in map user_quota. Traffic is dropped the moment it runs out;
+# the collector marks the user quota_exhausted. A quota is rewritten (with quota - used) only when it changes.
+QUOTA_CHAIN = "ZIVPN-QUOTA"
+BYTES_RE = re.compile(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", re.I)
+
+def parse_bytes(s):
+    # '10G', '500m', '1.5GB', '1048576' -> bytes (binary units); '' -> 0; ValueError otherwise
+    m = BYTES_RE.fullmatch((s or "0").strip())
+    if not m: raise ValueError(s)
+    return int(float(m.group(1)) * 1024 ** "_KMGT".index(m.group(2).upper() or "_"))
+
+DEFAULT_QUOTA = parse_bytes(os.environ.get("DEFAULT_QUOTA", ""))   # e.g. "5G": quota given to every new user; "" = none
+
+def quota_used(u, traffic):
+    return max(int(traffic.get(u.get("user",""), 0) or 0) - int(u.get("quota_base") or 0), 0)
+
+def quota_marks(users, traffic):
+    # users whose quota_exhausted flag has to flip (set when used >= quota, cleared when topped up)
+    out = []
+    for u in users:
+        q = int(u.get("quota") or 0)
+        over = bool(q) and quota_used(u, traffic) >= q
+        if over != bool(u.get("quota_exhausted")):
+            u["quota_exhausted"] = datetime.now().strftime("%Y-%m-%d %H:%M") if over else ""
+            out.append(u)
+    return out
+
+def _desired_quotas(users, traffic):
+    # {port: (quota, base, bytes left)}
+    want = {}
+    for u in users:
+        q = int(u.get("quota") or 0); port = str(u.get("port") or "")
+        if q and port.isdigit(): want[port] = (q, int(u.get("quota_base") or 0), max(q - quota_used(u, traffic), 0))
+    return want
+
+def _iptables_quotas(want, dump=None):
+    if dump is None: dump = run(["iptables-save", "-c", "-t", "mangle"]).stdout
+    tags = {f"quota:{p}:{q}:{base}": (p, left) for p, (q, base, left) in want.items()}
+    have = set(); jumped = False
+    for line in dump.splitlines():
+        rule = line.partition("] ")[2] if line.startswith("[") else line
+        m = re.match(rf"-A {QUOTA_CHAIN} .*--comment \"?(quota:[\d:]+)", rule)
+        if m: have.add(m.group(1))
+        elif rule.startswith("-A PREROUTING ") and rule.endswith(f"-j {QUOTA_CHAIN}"): jumped = True
+    if have != tags.keys() or (tags and not jumped):
+        payload = ["*mangle", f":{QUOTA_CHAIN} - [0:0]"]   # declaring the chain with --noflush replaces its contents
+        if not jumped: payload.append(f"-A PREROUTING -p udp -j {QUOTA_CHAIN}")   # after the ZIVPN-COUNT jump at 1
+        for tag, (p, left) in tags.items():
+            match = f"-A {QUOTA_CHAIN} -p udp -m udp --dport {p} -m comment --comment \"{tag}\""
+            payload += [f"{match} -m quota --quota {left} -j RETURN", f"{match} -j DROP"]
+        payload.append("COMMIT")
+        r = run(["iptables-restore", "-w", XT_WAIT, "--noflush"], input="\n".join(payload) + "\n")
+        if r.returncode != 0: print(f"[firewall] iptables-restore quotas failed: {r.stderr.strip()}", flush=True)
+    return {"added": len(tags.keys() - have), "removed": len(have - tags.keys())}
+
+def _nft_quotas(want, listing=None):
+    names = {p: f"q{p}_{q}_{base}" for p, (q, base, _) in want.items()}
+    have = {}
+    for it in nft_json(run(NFT_LIST_TABLE).stdout if listing is None else listing):
+        m = re.fullmatch(r"q(\d+)_\d+_\d+", str((it.get("quota") or {}).get("name", "")))
+        if m: have[m.group(1)] = m.group(0)
+    gone = [p for p in have if names.get(p) != have[p]]
+    new = [p for p in names if have.get(p) != names[p]]
+    if gone or new:
+        ops = []
+        for p in gone:
+            ops += [f"delete element ip {NFT_TABLE} user_quota {{ {p} }}", f"delete quota ip {NFT_TABLE} {have[p]}"]
+        for p in new:
+            ops += [f"add quota ip {NFT_TABLE} {names[p]} {{ over {want[p][2]} bytes }}",
+                    f'add element ip {NFT_TABLE} user_quota {{ {p} : "{names[p]}" }}']
+        r = run(["nft", "-f", "-"], input="\n".join(ops) + "\n")
+        if r.returncode != 0: print(f"[firewall] nft quotas failed: {r.stderr.strip()}", flush=True)
+    return {"added": len(new), "removed": len(gone)}
+
+def apply_quotas(users, traffic, dumps=None):
+    # -> {"added": n, "removed": n}; dumps: fw_queries() output already fetched (taken before reconciling)
+    dumps = dumps or {}
+    want = _desired_quotas(users, traffic)
+    if FW_BACKEND == "nft": return _nft_quotas(want, dumps.get("nft_table"))
+    return _iptables_quotas(want, dumps.get("mangle"))
+
 # ---------- Status / Bind IP ----------
 def status_for_user_by_counters(port, counters):
     if not port: return "Inactive"
@@ -157,53 +655,544 @@ def status_for_user_by_counters(port, counters):
     if pk > 0: return "Online"
     return "Inactive"
 
-def try_autolock_bind_ip(u):
+# ---------- Conntrack snapshot (one dump per render, indexed by dport) ----------
+def _ct_timeout(name, default):
+    try:
+        with open(f"/proc/sys/net/netfilter/nf_conntrack_{name}") as f: return int(f.read().strip())
+    except Exception:
+        return default
+
+CT_UDP_TIMEOUT        = _ct_timeout("udp_timeout", 30)
+CT_UDP_TIMEOUT_STREAM = _ct_timeout("udp_timeout_stream", 120)
+
+def parse_conntrack(text):
+    # {dport: {"src":[ip,...], "packets":n, "bytes":n, "age":secs since last packet}}
+    idx={}
+    for line in text.splitlines():
+        f = line.split()
+        if len(f) < 4 or f[0] != "udp" or not f[2].isdigit(): continue
+        orig={}; pk=by=0
+        for tok in f[3:]:
+            k, _, v = tok.partition("=")
+            if not v: continue
+            if k == "packets" and v.isdigit(): pk += int(v)
+            elif k == "bytes" and v.isdigit(): by += int(v)
+            elif k not in orig: orig[k] = v   # first tuple = original direction
+        port, src = orig.get("dport"), orig.get("src","")
+        if not port: continue
+        timeout = CT_UDP_TIMEOUT_STREAM if "[ASSURED]" in line else CT_UDP_TIMEOUT
+        age = max(0, timeout - int(f[2]))
+        e = idx.get(port)
+        if e is None: e = idx[port] = {"src":[], "packets":0, "bytes":0, "age":age}
+        if re.fullmatch(r"(\d{1,3}\.){3}\d{1,3}", src) and src not in e["src"]: e["src"].append(src)
+        e["packets"] += pk; e["bytes"] += by
+        if age < e["age"]: e["age"] = age
+    return idx
+
+CONNTRACK_CMD = ["conntrack", "-L", "-p", "udp"]
+
+def conntrack_snapshot():
+    return parse_conntrack(run(CONNTRACK_CMD).stdout)
+
+def try_autolock_bind_ip(u, ct):
     if u.get("bind_ip") or not u.get("port"):
-        return
-    # best-effort: find recent src for this port from conntrack (may miss in some cases)
-    port = u["port"]
-    cmd = (
-        "conntrack -L -p udp 2>/dev/null | "
-        f"awk '/dport={port}/ && /src=/ {{for(i=1;i<=NF;i++) if($i~/src=/){{split($i,a,\"=\"); print a[2]; exit}}}}'"
-    )
-    ip = shell(cmd).stdout.strip()
-    if re.fullmatch(r'(\\d{1,3}\\.){3}\\d{1,3}', ip):
-        u["bind_ip"] = ip
+        return False
+    # best-effort: first source seen on this port in the shared conntrack snapshot
+    e = ct.get(str(u["port"]))
+    if e and e["src"]:
+        u["bind_ip"] = e["src"][0]
+        return True
+    return False
 
 # ---------- Sync passwords to ZIVPN config ----------
+# The file is only rewritten when the password set (or defaults) changed, and restarts are debounced:
+# N adds within SYNC_DEBOUNCE seconds cause at most one `systemctl restart zivpn.service`.
+# With WEB_WORKERS>1 the applied digest, the pending restart and the counters live in STATE_FILE.sync under the
+# store flock, so a restart one worker has scheduled absorbs the syncs of all the others.
+SYNC_DEBOUNCE = float(os.environ.get("SYNC_DEBOUNCE", "2"))
+SYNC_PENDING_STALE = 60   # a pending restart this far past due belonged to a worker that went away
+_sync = {"applied": None, "pending": 0.0, "restarts": 0, "avoided": 0}   # pending: when the scheduled restart is due
+_sync_lock = threading.Lock()
+
+def _cfg_digest(cfg): return json.dumps(cfg, sort_keys=True)
+
+@contextmanager
+def _sync_state():
+    # the debounce state, read-modify-written under the store lock (lock order: store, then sync)
+    with store_locked(), _sync_lock:
+        if WEB_WORKERS <= 1: yield _sync; return
+        path = STATE_FILE + ".sync"
+        st = {**_sync, **read_json(path, {})}; before = dict(st)
+        yield st
+        if st != before: write_json_atomic(path, st)
+
+def _pending(st): return bool(st["pending"]) and time.time() < st["pending"] + SYNC_PENDING_STALE
+
+def _restart_zivpn():
+    with _sync_state() as st:
+        st["pending"] = 0.0
+        cur = _cfg_digest(read_json(CONFIG_FILE, {}))
+        if cur == st["applied"]:
+            st["avoided"] += 1; return False
+        st["applied"] = cur; st["restarts"] += 1
+    run(["systemctl", "restart", "zivpn.service"], timeout=60)
+    return True
+
+def schedule_restart():
+    if SYNC_DEBOUNCE <= 0: return _restart_zivpn()
+    with _sync_state() as st:
+        if _pending(st):
+            st["avoided"] += 1; return False   # folded into the pending restart, whichever worker scheduled it
+        st["pending"] = time.time() + SYNC_DEBOUNCE
+    t = threading.Timer(SYNC_DEBOUNCE, _restart_zivpn); t.daemon = True; t.start()
+    return True
+
+def sync_stats():
+    # no lock: STATE_FILE.sync is replaced atomically
+    if WEB_WORKERS > 1: st = {**_sync, **read_json(STATE_FILE + ".sync", {})}
+    else:
+        with _sync_lock: st = dict(_sync)
+    return {"restarts": st["restarts"], "avoided": st["avoided"], "pending": _pending(st)}
+
 def sync_config_pw():
-    cfg=read_json(CONFIG_FILE, {})
-    users=load_users()
-    pws=sorted({str(u["password"]) for u in users if u.get("password")})
-    if not isinstance(cfg.get("auth"), dict): cfg["auth"]={}
-    cfg["auth"]["mode"]="passwords"; cfg["auth"]["config"]=pws
-    cfg["listen"]=cfg.get("listen") or ":5667"
-    cfg["cert"]=cfg.get("cert") or "/etc/zivpn/zivpn.crt"
-    cfg["key"]=cfg.get("key") or "/etc/zivpn/zivpn.key"
-    cfg["obfs"]=cfg.get("obfs") or "zivpn"
-    write_json_atomic(CONFIG_FILE, cfg)
-    shell("systemctl restart zivpn.service")
-
-# ---------- Auto expiry + prune (+ cleanup rules) ----------
-def ensure_expiry_and_prune(users):
-    today = date.today()
-    changed=False; kept=[]
+    with _sync_state() as st:
+        cfg=read_json(CONFIG_FILE, {})
+        before=_cfg_digest(cfg)
+        if st["applied"] is None: st["applied"]=before   # the running service was started with this file
+        users=load_users()
+        pws=sorted({str(u["password"]) for u in users if u.get("password")})
+        if not isinstance(cfg.get("auth"), dict): cfg["auth"]={}
+        cfg["auth"]["mode"]="passwords"; cfg["auth"]["config"]=pws
+        cfg["listen"]=cfg.get("listen") or ":5667"
+        cfg["cert"]=cfg.get("cert") or "/etc/zivpn/zivpn.crt"
+        cfg["key"]=cfg.get("key") or "/etc/zivpn/zivpn.key"
+        cfg["obfs"]=cfg.get("obfs") or "zivpn"
+        if _cfg_digest(cfg) == before:
+            st["avoided"] += 1; return False
+        write_json_atomic(CONFIG_FILE, cfg)
+    return schedule_restart()
+
+# ---------- Serving: WEB_WORKERS>1 runs gunicorn; one worker (flock leader) collects, the rest mirror STATE_FILE ----------
+WEB_WORKERS  = int(os.environ.get("WEB_WORKERS", "1"))    # processes; 1 = single process
+WEB_THREADS  = int(os.environ.get("WEB_THREADS", "8"))    # request threads per process (SSE viewers hold one each)
+STATE_FILE   = os.environ.get("STATE_FILE", "/run/zivpn/web2day-state.pickle")
+_leader = {"lock": None, "fh": None, "wake": 0}
+
+def try_lead():
+    # take the collector role unless another worker holds it; the flock dies with its process
+    if _leader["lock"]: return True
+    if _leader["fh"] is None:
+        os.makedirs(os.path.dirname(STATE_FILE) or ".", exist_ok=True)
+        _leader["fh"] = open(STATE_FILE + ".lock", "a")
+    try: fcntl.flock(_leader["fh"], fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError: return False
+    _leader["lock"] = _leader["fh"]
+    try: _leader["wake"] = os.stat(STATE_FILE + ".wake").st_mtime_ns   # only touches from now on count
+    except OSError: pass
+    print(f"[serve] pid {os.getpid()} collects for all workers", flush=True)
+    return True
+
+def share_state(snap):
+    # leader: publish the snapshot for the other workers (atomic replace)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(STATE_FILE) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f: pickle.dump(snap, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, STATE_FILE)
+    finally:
+        try: os.remove(tmp)
+        except OSError: pass
+
+def wait_for_wake(timeout):
+    # collector sleep; with several workers a follower's request_refresh() touches STATE_FILE.wake to end it early
+    if WEB_WORKERS <= 1:
+        _state_wake.wait(timeout); _state_wake.clear(); return
+    end = time.time() + timeout
+    while time.time() < end and not _state_wake.wait(min(1, max(end - time.time(), 0))):
+        try: m = os.stat(STATE_FILE + ".wake").st_mtime_ns
+        except OSError: continue
+        if m != _leader["wake"]:
+            _leader["wake"] = m; _expiry_wake.set(); break
+    _state_wake.clear()
+
+def _mirror_loop():
+    # follower: load each new STATE_FILE into _state (and the SSE ring) until the leader goes away, then lead
+    global _state
+    seen = None
+    while not try_lead():
+        try:
+            st = os.stat(STATE_FILE); sig = (st.st_ino, st.st_mtime_ns)
+            if sig != seen:
+                with open(STATE_FILE, "rb") as f: snap = pickle.load(f)
+                seen = sig
+                with _state_cv:
+                    if snap["version"] != _state["version"]:
+                        if not _state["version"]: _events_floor[0] = snap["version"]   # joined mid-stream: nothing before this is in the ring
+                        publish_live(snap, _state); _state = snap; _state_cv.notify_all()
+        except (OSError, EOFError, pickle.UnpicklingError): pass
+        time.sleep(0.5)
+    _collector_loop()
+
+def serve():
+    # gunicorn (gthread) with WEB_WORKERS x WEB_THREADS when asked for and installed, else the threaded dev server
+    if WEB_WORKERS > 1:
+        try: from gunicorn.app.base import BaseApplication
+        except ImportError: print("[serve] gunicorn not installed (apt install python3-gunicorn); using one process", flush=True)
+        else:
+            class Server(BaseApplication):
+                def load_config(self):
+                    for k, v in {"bind": f"0.0.0.0:{WEB_PORT}", "workers": WEB_WORKERS, "threads": WEB_THREADS,
+                                 "worker_class": "gthread", "timeout": 60, "graceful_timeout": 5}.items(): self.cfg.set(k, v)
+                def load(self): return app
+            _sse_cap[0] = max(min(SSE_MAX_CLIENTS, WEB_THREADS - 2), 0)   # each viewer holds a gthread; keep two for /add, /metrics
+            return Server().run()
+    app.run(host="0.0.0.0", port=WEB_PORT, threaded=True)
+
+# ---------- Auto expiry: a min-heap of expiry instants, one thread sleeps until the next account runs out ----------
+EXPIRY_GRACE_HOURS = float(os.environ.get("EXPIRY_GRACE_HOURS", "0"))   # keep expired users this long past their last day
+EXPIRY_RECHECK = 300   # max sleep, so store edits made outside this process are picked up
+_expiry = {"heap": [], "version": None, "removed": 0}
+_expiry_wake = threading.Event()
+
+def expiry_due(expires):
+    # epoch seconds when a YYYY-MM-DD expiry (valid through that day) + grace runs out; None if unset/bad
+    try: d = datetime.strptime(expires or "", "%Y-%m-%d")
+    except ValueError: return None
+    return (d + timedelta(days=1, hours=EXPIRY_GRACE_HOURS)).timestamp()
+
+def _expiry_heap():
+    # (due, user) min-heap, rebuilt only when the store changed; also fills in missing/bad dates once
+    v = store_version()
+    if v == _expiry["version"]: return _expiry["heap"]
+    today = date.today(); fixed = {}; heap = []
+    for u in load_users():
+        if not u.get("user"): continue
+        t = expiry_due(u.get("expires"))
+        p = {}
+        if not u.get("created_on"): p["created_on"] = today.strftime("%Y-%m-%d")
+        if t is None: p["expires"] = (today + timedelta(days=DEFAULT_DAYS)).strftime("%Y-%m-%d"); t = expiry_due(p["expires"])
+        if p: fixed[u["user"]] = p
+        heap.append((t, u["user"]))
+    if fixed: patch_users(fixed); v = store_version()   # only the filled-in fields, merged into the current records
+    heapq.heapify(heap)
+    _expiry["heap"] = heap; _expiry["version"] = v
+    return heap
+
+def prune_expired(now=None):
+    # drop every user past expiry + grace in one store write, then one rules pass and one config sync
+    now = now or time.time()
+    with store_locked():   # decide and delete under one lock, so an expiry extended meanwhile is honoured
+        gone = delete_users([u["user"] for u in load_users()
+                             if u.get("user") and (expiry_due(u.get("expires")) or float("inf")) <= now])
+    if not gone: return []
+    reconcile_rules(load_users())
+    sync_config_pw()
+    _expiry["removed"] += len(gone)
+    print(f"[expiry] removed {len(gone)}: {', '.join(u['user'] for u in gone[:20])}", flush=True)
+    request_refresh()
+    return gone
+
+def _expiry_loop():
+    while True:
+        wait = EXPIRY_RECHECK
+        try:
+            heap = _expiry_heap(); now = time.time()
+            if heap and heap[0][0] <= now:
+                while heap and heap[0][0] <= now: heapq.heappop(heap)
+                prune_expired(now)
+            if heap: wait = min(wait, max(heap[0][0] - time.time(), 0.5))
+        except Exception as e: print(f"[expiry] {e}", flush=True)
+        _expiry_wake.wait(wait); _expiry_wake.clear()
+
+# ---------- Traffic accounting: per-port counters -> monotonic per-user totals + ring-buffer rollups ----------
+ACCT_FILE = os.environ.get("ACCT_FILE", "/var/lib/zivpn/traffic.ring")
+ACCT_SLOTS = int(os.environ.get("ACCT_SLOTS", "4096")) # users the ring file holds; file size is fixed by this
+ACCT_RINGS = (("minute",60,60), ("hour",3600,24), ("day",86400,31)) # (name, bucket seconds, buckets)
+_ACCT_HDR = struct.Struct("<4sHI3q")          # magic, version, slots, last minute/hour/day bucket written
+_ACCT_REC = struct.Struct("<32sIQQ60Q24Q31Q") # user key, port, total, last raw counter, minute/hour/day rings
+_ACCT_VERSION = 2                             # 1 stored the name itself, cut at 32 bytes
+_ACCT_HDR_SIZE = 64
+_ACCT_RING_BASE = (4, 64, 88)                 # index of each ring inside an unpacked record
+_acct = {"mm":None, "slots":{}, "free":[]}
+_acct_lock = threading.Lock()
+
+def _acct_off(i): return _ACCT_HDR_SIZE+i*_ACCT_REC.size
+
+def _acct_key(name):
+    # slot key: fixed-size digest of the lowercased name (any length, no UTF-8 cut in half)
+    return hashlib.blake2b(name.lower().encode(), digest_size=32).digest()
+
+def _acct_open():
+    # mmap of ACCT_FILE (created/resized to ACCT_SLOTS records) and the user -> slot index
+    if _acct["mm"] is not None: return _acct["mm"]
+    os.makedirs(os.path.dirname(ACCT_FILE) or ".", exist_ok=True)
+    size=_acct_off(ACCT_SLOTS)
+    fd=os.open(ACCT_FILE, os.O_RDWR|os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size!=size: os.ftruncate(fd, size) # records sit at fixed offsets, so resizing keeps them
+        mm=mmap.mmap(fd, size)
+    finally: os.close(fd)
+    hdr=list(_ACCT_HDR.unpack_from(mm,0))
+    if hdr[0]!=b"ZVAC":
+        mm[:size]=bytes(size); e=time.time()
+        _ACCT_HDR.pack_into(mm, 0, b"ZVAC", _ACCT_VERSION, ACCT_SLOTS, *(int(e//step) for _,step,_ in ACCT_RINGS))
+    elif hdr[1]==1: # name -> digest in place; totals survive (names longer than 32 bytes were already cut and start over)
+        for i in range(ACCT_SLOTS):
+            name=mm[_acct_off(i):_acct_off(i)+32].rstrip(b"\0")
+            if name: mm[_acct_off(i):_acct_off(i)+32]=_acct_key(name.decode("utf-8","replace"))
+        hdr[1]=_ACCT_VERSION; _ACCT_HDR.pack_into(mm, 0, *hdr)
+    slots={}; free=[]
+    for i in range(ACCT_SLOTS):
+        key=mm[_acct_off(i):_acct_off(i)+32]
+        if any(key): slots[key]=i
+        else: free.append(i)
+    free.reverse()
+    _acct.update(mm=mm, slots=slots, free=free)
+    return mm
+
+def _acct_advance(mm, now):
+    # zero the ring buckets of every bucket period that passed since the last sample
+    hdr=list(_ACCT_HDR.unpack_from(mm,0))
+    for k,(_,step,n) in enumerate(ACCT_RINGS):
+        e=int(now//step); last=hdr[3+k]
+        if e<=last: continue
+        stale=[b%n for b in range(max(last+1, e-n+1), e+1)]
+        for i in _acct["slots"].values():
+            for b in stale: struct.pack_into("<Q", mm, _acct_off(i)+52+8*(_ACCT_RING_BASE[k]-4+b), 0)
+        hdr[3+k]=e
+    _ACCT_HDR.pack_into(mm, 0, *hdr)
+
+def acct_sample(users, raw, now=None):
+    # fold raw per-port counters into per-user totals/rollups; counter resets (rule re-created, reboot)
+    # and port moves count from zero instead of going negative. Rewrites TRAFFIC_FILE when a total moved.
+    now=now or time.time()
+    with _acct_lock:
+        mm=_acct_open(); slots=_acct["slots"]
+        _acct_advance(mm, now)
+        idx=[base+int(now//step)%n for base,(_,step,n) in zip(_ACCT_RING_BASE, ACCT_RINGS)]
+        totals={}; seen=set(); moved=False
+        for u in users:
+            name=u.get("user",""); port=str(u.get("port","") or "")
+            if not name: continue
+            key=_acct_key(name); i=slots.get(key)
+            if i is None:
+                if not _acct["free"]: continue # ring file full: raise ACCT_SLOTS
+                i=slots[key]=_acct["free"].pop(); rec=[key]+[0]*118; moved=True
+            else: rec=list(_ACCT_REC.unpack_from(mm, _acct_off(i)))
+            cur=raw.get(port)
+            if cur is not None:
+                delta=cur if rec[1]!=int(port) or cur<rec[3] else cur-rec[3]
+                rec[1]=int(port); rec[3]=cur
+                if delta:
+                    rec[2]+=delta; moved=True
+                    for j in idx: rec[j]+=delta
+            _ACCT_REC.pack_into(mm, _acct_off(i), *rec)
+            totals[name]=rec[2]; seen.add(key)
+        for key in [k for k in slots if k not in seen]: # deleted users give their slot back
+            i=slots.pop(key); mm[_acct_off(i):_acct_off(i+1)]=bytes(_ACCT_REC.size); _acct["free"].append(i); moved=True
+        mm.flush()
+    if moved or not os.path.exists(TRAFFIC_FILE): write_json_atomic(TRAFFIC_FILE, totals)
+    return totals
+
+def acct_history(name, res="hour"):
+    # {"total", "buckets": [[bucket_start_epoch, bytes], ...] oldest first} for one user, or None
+    k=[r[0] for r in ACCT_RINGS].index(res) # ValueError for an unknown resolution
+    _,step,n=ACCT_RINGS[k]
+    with _acct_lock:
+        mm=_acct_open(); i=_acct["slots"].get(_acct_key(name))
+        if i is None: return None
+        rec=_ACCT_REC.unpack_from(mm, _acct_off(i)); last=_ACCT_HDR.unpack_from(mm,0)[3+k]
+    e=int(time.time()//step)
+    return {"total":rec[2], "buckets":[[b*step, rec[_ACCT_RING_BASE[k]+b%n] if b<=last else 0] for b in range(e-n+1, e+1)]}
+
+
+# ---------- Background state collector (requests never shell out) ----------
+_state = {"version":0, "at":0.0, "counters":{}, "firewall":{}, "udp_listen":set(), "listen_port":"5667", "bind_ips":{}}
+_state_cv = threading.Condition()
+_state_wake = threading.Event()
+_collector = None
+
+def collect_state():
+    # per-user rules + counters + auto-lock, then publish a new snapshot (expiry has its own thread)
+    # all read-only queries run concurrently up front; reconcile + counters share the same dumps
+    global _state
+    t0 = time.perf_counter()
+    users = load_users()
+    q = run_many({**fw_queries(), "ct": CONNTRACK_CMD, "ss": ["ss", "-uHln"],
+                  "service": ["systemctl", "is-active", "zivpn.service"]})
+    dumps = {k: r.stdout for k, r in q.items()}
+    failed = fw_dump_failed(q)
+    if failed:
+        # reconciling against a cut-off dump would re-add every jump rule; keep the firewall and last counters
+        print(f"[collector] firewall dump failed, left as is: {' '.join(q[k].stderr.strip() for k in fw_queries())}", flush=True)
+        fw = _state["firewall"]; ctr = _state["counters"]; rules = _state.get("rules", {})
+    else:
+        fw = reconcile_rules(users, dumps)
+        ctr = mangle_counters(dumps)  # original dport counters
+        rules = rule_counts(dumps)
+    ct = parse_conntrack(dumps["ct"]); locked = set()
     for u in users:
-        if not u.get("created_on"):
-            u["created_on"]=today.strftime("%Y-%m-%d"); changed=True
-        if not u.get("expires"):
-            u["expires"]=(today+timedelta(days=DEFAULT_DAYS)).strftime("%Y-%m-%d"); changed=True
-        try: exp=datetime.strptime(u["expires"], "%Y-%m-%d").date()
-        except Exception:
-            exp=today+timedelta(days=DEFAULT_DAYS)
-            u["expires"]=exp.strftime("%Y-%m-%d"); changed=True
-        if exp < today:
-            nat_rule_del(user=u.get("user",""), port=u.get("port"))
-            mangle_rule_del(user=u.get("user",""), port=u.get("port"))
-            continue
-        kept.append(u)
-    if changed or len(kept)!=len(users): save_users(kept)
-    return kept
+        if status_for_user_by_counters(u.get("port"), ctr) == "Online" and not u.get("bind_ip"):
+            if try_autolock_bind_ip(u, ct): locked.add(u["user"])
+    if locked: patch_users({u["user"]: {"bind_ip": u["bind_ip"]} for u in users if u["user"] in locked})
+    traffic = acct_sample(users, {p: by for p, (_, by) in ctr.items()})
+    marks = quota_marks(users, traffic)
+    if marks: patch_users({u["user"]: {"quota_exhausted": u["quota_exhausted"]} for u in marks})
+    quotas = _state.get("quotas", {}) if failed else apply_quotas(users, traffic, dumps)
+    listen = set(re.findall(r":(\d+)\s", dumps["ss"]))
+    online_sig = zlib.crc32(",".join(sorted(p for p, (pk, _) in ctr.items() if pk > 0)).encode())   # the set of Online ports
+    traffic_sig = zlib.crc32(repr(sorted(traffic.items())).encode())
+    snap = {
+        "version": _state["version"] + 1, "at": time.time(), "counters": ctr, "firewall": fw,
+        "online_sig": online_sig, "traffic_sig": traffic_sig,
+        "udp_listen": listen, "listen_port": get_listen_port(), "ports": check_ports(listen),
+        "bind_ips": {u["user"]: u["bind_ip"] for u in users if u.get("bind_ip")},
+        "traffic": traffic, "live": live_rows(users, ctr, traffic), "rules": rules, "quotas": quotas,
+        "expired": sum(1 for u in users if u.get("expires", "") < date.today().strftime("%Y-%m-%d")),
+        "service": dumps["service"].strip() or "unknown", "collect_ms": round((time.perf_counter() - t0) * 1000),
+        "commands": cmd_stats(),
+    }
+    with _state_cv:
+        publish_live(snap, _state)
+        _state = snap
+        _state_cv.notify_all()
+    return snap
+
+def rule_counts(dumps):
+    # {chain, or nft set/map: entries} in this cycle's firewall dumps (taken before reconciling)
+    c = collections.Counter()
+    if FW_BACKEND == "nft":
+        for it in nft_json(dumps.get("nft_table")):
+            s = it.get("set") or it.get("map")
+            if s: c[s.get("name", "")] += len(s.get("elem", []))
+    else:
+        for k in ("nat", "mangle"):
+            for line in (dumps.get(k) or "").splitlines():
+                m = re.match(r"(?:\[\d+:\d+\] )?-A (ZIVPN\S*)", line)
+                if m: c[m.group(1)] += 1
+    return dict(c)
+
+# ---------- Live push (SSE): the collector diffs per-user rows, /events fans the diffs out ----------
+SSE_KEEPALIVE = 20   # seconds between keepalive comments on an idle stream
+SSE_MAX_CLIENTS = int(os.environ.get("SSE_MAX_CLIENTS", "20"))   # per process; serve() lowers it to WEB_THREADS-2 under gunicorn
+_events = collections.deque(maxlen=64)   # (state version, json diff); guarded by _state_cv
+_events_floor = [0]   # newest version already evicted from _events
+_sse_clients = [0]   # open /events streams in this worker; checked and counted together under _sse_lock
+_sse_lock = threading.Lock()
+_sse_cap = [SSE_MAX_CLIENTS]   # effective per-process limit
+
+def live_rows(users, ctr, traffic):
+    # {user: (status, traffic_bytes, bind_ip)} — what the cards patch in place
+    return {u["user"]: (status_for_user_by_counters(u.get("port"), ctr), traffic.get(u["user"], 0),
+                        u.get("bind_ip","")) for u in users if u.get("user")}
+
+def live_diff(old, new):
+    changes = []
+    for name, row in new.items():
+        o = old.get(name)
+        if o == row: continue
+        d = {"user": name}
+        if not o or o[0] != row[0]: d["status"] = row[0]
+        if not o or o[1] != row[1]: d["traffic"] = bytes_to_human(row[1]); d["traffic_delta"] = row[1] - (o[1] if o else 0)
+        if not o or o[2] != row[2]: d["bind_ip"] = row[2]
+        changes.append(d)
+    return changes, [n for n in old if n not in new]
+
+def publish_live(snap, prev):
+    # called by the collector with _state_cv held
+    if not prev.get("version"): return   # first snapshot: nothing to diff against
+    changes, removed = live_diff(prev.get("live", {}), snap["live"])
+    if not (changes or removed): return
+    if len(_events) == _events.maxlen: _events_floor[0] = _events[0][0]
+    _events.append((snap["version"], json.dumps({"changes": changes, "removed": removed,
+                    "online": sum(r[0] == "Online" for r in snap["live"].values())})))
+
+def sse_stream(last):
+    # one subscriber: waits on the shared snapshot condition, never queries anything itself
+    yield "retry: 5000\n\n"
+    while True:
+        with _state_cv:
+            _state_cv.wait_for(lambda: _state["version"] != last, timeout=SSE_KEEPALIVE)
+            cur = _state["version"]; evs = [e for e in _events if e[0] > last]
+        if cur == last:
+            yield ": keepalive\n\n"; continue
+        if last and (last < _events_floor[0] or last > cur):
+            # fell behind the ring buffer, or an id from before a panel restart (versions start over): reload
+            yield f"id: {cur}\nevent: reset\ndata: {{}}\n\n"
+            last = cur; continue
+        for v, data in evs: yield f"id: {v}\nevent: diff\ndata: {data}\n\n"
+        last = cur
+
+def _collector_loop():
+    threading.Thread(target=_expiry_loop, name="expiry", daemon=True).start()
+    while True:
+        try:
+            snap = collect_state()
+            if WEB_WORKERS > 1: share_state(snap)
+        except Exception as e: print(f"[collector] {e}", flush=True)
+        wait_for_wake(STATE_INTERVAL)
+
+def start_collector():
+    # this process's collector, or a mirror of the leading worker's snapshots
+    global _collector
+    with _state_cv:
+        if _collector is None:
+            lead = WEB_WORKERS <= 1 or try_lead()
+            _collector = threading.Thread(target=_collector_loop if lead else _mirror_loop,
+                                          name="state-collector" if lead else "state-mirror", daemon=True)
+            _collector.start()
+
+def get_state(wait=5.0):
+    # only the first call after startup blocks until the collector has run once
+    start_collector()
+    with _state_cv:
+        if _state["version"] == 0: _state_cv.wait_for(lambda: _state["version"] > 0, timeout=wait)
+        return _state
+
+def request_refresh(wait=0):
+    seen = _state["version"]
+    _state_wake.set(); _expiry_wake.set()
+    if WEB_WORKERS > 1 and not _leader["lock"]:
+        try: os.utime(STATE_FILE + ".wake", None)
+        except OSError: open(STATE_FILE + ".wake", "a").close()
+    if wait:
+        with _state_cv: _state_cv.wait_for(lambda: _state["version"] > seen, timeout=wait)
+
+# ---------- Prometheus /metrics: rendered from the collector snapshot only, never from a fresh query ----------
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "").strip()   # "Authorization: Bearer <token>" required when set
+METRICS_USER_LIMIT = int(os.environ.get("METRICS_USER_LIMIT", "500"))   # per-user series cap (online first, then most bytes); 0 = none
+_metrics_cache = {"version": None, "text": ""}
+
+def _prom_labels(labels):
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}" if labels else ""
+
+def _prom_metric(out, name, kind, help, samples):
+    out.append(f"# HELP {name} {help}"); out.append(f"# TYPE {name} {kind}")
+    out.extend(f"{name}{_prom_labels(labels)} {val}" for labels, val in samples)
+
+def metrics_text(st):
+    # exposition text of one snapshot, rendered once per collector cycle
+    if _metrics_cache["version"] == st["version"]: return _metrics_cache["text"]
+    out = []; metric = lambda *a: _prom_metric(out, *a)
+    live = st.get("live", {})
+    metric("zivpn_users", "gauge", "Users in the store.", [({}, len(live))])
+    metric("zivpn_users_online", "gauge", "Users with recent UDP traffic.", [({}, sum(r[0] == "Online" for r in live.values()))])
+    metric("zivpn_users_expired", "gauge", "Users past their expiry date.", [({}, st.get("expired", 0))])
+    metric("zivpn_users_locked", "gauge", "Users locked to one device.", [({}, len(st.get("bind_ips", {})))])
+    metric("zivpn_firewall_rules", "gauge", "Entries in the panel's chains (nft: sets/maps) at the last collection.",
+           [({"chain": k}, n) for k, n in sorted(st.get("rules", {}).items())])
+    metric("zivpn_service_up", "gauge", "1 if zivpn.service was active at the last collection.", [({}, int(st.get("service") == "active"))])
+    metric("zivpn_collector_cycles_total", "counter", "Collector snapshots published.", [({}, st["version"])])
+    metric("zivpn_collector_last_run_timestamp_seconds", "gauge", "When the last snapshot was taken.", [({}, round(st["at"], 3))])
+    metric("zivpn_collector_duration_seconds", "gauge", "How long the last collection took.", [({}, st.get("collect_ms", 0) / 1000)])
+    if METRICS_USER_LIMIT > 0:
+        top = sorted(live.items(), key=lambda kv: (kv[1][0] != "Online", -int(kv[1][1] or 0), kv[0].lower()))[:METRICS_USER_LIMIT]
+        metric("zivpn_user_bytes_total", "counter", "Bytes through each user's port.", [({"user": n}, int(r[1] or 0)) for n, r in top])
+        metric("zivpn_user_online", "gauge", "1 if the user has recent UDP traffic.", [({"user": n}, int(r[0] == "Online")) for n, r in top])
+        metric("zivpn_user_series_dropped", "gauge", "Users left out of the per-user series by METRICS_USER_LIMIT.", [({}, len(live) - len(top))])
+    text = "\n".join(out) + "\n"
+    _metrics_cache.update(version=st["version"], text=text)
+    return text
 
 # ---------- THEME / HTML ----------
 LOGO_URL="https://raw.githubusercontent.com/Upk123/upkvip-ziscript/refs/heads/main/20251018_231111.png"
@@ -267,6 +1256,7 @@ footer{position:fixed;left:0;right:0;bottom:0;background:var(--card);border-top:
 .nav{display:flex;gap:8px;justify-content:space-around}
 .nav a{color:var(--muted);text-decoration:none;font-size:12px}
 .nav a.active{color:#111827;font-weight:800}
+.pager{display:flex;gap:10px;align-items:center;justify-content:center;margin:14px 0}
 </style>
 <script>
 function copyToClipboard(text){
@@ -283,7 +1273,7 @@ function copyToClipboard(text){
       <img class="logo" src="{{ logo }}">
       <div>
         <h1>DEV-U PHOE KAUNT</h1>
-        <div class="sub">ZIVPN Free Panel • Total <b>{{ total }}</b></div>
+        <div class="sub">ZIVPN Free Panel • Total <b>{{ total }}</b>{% if state_version %} • Status {{ state_age }}s ago ({{ collect_ms }} ms){% endif %}{% if service and service!="active" %} • <span style="color:var(--bad)">zivpn {{ service }}</span>{% endif %}{% if sync %} • Restarts {{ sync.restarts }} (avoided {{ sync.avoided }}){% endif %}</div>
       </div>
     </div>
     <form method="post" action="{{ url_for('refresh_status', filter=filter_type) }}">
@@ -298,7 +1288,7 @@ function copyToClipboard(text){
   <div class="grid">
     <div class="card kpi"><div class="label">Today Created</div><div class="value">{{ today_new }}</div></div>
     <div class="card kpi"><div class="label">This Month Created</div><div class="value">{{ month_new }}</div></div>
-    <div class="card kpi"><div class="label">Online</div><div class="value">{{ online_count }}</div></div>
+    <div class="card kpi"><div class="label">Online</div><div class="value" id="online-kpi">{{ online_count }}</div></div>
     <div class="card kpi"><div class="label">Expired (auto-removed)</div><div class="value">{{ expired_count }}</div></div>
   </div>
 
@@ -317,7 +1307,7 @@ function copyToClipboard(text){
   <!-- Add user (auto 2 days) -->
   <div class="card">
     <div style="display:flex;align-items:center;justify-content:space-between;margin-bottom:8px">
-      <div style="font-weight:800">➕ အသုံးပြုသူ အသစ် (Auto {{ default_days }} days)</div>
+      <div style="font-weight:800">➕ အသုံးပြုသူ အသစ် (Auto {{ default_days }} days{% if default_quota %}, {{ default_quota }}{% endif %})</div>
       {% if msg %}<div style="color:#059669">{{ msg }}</div>{% endif %}
       {% if err %}<div style="color:#b91c1c">{{ err }}</div>{% endif %}
     </div>
@@ -333,26 +1323,60 @@ function copyToClipboard(text){
   <!-- User list -->
   <div class="userlist">
     {% for u in users %}
-      <div class="ucard">
+      <div class="ucard" data-user="{{ u.user }}">
         <div class="uhead">
           <div class="uname">{{ u.user }}</div>
           {% if u.status == "Online" %}
-            <div class="badge b-online"><span class="dot"></span>Online</div>
+            <div class="badge b-online"><span class="dot"></span><span class="st">Online</span></div>
           {% else %}
-            <div class="badge b-inact"><span class="dot"></span>Inactive</div>
+            <div class="badge b-inact"><span class="dot"></span><span class="st">Inactive</span></div>
           {% endif %}
         </div>
 
         <div style="display:grid;gap:6px">
           <div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Password</span><span><b>{{ u.password }}</b></span></div>
-          <div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Data</span><span><b>{{ u.traffic }}</b></span></div>
+          <div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Data</span><span><b class="tr">{{ u.traffic }}</b></span></div>
+          {% if u.quota %}<div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Quota</span><span>{% if u.quota_exhausted %}<b style="color:#b91c1c">used up</b>{% else %}<b>{{ human(u.quota_used) }}</b> used · <b>{{ u.quota_left }}</b> left{% endif %}</span></div>{% endif %}
           <div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Port</span><span><b>{{ u.port or listen_port }}</b></span></div>
-          <div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Bind IP</span><span><b>{{ u.bind_ip or "—" }}</b></span></div>
+          <div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Bind IP</span><span><b class="bip">{{ u.bind_ip or "—" }}</b></span></div>
           <div style="display:flex;justify-content:space-between;font-size:13px"><span class="muted">Expires</span><span><b>{{ u.expires }}</b></span></div>
         </div>
       </div>
     {% endfor %}
   </div>
+  {% if pages > 1 %}
+  <div class="pager">
+    {% if page > 1 %}<a class="btn" href="{{ url_for('index', filter=filter_type, page=page-1) }}">‹ Prev</a>{% endif %}
+    <span class="muted">{{ page }} / {{ pages }} ({{ matched }})</span>
+    {% if page < pages %}<a class="btn" href="{{ url_for('index', filter=filter_type, page=page+1) }}">Next ›</a>{% endif %}
+  </div>
+  {% endif %}
+  {% if state_version and not info_page %}
+  <script>
+  // live status: patch cards in place from /events diffs instead of re-scanning the whole page
+  (function(){
+    if(!window.EventSource) return;
+    var es=new EventSource("{{ url_for('events', since=state_version) }}");
+    es.addEventListener('diff', function(e){
+      var d=JSON.parse(e.data);
+      d.changes.forEach(function(c){
+        var card=document.querySelector('.ucard[data-user="'+CSS.escape(c.user)+'"]'); if(!card) return;
+        if(c.status){
+          var b=card.querySelector('.badge');
+          b.className='badge '+(c.status=="Online"?'b-online':'b-inact'); b.querySelector('.st').textContent=c.status;
+        }
+        if(c.traffic) card.querySelector('.tr').textContent=c.traffic;
+        if(c.bind_ip!==undefined) card.querySelector('.bip').textContent=c.bind_ip||'—';
+      });
+      d.removed.forEach(function(u){ var card=document.querySelector('.ucard[data-user="'+CSS.escape(u)+'"]'); if(card) card.remove(); });
+      document.getElementById('online-kpi').textContent=d.online;
+      document.getElementById('online-count').textContent=d.online;
+    });
+    es.addEventListener('reset', function(){ location.reload(); });
+    es.onerror=function(){ if(es.readyState===2) setTimeout(function(){ location.reload(); }, 120000); };   // refused (503): poll
+  })();
+  </script>
+  {% endif %}
 
 </div>
 
@@ -360,7 +1384,7 @@ function copyToClipboard(text){
   <div class="wrap">
     <div class="nav">
       <a href="{{ url_for('index', filter='all') }}" class="{% if filter_type=='all' %}active{% endif %}">All ({{ total }})</a>
-      <a href="{{ url_for('index', filter='online') }}" class="{% if filter_type=='online' %}active{% endif %}">Online ({{ online_count }})</a>
+      <a href="{{ url_for('index', filter='online') }}" class="{% if filter_type=='online' %}active{% endif %}">Online (<span id="online-count">{{ online_count }}</span>)</a>
       <a href="{{ url_for('index', filter='expired') }}" class="{% if filter_type=='expired' %}active{% endif %}">Expired ({{ expired_count }})</a>
     </div>
   </div>
@@ -368,77 +1392,113 @@ function copyToClipboard(text){
 
 </body></html>
 """
+PAGE = app.jinja_env.from_string(HTML)   # compiled once at startup, not per request
 
 # ---------- VIEW ----------
-def build_view(msg="", err="", info_user=None):
-    users = ensure_expiry_and_prune(load_users())
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    month_start = datetime.now().replace(day=1).strftime("%Y-%m-%d")
-    listen = get_listen_port()
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "30"))   # cards per page
+_rows_cache = {"key": None, "rows": [], "online": 0, "expired": 0, "today_new": 0, "month_new": 0}
+_rows_lock = threading.Lock()
+
+def render_page(**ctx):
+    # stream the precompiled PAGE template: header + KPIs flush before the card list is rendered
+    app.update_template_context(ctx)
+    out = PAGE.stream(**ctx); out.enable_buffering(16)
+    return Response(stream_with_context(out), mimetype="text/html")
+
+# copied byte for byte from web.py (each panel installs as one file); change both together
+class UserRow:
+  """One dashboard/API row. __slots__: no per-row class or __dict__, just a fixed-size record."""
+  __slots__=("user","password","expires","port","bind_ip","status","expired","traffic_bytes","key",
+             "quota","quota_used","quota_exhausted","last_seen")
+  def __init__(self, u, status, today, traffic_bytes=0, last_seen=0):
+    self.user=u.get("user",""); self.password=u.get("password",""); self.expires=u.get("expires","")
+    self.port=u.get("port",""); self.bind_ip=u.get("bind_ip",""); self.status=status
+    self.expired=bool(self.expires and self.expires<today); self.traffic_bytes=int(traffic_bytes or 0)
+    self.key=self.user.lower()
+    self.quota=int(u.get("quota") or 0); self.quota_exhausted=u.get("quota_exhausted","")
+    self.quota_used=max(self.traffic_bytes-int(u.get("quota_base") or 0), 0) if self.quota else 0
+    self.last_seen=int(last_seen or 0)
+  @property
+  def traffic(self): return bytes_to_human(self.traffic_bytes)
+  @property
+  def seen_ago(self):
+    if not self.last_seen: return ""
+    d=max(int(time.time())-self.last_seen, 0)
+    return f"{d//86400}d ago" if d>=86400 else f"{d//3600}h ago" if d>=3600 else f"{d//60}m ago" if d>=60 else "just now"
+  @property
+  def quota_left(self): return bytes_to_human(max(self.quota-self.quota_used, 0))
+  def as_dict(self, fields): return {k:getattr(self,k) for k in fields}
+
+def view_key(st):
+    # everything a card depends on: store, online port set, traffic totals, listen port and today's date
+    return (store_version(), st.get("online_sig"), st.get("traffic_sig"), st["listen_port"], datetime.now().strftime("%Y-%m-%d"))
+
+def user_rows(st):
+    # cards (online first) + KPI counts for a snapshot; rebuilt only when view_key() changed, shared by every request
+    key = view_key(st)
+    with _rows_lock:
+        if _rows_cache["key"] != key:
+            today = key[-1]; month_start = today[:8] + "01"; ctr = st["counters"]; traffic = st.get("traffic", {})
+            users = load_users()
+            rows = [UserRow(u, status_for_user_by_counters(u.get("port"), ctr), today, traffic.get(u.get("user",""), 0)) for u in users]
+            rows.sort(key=lambda r: (r.status != "Online", r.key))
+            _rows_cache.update(key=key, rows=rows, online=sum(r.status == "Online" for r in rows), expired=sum(r.expired for r in rows),
+                               today_new=sum(u.get("created_on","") == today for u in users),
+                               month_new=sum(u.get("created_on","") >= month_start for u in users))
+        return dict(_rows_cache)
 
-    # ensure per-user NAT + MANGLE rules exist
-    for u in users:
-        if u.get("port"):
-            nat_rule_add(u.get("user",""), u.get("port"))
-            mangle_rule_add(u.get("user",""), u.get("port"))
-
-    ctr = mangle_counters()  # original dport counters
-
-    processed=[]; online=0; expired=0; today_new=0; month_new=0
-    for u in users:
-        st = status_for_user_by_counters(u.get("port"), ctr)
-        if st == "Online":
-            online += 1
-            if not u.get("bind_ip"):
-                try_autolock_bind_ip(u); save_users(users)
-
-        _, by = ctr.get(str(u.get("port","")), (0,0))
-        t_h = bytes_to_human(by)
-
-        if u.get("created_on","") == today_str: today_new += 1
-        if u.get("created_on","") >= month_start: month_new += 1
-        if u.get("expires","") < today_str: expired += 1
-
-        processed.append({
-            "user": u.get("user",""),
-            "password": u.get("password",""),
-            "expires": u.get("expires",""),
-            "port": u.get("port",""),
-            "bind_ip": u.get("bind_ip",""),
-            "status": st,
-            "traffic": t_h
-        })
+def build_view(msg="", err="", info_user=None):
+    state = get_state()
+    v = user_rows(state)
 
+    # filter before paging, over the cached rows: no per-request row objects or list copies
     f = request.args.get("filter","all")
-    if f == "online": view = [x for x in processed if x["status"]=="Online"]
-    elif f == "expired": view = [x for x in processed if x["expires"] < today_str]
-    else: view = processed
-    view.sort(key=lambda x: (x["status"]!="Online", (x["user"] or "").lower()))
-
+    rows = v["rows"]
+    keep = {"online": lambda r: r.status == "Online", "expired": attrgetter("expired")}.get(f)
+    matched = sum(1 for r in rows if keep(r)) if keep else len(rows)
+
+    pages = max(1, -(-matched // PAGE_SIZE))
+    try: page = min(max(int(request.args.get("page") or 1), 1), pages)
+    except ValueError: page = 1
+    start = (page - 1) * PAGE_SIZE
+
+    ctx = dict(logo=LOGO_URL, listen_port=state["listen_port"], default_days=DEFAULT_DAYS,
+               default_quota=bytes_to_human(DEFAULT_QUOTA) if DEFAULT_QUOTA else "", human=bytes_to_human,
+               today_new=v["today_new"], month_new=v["month_new"],
+               online_count=v["online"], expired_count=v["expired"],
+               total=len(rows), filter_type=f, msg=msg, err=err,
+               state_age=int(time.time()-state["at"]), state_version=state["version"], sync=sync_stats(),
+               collect_ms=state.get("collect_ms", 0), service=state.get("service", ""),
+               page=page, pages=pages, matched=matched)
     if info_user:
-        return render_template_string(
-            HTML, info_page=True, info=info_user, logo=LOGO_URL,
-            listen_port=listen, default_days=DEFAULT_DAYS,
-            today_new=today_new, month_new=month_new,
-            online_count=online, expired_count=expired,
-            total=len(processed), filter_type=f, msg=msg, err=err
-        )
-
-    return render_template_string(
-        HTML, users=view, logo=LOGO_URL,
-        listen_port=listen, default_days=DEFAULT_DAYS,
-        today_new=today_new, month_new=month_new,
-        online_count=online, expired_count=expired,
-        total=len(processed), filter_type=f, msg=msg, err=err
-    )
+        return render_page(info_page=True, info=info_user, users=(), **ctx)
+    return render_page(users=itertools.islice(filter(keep, rows) if keep else rows, start, start + PAGE_SIZE), **ctx)
 
 # ---------- ROUTES ----------
 @app.route("/", methods=["GET"])
 def index():
     return build_view()
 
+@app.route("/events", methods=["GET"])
+def events():
+    # SSE stream of per-user diffs; every tab shares the collector's snapshots
+    st = get_state()
+    try: last = int(request.headers.get("Last-Event-ID") or request.args.get("since") or st["version"])
+    except ValueError: last = st["version"]
+    with _sse_lock:
+        if _sse_clients[0] >= _sse_cap[0]: return ("too many live viewers", 503)   # the page falls back to polling
+        _sse_clients[0] += 1
+    resp = Response(sse_stream(last), mimetype="text/event-stream")
+    resp.call_on_close(_sse_release)   # also runs when the client goes away before the stream started
+    resp.headers["Cache-Control"] = "no-cache"; resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+def _sse_release():
+    with _sse_lock: _sse_clients[0] -= 1
+
 @app.route("/refresh_status", methods=["POST"])
 def refresh_status():
+    request_refresh(wait=10)
     return redirect(url_for('index', filter=request.args.get('filter','all')))
 
 @app.route("/add", methods=["POST"])
@@ -448,22 +1508,22 @@ def add_user():
     if not user or not password:
         return build_view(err="User/Password လိုအပ်ပါသည်")
 
-    users = load_users()
     today = date.today()
     expires = (today + timedelta(days=DEFAULT_DAYS)).strftime("%Y-%m-%d")
     created = today.strftime("%Y-%m-%d")
     port = pick_free_port()
     if not port: return build_view(err="အသုံးပြုရန် UDP port မထိုက်ပါ")
-    rec = {"user":user,"password":password,"created_on":created,"expires":expires,"port":port,"bind_ip":""}
-
-    replaced=False
-    for u in users:
-        if u.get("user","").lower()==user.lower():
-            u.update(rec); replaced=True; break
-    if not replaced: users.append(rec)
-
-    save_users(users); sync_config_pw()
-    nat_rule_add(user, port); mangle_rule_add(user, port)
+    rec = {"user":user,"password":password,"created_on":created,"expires":expires,"port":port,"bind_ip":"",
+           "quota":str(DEFAULT_QUOTA) if DEFAULT_QUOTA else "", "quota_exhausted":"",
+           "quota_base":str(get_state().get("traffic", {}).get(user, 0)) if DEFAULT_QUOTA else ""}
+    try: upsert_user(rec)
+    except ValueError:
+        release_port(port)
+        return build_view(err="အသုံးပြုရန် UDP port မထိုက်ပါ")
+    claim_port(port)
+
+    sync_config_pw()
+    reconcile_rules(load_users()); request_refresh()
 
     session["new_info"]= {"user":user,"password":password,"expires":expires,"port":port,"vps_ip":VPS_IP}
     return redirect(url_for("show_info"))
@@ -474,6 +1534,17 @@ def show_info():
     if not info: return redirect(url_for("index"))
     return build_view(info_user=info)
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Prometheus text format: the cached snapshot part plus the values that move between snapshots
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return ("unauthorized", 401)
+    st = get_state(); sync = sync_stats(); out = []
+    _prom_metric(out, "zivpn_collector_age_seconds", "gauge", "Seconds since the last snapshot.", [({}, round(time.time() - st["at"], 3))])
+    _prom_metric(out, "zivpn_config_restarts_total", "counter", "zivpn restarts after config syncs.", [({}, sync["restarts"])])
+    _prom_metric(out, "zivpn_config_restarts_avoided_total", "counter", "Config syncs that needed no restart.", [({}, sync["avoided"])])
+    return Response(metrics_text(st) + "\n".join(out) + "\n", mimetype="text/plain; version=0.0.4")
+
 @app.route("/favicon.ico")
 def favicon(): return ("",204)
 
@@ -481,4 +1552,9 @@ def favicon(): return ("",204)
 def _405(e): return redirect(url_for("index"))
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=WEB_PORT)
+    # maintenance: `web.py migrate-users` (users.json -> USERS_DB), `web.py export-users [path]`
+    if sys.argv[1:2] == ["migrate-users"]:
+        print(f"imported {migrate_users_json()} users into {USERS_DB}"); sys.exit(0)
+    if sys.argv[1:2] == ["export-users"]:
+        export_users_json(*sys.argv[2:3]); sys.exit(0)
+    serve()
@@ -39,7 +39,8 @@ apt_guard_end(){ dpkg --configure -a >/dev/null 2>&1 || true; apt-get -f install
 say "${Y}📦 Packages တင်နေ...${Z}"
 apt_guard_start
 apt-get update -y -o APT::Update::Post-Invoke::= >/dev/null
-apt-get install -y curl ufw jq python3 python3-flask python3-apt iproute2 conntrack ca-certificates openssl >/dev/null
+apt-get install -y curl ufw jq python3 python3-flask python3-apt iproute2 conntrack nftables ca-certificates openssl >/dev/null
+apt-get install -y python3-gunicorn >/dev/null 2>&1 || true   # optional: WEB_WORKERS>1 serving mode
 apt_guard_end
 
 # ===== Stop old services =====
@@ -132,6 +133,10 @@ After=network.target
 [Service]
 Type=simple
 User=root
+# WEB_WORKERS=4 / WEB_THREADS=8 in web.env -> gunicorn workers (one collects, the rest mirror its state)
+# METRICS_TOKEN=... -> /metrics for Prometheus (Authorization: Bearer ...); METRICS_USER_LIMIT=500 caps per-user series
+# DEFAULT_QUOTA=5G -> every new user gets a 5 GiB data quota (dropped in the kernel once used up)
+EnvironmentFile=-/etc/zivpn/web.env
 ExecStart=/usr/bin/python3 /etc/zivpn/web.py
 Restart=always
 RestartSec=3